@@ -1,7 +1,8 @@
 import unittest
 import requests
 import json
-from datetime import datetime, date
+import time
+from datetime import datetime, date, timedelta
 
 # Base URL for the API
 BASE_URL = "http://localhost:8000"  # Change this if your API is running on a different URL
@@ -131,6 +132,25 @@ class TestDonorManagementAPI(unittest.TestCase):
         response = requests.get(f"{BASE_URL}/donors/?skip=0&limit=10")
         self.assertEqual(response.status_code, 200)
 
+    def test_read_donors_sparse_fields(self):
+        """Test restricting donor columns with the fields parameter"""
+        response = requests.post(f"{BASE_URL}/donors/", json=self.donor_data)
+        self.assertEqual(response.status_code, 200)
+        self.donor_id = response.json()["id"]
+
+        response = requests.get(f"{BASE_URL}/donors/?fields=first_name,last_name,email")
+        self.assertEqual(response.status_code, 200)
+        for donor in response.json():
+            self.assertEqual(set(donor), {"id", "first_name", "last_name", "email"})
+
+        response = requests.get(f"{BASE_URL}/donors/{self.donor_id}?fields=email")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"id": self.donor_id, "email": "john.doe@example.com"})
+
+        # Unknown fields are rejected
+        response = requests.get(f"{BASE_URL}/donors/?fields=email,not_a_field")
+        self.assertEqual(response.status_code, 422)
+
     # -------------------- Program Tests --------------------
 
     def test_program_crud(self):
@@ -231,6 +251,62 @@ class TestDonorManagementAPI(unittest.TestCase):
         # Reset donation_id since we've deleted it
         self.donation_id = None
 
+    def test_donation_idempotency_key(self):
+        """Test that a retried donation with the same Idempotency-Key is not inserted twice"""
+        response = requests.post(f"{BASE_URL}/donors/", json=self.donor_data)
+        self.assertEqual(response.status_code, 200)
+        self.donor_id = response.json()["id"]
+
+        donation_data = {
+            "donor_id": self.donor_id,
+            "amount": 25.0,
+            "donation_date": str(date.today()),
+            "payment_method": "credit_card",
+            "transaction_id": f"TX-IDEMPOTENT-{datetime.now().timestamp()}"
+        }
+        headers = {"Idempotency-Key": donation_data["transaction_id"]}
+
+        response = requests.post(f"{BASE_URL}/donations/", json=donation_data, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.donation_id = response.json()["id"]
+
+        # The retry returns the original donation
+        response = requests.post(f"{BASE_URL}/donations/", json=donation_data, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["id"], self.donation_id)
+        self.assertEqual(response.headers.get("Idempotent-Replayed"), "true")
+
+        # Reusing the key for a different body is rejected
+        response = requests.post(f"{BASE_URL}/donations/", json={**donation_data, "amount": 30.0}, headers=headers)
+        self.assertEqual(response.status_code, 422)
+
+    def test_donation_unique_transaction(self):
+        """Test that a repeated transaction id returns the existing donation (needs the unique transaction index)"""
+        response = requests.post(f"{BASE_URL}/donors/", json=self.donor_data)
+        self.assertEqual(response.status_code, 200)
+        self.donor_id = response.json()["id"]
+
+        donation_data = {
+            "donor_id": self.donor_id,
+            "amount": 25.0,
+            "donation_date": str(date.today()),
+            "payment_method": "credit_card",
+            "transaction_id": f"TX-UNIQUE-{datetime.now().timestamp()}"
+        }
+        response = requests.post(f"{BASE_URL}/donations/", json=donation_data)
+        self.assertEqual(response.status_code, 200)
+        self.donation_id = response.json()["id"]
+
+        response = requests.post(f"{BASE_URL}/donations/", json=donation_data)
+        self.assertEqual(response.status_code, 200)
+        if response.json()["id"] != self.donation_id:
+            requests.delete(f"{BASE_URL}/donations/{response.json()['id']}")
+            self.skipTest("the unique transaction index has not been created (python idempotency.py unique-transactions)")
+
+        # The same transaction id with different details is a conflict, not a silent replay
+        response = requests.post(f"{BASE_URL}/donations/", json={**donation_data, "amount": 30.0})
+        self.assertEqual(response.status_code, 409)
+
     # -------------------- Pledge Tests --------------------
 
     def test_pledge_crud(self):
@@ -293,8 +369,167 @@ class TestDonorManagementAPI(unittest.TestCase):
         # Reset pledge_id since we've deleted it
         self.pledge_id = None
 
+    def test_pledge_patch(self):
+        """Test partial updates of a pledge with If-Match"""
+        response = requests.post(f"{BASE_URL}/donors/", json=self.donor_data)
+        self.assertEqual(response.status_code, 200)
+        self.donor_id = response.json()["id"]
+
+        response = requests.post(f"{BASE_URL}/pledges/", json={
+            "donor_id": self.donor_id,
+            "amount": 1000.0,
+            "pledge_date": str(date.today()),
+            "status": "pending",
+            "amount_fulfilled": 0.0
+        })
+        self.assertEqual(response.status_code, 200)
+        self.pledge_id = response.json()["id"]
+
+        # Change only the status; the other fields keep their values
+        response = requests.patch(f"{BASE_URL}/pledges/{self.pledge_id}", json={"status": "partial"})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["status"], "partial")
+        self.assertEqual(data["amount"], 1000.0)
+        etag = response.headers["ETag"]
+
+        # A matching If-Match succeeds, the now stale one is rejected
+        response = requests.patch(f"{BASE_URL}/pledges/{self.pledge_id}", json={"amount_fulfilled": 500.0},
+                                  headers={"If-Match": etag})
+        self.assertEqual(response.status_code, 200)
+
+        response = requests.patch(f"{BASE_URL}/pledges/{self.pledge_id}", json={"status": "fulfilled"},
+                                  headers={"If-Match": etag})
+        self.assertEqual(response.status_code, 412)
+
+        # A GET, with or without fields, returns the current ETag to patch against
+        response = requests.get(f"{BASE_URL}/pledges/{self.pledge_id}")
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers["ETag"]
+        response = requests.get(f"{BASE_URL}/pledges/{self.pledge_id}", params={"fields": "status"})
+        self.assertEqual(response.json(), {"id": self.pledge_id, "status": "partial"})
+        self.assertEqual(response.headers["ETag"], etag)
+        response = requests.patch(f"{BASE_URL}/pledges/{self.pledge_id}", json={"status": "fulfilled"},
+                                  headers={"If-Match": etag})
+        self.assertEqual(response.status_code, 200)
+
+        # Required fields cannot be cleared
+        response = requests.patch(f"{BASE_URL}/pledges/{self.pledge_id}", json={"amount": None})
+        self.assertEqual(response.status_code, 422)
+
     # -------------------- Special Endpoint Tests --------------------
 
+    def test_pledge_reconciliation(self):
+        """Test matching a donation to an open pledge"""
+        response = requests.post(f"{BASE_URL}/donors/", json=self.donor_data)
+        self.assertEqual(response.status_code, 200)
+        self.donor_id = response.json()["id"]
+
+        response = requests.post(f"{BASE_URL}/programs/", json=self.program_data)
+        self.assertEqual(response.status_code, 200)
+        self.program_id = response.json()["id"]
+
+        response = requests.post(f"{BASE_URL}/pledges/", json={
+            "donor_id": self.donor_id, "program_id": self.program_id, "amount": 1000.0,
+            "pledge_date": str(date.today()), "status": "pending", "amount_fulfilled": 0.0})
+        self.assertEqual(response.status_code, 200)
+        self.pledge_id = response.json()["id"]
+
+        response = requests.post(f"{BASE_URL}/donations/", json={
+            "donor_id": self.donor_id, "program_id": self.program_id, "amount": 400.0,
+            "donation_date": str(date.today())})
+        self.assertEqual(response.status_code, 200)
+        self.donation_id = response.json()["id"]
+
+        # Run the reconciliation job and wait for it
+        response = requests.post(f"{BASE_URL}/pledges/reconcile/", params={"full": True})
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json()["id"]
+        for _ in range(50):
+            if requests.get(f"{BASE_URL}/jobs/{job_id}").json()["status"] in ("succeeded", "failed"):
+                break
+            time.sleep(0.2)
+        self.assertEqual(requests.get(f"{BASE_URL}/jobs/{job_id}").json()["status"], "succeeded")
+
+        data = requests.get(f"{BASE_URL}/pledges/{self.pledge_id}").json()
+        self.assertEqual(data["status"], "partially_fulfilled")
+        self.assertEqual(data["amount_fulfilled"], 400.0)
+
+        response = requests.get(f"{BASE_URL}/pledges/{self.pledge_id}/allocations")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(row["donation_id"], row["amount"]) for row in response.json()],
+                         [(self.donation_id, 400.0)])
+
+    def test_statement_reconciliation(self):
+        """Test matching statement lines to donations by transaction id and by amount and date"""
+        response = requests.post(f"{BASE_URL}/donors/", json=self.donor_data)
+        self.assertEqual(response.status_code, 200)
+        self.donor_id = response.json()["id"]
+
+        response = requests.post(f"{BASE_URL}/donations/", json={
+            "donor_id": self.donor_id, "amount": 123.45, "donation_date": "2024-03-01",
+            "payment_method": "test_processor", "transaction_id": "TEST-RECON-1"})
+        self.assertEqual(response.status_code, 200)
+        self.donation_id = response.json()["id"]
+
+        statement = "transaction_id,amount,date\nTEST-RECON-1,123.45,2024-03-02\nTEST-RECON-2,50.00,2024-03-03\n"
+        response = requests.post(f"{BASE_URL}/reports/statement-reconciliation/",
+                                 params={"payment_method": "test_processor"},
+                                 files={"file": ("statement.csv", statement, "text/csv")})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["matched_by_transaction_id"], 1)
+        self.assertEqual(data["unmatched_statement"], 1)
+        self.assertEqual(data["unmatched_database"], 0)
+
+        response = requests.get(f"{BASE_URL}{data['files']['matched']}")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("TEST-RECON-1", response.text)
+
+        # A statement without the required columns is rejected
+        response = requests.post(f"{BASE_URL}/reports/statement-reconciliation/",
+                                 files={"file": ("statement.csv", "id,total\n1,2\n", "text/csv")})
+        self.assertEqual(response.status_code, 422)
+
+        # A statement much larger than the matching donations is still split to fit the memory budget
+        import io
+        from unittest import mock
+        import models
+        import reconciliation
+
+        lines = "".join(f"TEST-RECON-BIG-{i},1.00,2024-03-02\n" for i in range(10_000))
+        upload = io.BytesIO(f"transaction_id,amount,date\nTEST-RECON-1,123.45,2024-03-02\n{lines}".encode())
+        with mock.patch.object(reconciliation, "RECONCILIATION_MEMORY_MB", 1), models.ReportSessionLocal() as db:
+            summary = reconciliation.reconcile_statement(db, upload, payment_method="test_processor")
+        self.assertGreater(summary["buckets"]["transaction_id"], 1)
+        self.assertEqual(summary["matched_by_transaction_id"], 1)
+        self.assertEqual(summary["unmatched_statement"], 10_000)
+
+    def test_donor_merge(self):
+        """Test merging a duplicate donor moves its donations"""
+        response = requests.post(f"{BASE_URL}/donors/", json=self.donor_data)
+        self.assertEqual(response.status_code, 200)
+        self.donor_id = response.json()["id"]
+
+        response = requests.post(f"{BASE_URL}/donors/", json={**self.donor_data, "first_name": "Jon",
+                                                              "email": "JOHN.DOE@example.com", "notes": None})
+        self.assertEqual(response.status_code, 200)
+        duplicate_id = response.json()["id"]
+
+        response = requests.post(f"{BASE_URL}/donations/", json={
+            "donor_id": duplicate_id, "amount": 25.0, "donation_date": str(date.today())})
+        self.assertEqual(response.status_code, 200)
+        self.donation_id = response.json()["id"]
+
+        response = requests.post(f"{BASE_URL}/donors/{self.donor_id}/merge", json={"duplicate_id": duplicate_id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(requests.get(f"{BASE_URL}/donations/{self.donation_id}").json()["donor_id"], self.donor_id)
+        self.assertEqual(requests.get(f"{BASE_URL}/donors/{duplicate_id}").status_code, 404)
+
+        # A donor can't be merged into itself
+        response = requests.post(f"{BASE_URL}/donors/{self.donor_id}/merge", json={"duplicate_id": self.donor_id})
+        self.assertEqual(response.status_code, 422)
+
     def test_donations_by_program(self):
         """Test getting donations by program"""
         # Create necessary test data
@@ -328,6 +563,390 @@ class TestDonorManagementAPI(unittest.TestCase):
         data = response.json()
         self.assertIsInstance(data, list)
 
+    def test_donations_timeseries(self):
+        """Test daily and monthly rollups for one program's donations"""
+        response = requests.post(f"{BASE_URL}/donors/", json=self.donor_data)
+        self.assertEqual(response.status_code, 200)
+        self.donor_id = response.json()["id"]
+
+        response = requests.post(f"{BASE_URL}/programs/", json=self.program_data)
+        self.assertEqual(response.status_code, 200)
+        self.program_id = response.json()["id"]
+
+        today = date.today()
+        donation_ids = []
+        for amount in (40.0, 60.0):
+            response = requests.post(f"{BASE_URL}/donations/", json={
+                "donor_id": self.donor_id, "program_id": self.program_id, "amount": amount,
+                "donation_date": str(today)})
+            self.assertEqual(response.status_code, 200)
+            donation_ids.append(response.json()["id"])
+
+        for granularity, bucket_date in (("day", today), ("month", today.replace(day=1))):
+            response = requests.get(f"{BASE_URL}/reports/donations-timeseries/",
+                                    params={"granularity": granularity, "program_id": self.program_id})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json(), [{"program_id": self.program_id, "bucket_date": str(bucket_date),
+                                                "total_amount": 100.0, "gift_count": 2, "distinct_donors": 1}])
+
+        # Deleting the donations empties the buckets
+        for donation_id in donation_ids:
+            requests.delete(f"{BASE_URL}/donations/{donation_id}")
+        response = requests.get(f"{BASE_URL}/reports/donations-timeseries/", params={"program_id": self.program_id})
+        self.assertEqual(response.json(), [])
+
+        response = requests.get(f"{BASE_URL}/reports/donations-timeseries/", params={"granularity": "week"})
+        self.assertEqual(response.status_code, 422)
+
+    def test_change_feed(self):
+        """Test that the change feed returns creates, updates and deletes, and waits for open transactions"""
+        from sqlalchemy import text
+        import models
+
+        def read_all(cursor=None):
+            changes, deleted = [], []
+            while True:
+                response = requests.get(f"{BASE_URL}/changes/donors",
+                                        params={"limit": 5000, **({"cursor": cursor} if cursor else {})})
+                self.assertEqual(response.status_code, 200)
+                page = response.json()
+                changes += page["changes"]
+                deleted += page["deleted"]
+                cursor = page["next_cursor"]
+                if not page["has_more"]:
+                    return changes, deleted, cursor
+
+        _, _, cursor = read_all()
+
+        # A transaction that is still open holds the feed back, so a row it writes later is not skipped
+        with models.SessionLocal() as open_transaction:
+            open_transaction.execute(text("SELECT txid_current()"))
+            response = requests.post(f"{BASE_URL}/donors/", json=self.donor_data)
+            self.assertEqual(response.status_code, 200)
+            self.donor_id = response.json()["id"]
+            changes, _, cursor = read_all(cursor)
+            self.assertNotIn(self.donor_id, [change["id"] for change in changes])
+
+        changes, _, cursor = read_all(cursor)
+        self.assertEqual([(change["id"], change["op"]) for change in changes if change["id"] == self.donor_id],
+                         [(self.donor_id, "created")])
+
+        response = requests.put(f"{BASE_URL}/donors/{self.donor_id}", json={**self.donor_data, "city": "Feedville"})
+        self.assertEqual(response.status_code, 200)
+        changes, _, cursor = read_all(cursor)
+        self.assertEqual([(change["op"], change["data"]["city"]) for change in changes if change["id"] == self.donor_id],
+                         [("updated", "Feedville")])
+
+        requests.delete(f"{BASE_URL}/donors/{self.donor_id}")
+        _, deleted, _ = read_all(cursor)
+        self.assertIn(self.donor_id, [tombstone["id"] for tombstone in deleted])
+
+        response = requests.get(f"{BASE_URL}/changes/donors", params={"cursor": "not-a-cursor"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_donations_by_geography(self):
+        """Test geographic rollups for one program's donations"""
+        response = requests.post(f"{BASE_URL}/donors/", json=self.donor_data)
+        self.assertEqual(response.status_code, 200)
+        self.donor_id = response.json()["id"]
+
+        response = requests.post(f"{BASE_URL}/programs/", json=self.program_data)
+        self.assertEqual(response.status_code, 200)
+        self.program_id = response.json()["id"]
+
+        response = requests.post(f"{BASE_URL}/donations/", json={
+            "donor_id": self.donor_id, "program_id": self.program_id, "amount": 75.0,
+            "donation_date": str(date.today())})
+        self.assertEqual(response.status_code, 200)
+        self.donation_id = response.json()["id"]
+
+        response = requests.get(f"{BASE_URL}/reports/donations-by-geography/",
+                                params={"program_id": self.program_id, "level": "state"})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([row["level"] for row in data], ["total", "country", "state"])
+        self.assertEqual(data[2]["state"], "CA")
+        for row in data:
+            self.assertEqual((row["total_amount"], row["gift_count"], row["donor_count"]), (75.0, 1, 1))
+
+        # Nothing matches: just an empty grand total
+        response = requests.get(f"{BASE_URL}/reports/donations-by-geography/",
+                                params={"program_id": self.program_id, "start_date": "2099-01-01"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [{"level": "total", "total_amount": 0.0, "gift_count": 0, "donor_count": 0}])
+
+        response = requests.get(f"{BASE_URL}/reports/donations-by-geography/", params={"level": "street"})
+        self.assertEqual(response.status_code, 422)
+
+    def test_leaderboards(self):
+        """Test top donors and largest gifts for one program"""
+        response = requests.post(f"{BASE_URL}/donors/", json=self.donor_data)
+        self.assertEqual(response.status_code, 200)
+        self.donor_id = response.json()["id"]
+
+        response = requests.post(f"{BASE_URL}/programs/", json=self.program_data)
+        self.assertEqual(response.status_code, 200)
+        self.program_id = response.json()["id"]
+
+        response = requests.post(f"{BASE_URL}/donations/", json={
+            "donor_id": self.donor_id, "program_id": self.program_id, "amount": 250.0,
+            "donation_date": str(date.today())})
+        self.assertEqual(response.status_code, 200)
+        self.donation_id = response.json()["id"]
+
+        response = requests.get(f"{BASE_URL}/reports/leaderboards/donors/",
+                                params={"program_id": self.program_id, "year": date.today().year})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(row["rank"], row["donor_id"], row["total_amount"]) for row in response.json()],
+                         [(1, self.donor_id, 250.0)])
+
+        response = requests.get(f"{BASE_URL}/reports/leaderboards/gifts/", params={"program_id": self.program_id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row["donation_id"] for row in response.json()], [self.donation_id])
+
+    def test_dashboard(self):
+        """Test the combined dashboard payload"""
+        response = requests.post(f"{BASE_URL}/donors/", json=self.donor_data)
+        self.assertEqual(response.status_code, 200)
+        self.donor_id = response.json()["id"]
+
+        response = requests.get(f"{BASE_URL}/reports/dashboard/", params={"limit": 1})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(set(data["sections"]), {"programs", "unfulfilled_pledges", "pending_thank_you_notes",
+                                                 "recent_donations", "recent_donors"})
+        for section in data["sections"].values():
+            self.assertLessEqual(len(section["rows"]), 1)
+            self.assertIn("elapsed_ms", section)
+        self.assertEqual(data["sections"]["recent_donors"]["rows"][0]["donor_id"], self.donor_id)
+
+        response = requests.get(f"{BASE_URL}/reports/dashboard/", params={"sections": "recent_donors,not_a_section"})
+        self.assertEqual(response.status_code, 422)
+
+        # The dashboard is admitted under its own route class
+        stats = requests.get(f"{BASE_URL}/metrics/admission").json()["classes"]
+        self.assertGreaterEqual(stats["dashboard"]["admitted"], 1)
+
+        # and runs on its own pool, so it completes while every report-pool connection is taken
+        import dashboard
+        import models
+
+        held = [models.report_engine.connect() for _ in range(models.REPORT_POOL_SIZE)]
+        try:
+            data = dashboard.build_dashboard(list(dashboard.SECTIONS), 1)
+        finally:
+            for connection in held:
+                connection.close()
+        self.assertEqual(set(data["sections"]), set(dashboard.SECTIONS))
+
+    def test_list_total_count(self):
+        """Test X-Total-Count on list endpoints"""
+        response = requests.post(f"{BASE_URL}/donors/", json=self.donor_data)
+        self.assertEqual(response.status_code, 200)
+        self.donor_id = response.json()["id"]
+
+        response = requests.post(f"{BASE_URL}/programs/", json=self.program_data)
+        self.assertEqual(response.status_code, 200)
+        self.program_id = response.json()["id"]
+
+        self.donation_ids = []
+        for amount in (10.0, 20.0, 30.0):
+            response = requests.post(f"{BASE_URL}/donations/", json={
+                "donor_id": self.donor_id, "program_id": self.program_id, "amount": amount,
+                "donation_date": str(date.today())})
+            self.assertEqual(response.status_code, 200)
+            self.donation_ids.append(response.json()["id"])
+
+        response = requests.get(f"{BASE_URL}/donations/", params={"donor_id": self.donor_id, "limit": 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("X-Total-Count", response.headers)
+
+        # A few rows are always counted exactly, also for sparse fieldsets
+        for mode, fields in (("exact", None), ("estimated", None), ("exact", "amount")):
+            response = requests.get(f"{BASE_URL}/donations/", params={
+                "donor_id": self.donor_id, "limit": 1, "count": mode, "fields": fields
+            })
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.json()), 1)
+            self.assertEqual(response.headers["X-Total-Count"], "3")
+            self.assertEqual(response.headers["X-Total-Count-Mode"], "exact")
+
+        response = requests.get(f"{BASE_URL}/donations/", params={"count": "estimated", "limit": 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(int(response.headers["X-Total-Count"]), 3)
+
+        response = requests.get(f"{BASE_URL}/donations/", params={"count": "approximate"})
+        self.assertEqual(response.status_code, 422)
+
+        for donation_id in self.donation_ids:
+            requests.delete(f"{BASE_URL}/donations/{donation_id}")
+
+    def test_delete_referenced_donation(self):
+        """Test that a donation with a thank you note cannot be deleted"""
+        response = requests.post(f"{BASE_URL}/donors/", json=self.donor_data)
+        self.assertEqual(response.status_code, 200)
+        self.donor_id = response.json()["id"]
+
+        response = requests.post(f"{BASE_URL}/donations/", json={
+            "donor_id": self.donor_id, "amount": 20.0, "donation_date": str(date.today())})
+        self.assertEqual(response.status_code, 200)
+        self.donation_id = response.json()["id"]
+
+        response = requests.post(f"{BASE_URL}/thank-you-notes/", json={
+            "donor_id": self.donor_id, "donation_id": self.donation_id, "method": "email"})
+        self.assertEqual(response.status_code, 200)
+        thank_you_note_id = response.json()["id"]
+
+        response = requests.delete(f"{BASE_URL}/donations/{self.donation_id}")
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(requests.get(f"{BASE_URL}/donations/{self.donation_id}").status_code, 200)
+
+        requests.delete(f"{BASE_URL}/thank-you-notes/{thank_you_note_id}")
+        response = requests.delete(f"{BASE_URL}/donations/{self.donation_id}")
+        self.assertEqual(response.status_code, 200)
+        self.donation_id = None
+
+        response = requests.delete(f"{BASE_URL}/donations/{response.json()['id']}")
+        self.assertEqual(response.status_code, 404)
+
+    def test_mark_sent(self):
+        """Test marking tax receipts and thank you notes as sent in bulk"""
+        response = requests.post(f"{BASE_URL}/donors/", json=self.donor_data)
+        self.assertEqual(response.status_code, 200)
+        self.donor_id = response.json()["id"]
+
+        response = requests.post(f"{BASE_URL}/programs/", json=self.program_data)
+        self.assertEqual(response.status_code, 200)
+        self.program_id = response.json()["id"]
+
+        response = requests.post(f"{BASE_URL}/donations/", json={
+            "donor_id": self.donor_id, "program_id": self.program_id, "amount": 75.0,
+            "donation_date": str(date.today())})
+        self.assertEqual(response.status_code, 200)
+        self.donation_id = response.json()["id"]
+
+        response = requests.post(f"{BASE_URL}/tax-receipts/", json={
+            "donor_id": self.donation_id, "total_amount": 75.0, "generated_date": str(date.today())})
+        self.assertEqual(response.status_code, 200)
+        tax_receipt_id = response.json()["id"]
+
+        response = requests.post(f"{BASE_URL}/thank-you-notes/", json={
+            "donor_id": self.donor_id, "donation_id": self.donation_id, "method": "email"})
+        self.assertEqual(response.status_code, 200)
+        thank_you_note_id = response.json()["id"]
+
+        for path, resource_id, narrow in (("tax-receipts", tax_receipt_id, {"donation_id": self.donation_id}),
+                                          ("thank-you-notes", thank_you_note_id, {"donation_id": self.donation_id})):
+            # A request that selects nothing specific would mark every row
+            for body in ({}, {"filter": {}}, {"filter": {"unsent_only": False}}):
+                response = requests.post(f"{BASE_URL}/{path}/mark-sent/", json=body)
+                self.assertEqual(response.status_code, 422)
+
+            response = requests.post(f"{BASE_URL}/{path}/mark-sent/", json={"ids": [resource_id], "dry_run": True})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json(), {"dry_run": True, "count": 1, "ids": []})
+            self.assertIsNone(requests.get(f"{BASE_URL}/{path}/{resource_id}").json()["sent_date"])
+
+            response = requests.post(f"{BASE_URL}/{path}/mark-sent/", json={"filter": narrow})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json(), {"dry_run": False, "count": 1, "ids": [resource_id]})
+            self.assertEqual(requests.get(f"{BASE_URL}/{path}/{resource_id}").json()["sent_date"], str(date.today()))
+
+            # Already sent, so unsent_only (the default) leaves it alone
+            response = requests.post(f"{BASE_URL}/{path}/mark-sent/", json={"filter": narrow, "dry_run": True})
+            self.assertEqual(response.json()["count"], 0)
+
+        requests.delete(f"{BASE_URL}/thank-you-notes/{thank_you_note_id}")
+        requests.delete(f"{BASE_URL}/tax-receipts/{tax_receipt_id}")
+
+    def wait_for_job(self, job_id, timeout=120):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            job = requests.get(f"{BASE_URL}/jobs/{job_id}").json()
+            if job["status"] in ("succeeded", "failed", "cancelled"):
+                self.assertEqual(job["status"], "succeeded", job.get("error"))
+                return requests.get(f"{BASE_URL}/jobs/{job_id}/result").json()["result"]
+            time.sleep(0.2)
+        self.fail(f"job {job_id} did not finish within {timeout}s")
+
+    def test_annual_statements(self):
+        """Test that annual statements and per-donation tax receipts don't stand in for each other"""
+        from sqlalchemy import text
+        import models
+
+        year = 2031
+        response = requests.post(f"{BASE_URL}/donors/", json=self.donor_data)
+        self.assertEqual(response.status_code, 200)
+        self.donor_id = response.json()["id"]
+
+        response = requests.post(f"{BASE_URL}/donations/", json={
+            "donor_id": self.donor_id, "amount": 120.0, "donation_date": f"{year}-03-01", "is_tax_deductible": True})
+        self.assertEqual(response.status_code, 200)
+        self.donation_id = response.json()["id"]
+
+        # A per-donation receipt does not stop the donor's annual statement
+        response = requests.post(f"{BASE_URL}/tax-receipts/", json={
+            "donor_id": self.donation_id, "year_donated": f"{year}-01-01", "total_amount": 120.0,
+            "generated_date": str(date.today())})
+        self.assertEqual(response.status_code, 200)
+        tax_receipt_id = response.json()["id"]
+
+        # Two jobs for the same year at once record the donor's statement once
+        job_ids = []
+        for _ in range(2):
+            response = requests.post(f"{BASE_URL}/tax-receipts/annual-statements/", params={"year": year, "shards": 1})
+            self.assertEqual(response.status_code, 202)
+            job_ids.append(response.json()["id"])
+        results = [self.wait_for_job(job_id) for job_id in job_ids]
+        self.assertGreaterEqual(sum(result["statements"] for result in results), 1)
+        with open(f"{results[0]['output_dir']}/statement_{year}_donor_{self.donor_id}.txt") as statement:
+            self.assertIn("$120.00", statement.read())
+        with models.engine.connect() as conn:
+            self.assertEqual(conn.execute(text("SELECT count(*) FROM annual_statements WHERE donor_id = :donor_id "
+                                               "AND year = :year"), {"donor_id": self.donor_id, "year": year}).scalar(), 1)
+
+        # Retrying skips donors who already have a statement
+        response = requests.post(f"{BASE_URL}/tax-receipts/annual-statements/", params={"year": year, "shards": 1})
+        self.assertEqual(self.wait_for_job(response.json()["id"])["statements"], 0)
+
+        # ... and the statement does not count as a receipt for the donation
+        requests.delete(f"{BASE_URL}/tax-receipts/{tax_receipt_id}")
+        response = requests.post(f"{BASE_URL}/tax-receipts/generate-for-year/", params={"year": year})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()["kind"], "tax_receipts")
+        self.wait_for_job(response.json()["id"])
+        receipts = requests.get(f"{BASE_URL}/tax-receipts/", params={"donation_id": self.donation_id}).json()
+        self.assertEqual([receipt["total_amount"] for receipt in receipts], [120.0])
+        for receipt in receipts:
+            requests.delete(f"{BASE_URL}/tax-receipts/{receipt['id']}")
+
+    def test_donor_segments(self):
+        """Test that tied donors get the same RFM scores and first-time donors are new"""
+        donor_ids, donation_ids = [], []
+        for _ in range(2):
+            response = requests.post(f"{BASE_URL}/donors/", json=self.donor_data)
+            self.assertEqual(response.status_code, 200)
+            donor_ids.append(response.json()["id"])
+            response = requests.post(f"{BASE_URL}/donations/", json={
+                "donor_id": donor_ids[-1], "amount": 1.0, "donation_date": str(date.today())})
+            self.assertEqual(response.status_code, 200)
+            donation_ids.append(response.json()["id"])
+
+        try:
+            response = requests.post(f"{BASE_URL}/jobs/", json={"kind": "donor_segments", "params": {}})
+            self.assertEqual(response.status_code, 202)
+            self.wait_for_job(response.json()["id"])
+
+            response = requests.get(f"{BASE_URL}/reports/donor-segments/", params={"segment": "new", "limit": 1000})
+            self.assertEqual(response.status_code, 200)
+            scores = {row["donor_id"]: (row["r_score"], row["f_score"], row["m_score"]) for row in response.json()}
+            self.assertIn(donor_ids[0], scores)
+            self.assertEqual(scores[donor_ids[0]], scores.get(donor_ids[1]))
+        finally:
+            for donation_id, donor_id in zip(donation_ids, donor_ids):
+                requests.delete(f"{BASE_URL}/donations/{donation_id}")
+                requests.delete(f"{BASE_URL}/donors/{donor_id}")
+
     def test_unfulfilled_pledges(self):
         """Test getting unfulfilled pledges"""
         # Create necessary test data
@@ -393,5 +1012,228 @@ class TestDonorManagementAPI(unittest.TestCase):
         response = requests.post(f"{BASE_URL}/tax_receipts/generate/{current_year}")
         self.assertEqual(response.status_code, 200)
 
+class TestWriteStatementCounts(unittest.TestCase):
+    """
+    Runs the app in-process and counts the SQL statements and commits each write issues
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        from fastapi.testclient import TestClient
+        from sqlalchemy import event
+        import main
+        import models
+        from events import PROGRESS_NOTIFY
+        from rollups import GRANULARITIES
+
+        cls.client = TestClient(main.app)
+        cls.statements = []
+        cls.commits = []
+        event.listen(models.engine, "before_cursor_execute",
+                     lambda conn, cursor, statement, *args: cls.statements.append(statement))
+        event.listen(models.engine, "commit", lambda conn: cls.commits.append(conn))
+
+        # One UPDATE of programs, NOTIFY if enabled, advisory lock + upsert + cleanup per rollup granularity
+        cls.progress_statements = 1 + (1 if PROGRESS_NOTIFY else 0)
+        cls.rollup_statements = 1 + 2 * len(GRANULARITIES)
+        # Advisory lock, delete and re-insert of the donor's leaderboard totals
+        cls.donor_total_statements = 3
+
+    def counted(self, method, url, **kwargs):
+        self.statements.clear()
+        self.commits.clear()
+        response = getattr(self.client, method)(url, **kwargs)
+        return response, len(self.statements), len(self.commits)
+
+    def test_write_statement_counts(self):
+        """Each donation, pledge and thank-you note write is one transaction with a fixed number of statements"""
+        donor_id = self.client.post("/donors/", json={"donor_type": "individual", "first_name": "Count",
+                                                      "last_name": "Test"}).json()["id"]
+        program_id = self.client.post("/programs/", json={"name": "Count Test",
+                                                          "start_date": str(date.today())}).json()["id"]
+        donation_data = {"donor_id": donor_id, "program_id": program_id, "amount": 100.0,
+                         "donation_date": str(date.today())}
+
+        response, statements, commits = self.counted("post", "/donations/", json=donation_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(statements, 1 + self.progress_statements + self.rollup_statements + self.donor_total_statements)
+        self.assertEqual(commits, 1)
+        donation_id = response.json()["id"]
+
+        response, statements, commits = self.counted("put", f"/donations/{donation_id}",
+                                                      json={**donation_data, "amount": 150.0})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(statements, 1 + self.progress_statements + self.rollup_statements + self.donor_total_statements)
+        self.assertEqual(commits, 1)
+        self.assertEqual(self.client.get(f"/programs/{program_id}").json()["current_progress"], 150.0)
+
+        response, statements, commits = self.counted("post", "/donations/", json={**donation_data, "donor_id": 0})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()["detail"], "Donor not found")
+        self.assertEqual((statements, commits), (1, 0))
+
+        response, statements, commits = self.counted("post", "/pledges/", json={
+            "donor_id": donor_id, "program_id": program_id, "amount": 500.0,
+            "pledge_date": str(date.today()), "amount_fulfilled": 0.0})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((statements, commits), (1, 1))
+        pledge_id = response.json()["id"]
+
+        response, statements, commits = self.counted("post", "/thank-you-notes/", json={
+            "donor_id": donor_id, "donation_id": donation_id, "method": "email"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((statements, commits), (1, 1))
+        thank_you_note_id = response.json()["id"]
+
+        # Deletes add a tombstone for the change feed
+        response, statements, commits = self.counted("delete", f"/thank-you-notes/{thank_you_note_id}")
+        self.assertEqual((response.status_code, statements, commits), (200, 1, 1))
+        response, statements, commits = self.counted("delete", f"/pledges/{pledge_id}")
+        self.assertEqual((response.status_code, statements, commits), (200, 2, 1))
+        response, statements, commits = self.counted("delete", f"/donations/{donation_id}")
+        self.assertEqual(response.status_code, 200)
+        # Lock, delete and tombstone
+        self.assertEqual(statements, 3 + self.progress_statements + self.rollup_statements + self.donor_total_statements)
+        self.assertEqual(commits, 1)
+
+        self.client.delete(f"/programs/{program_id}")
+        self.client.delete(f"/donors/{donor_id}")
+
+    def test_stale_transaction_index(self):
+        """Donation inserts look the transaction index up once, and again after it changes"""
+        import idempotency
+
+        donor_id = self.client.post("/donors/", json={"donor_type": "individual", "first_name": "Index",
+                                                      "last_name": "Test"}).json()["id"]
+        donation_data = {"donor_id": donor_id, "amount": 10.0, "donation_date": str(date.today()),
+                         "payment_method": "card", "transaction_id": f"STALE-{time.time()}"}
+
+        # A cached conflict target that no longer matches any unique index is looked up again
+        idempotency._transaction_index_columns = ["payment_method", "transaction_id", "notes"]
+        response = self.client.post("/donations/", json=donation_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("notes", idempotency.transaction_index_columns(None))
+
+        # Once looked up, further inserts run no catalog query
+        response, statements, commits = self.counted("post", "/donations/", json={
+            **donation_data, "transaction_id": f"STALE-{time.time()}"})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([statement for statement in self.statements if "to_regclass" in statement])
+
+        self.client.delete(f"/donors/{donor_id}")
+
+    def test_read_your_writes(self):
+        """A committed write hands the client its time, and reads that send it back stay on the primary"""
+        from unittest import mock
+        from starlette.requests import Request
+        import models
+
+        def request(headers):
+            return Request({"type": "http", "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()]})
+
+        donor_data = {"donor_type": "individual", "first_name": "Sticky", "last_name": "Test"}
+        with mock.patch.object(models, "READ_YOUR_WRITES_SECONDS", 5.0):
+            response = self.client.post("/donors/", json=donor_data)
+            self.assertEqual(response.status_code, 200)
+            donor_id = response.json()["id"]
+            last_write = response.headers["X-Last-Write"]
+            self.assertEqual(response.cookies[models.LAST_WRITE_COOKIE], last_write)
+
+            self.assertTrue(models.wrote_recently(request({"X-Last-Write": last_write})))
+            self.assertTrue(models.wrote_recently(request({"Cookie": f"{models.LAST_WRITE_COOKIE}={last_write}"})))
+            self.assertFalse(models.wrote_recently(request({"X-Last-Write": str(time.time() - 10)})))
+            self.assertFalse(models.wrote_recently(request({})))
+
+            # A write that fails is not remembered
+            response = self.client.put("/donors/0", json=donor_data)
+            self.assertEqual(response.status_code, 404)
+            self.assertNotIn("X-Last-Write", response.headers)
+
+        self.client.cookies.clear()
+        self.client.delete(f"/donors/{donor_id}")
+
+class TestJobHeartbeat(unittest.TestCase):
+    """
+    Runs a job in-process whose single batch outlasts the heartbeat interval
+    """
+
+    def test_long_batch_keeps_heartbeat(self):
+        """A job busy in one long batch keeps heartbeating and is not requeued as stale"""
+        from unittest import mock
+        from sqlalchemy import func, update
+        import jobs
+        import models
+
+        def slow_batch(ctx, params):
+            time.sleep(1.5)
+            with models.SessionLocal() as db:
+                job = db.get(models.Job, ctx.job_id)
+                return {"beat_after": (job.heartbeat_at - job.started_at).total_seconds()}
+
+        with mock.patch.object(jobs, "JOB_HEARTBEAT_SECONDS", 0.2), \
+                mock.patch.dict(jobs.handlers, {"slow_batch_test": slow_batch}):
+            with models.SessionLocal() as db:
+                job_id = jobs.submit_job(db, "slow_batch_test", {}).id
+            time.sleep(1)
+            # Would requeue the job if its heartbeat were older than a second
+            with models.SessionLocal() as db:
+                requeued = db.execute(update(models.Job).where(
+                    models.Job.id == job_id, models.Job.status == "running",
+                    models.Job.heartbeat_at < func.now() - timedelta(seconds=1)
+                ).values(status="queued")).rowcount
+                db.commit()
+            self.assertEqual(requeued, 0)
+
+            for _ in range(50):
+                with models.SessionLocal() as db:
+                    job = db.get(models.Job, job_id)
+                    if job.status in jobs.FINISHED_STATUSES:
+                        break
+                time.sleep(0.1)
+            self.assertEqual(job.status, "succeeded")
+            self.assertGreater(job.result["beat_after"], 0.5)
+            with models.SessionLocal() as db:
+                db.delete(db.get(models.Job, job_id))
+                db.commit()
+
+class TestPartitionMigration(unittest.TestCase):
+    """
+    Partitions an empty copy of donations in a scratch schema and rolls it back
+    """
+
+    def test_partitioning_keeps_indexes(self):
+        """Every index of donations is created again on the partitioned table, unique ones with donation_date"""
+        from sqlalchemy import text
+        import models
+        import partitions
+
+        def indexes(conn):
+            return dict(conn.execute(text(
+                "SELECT indexname, replace(indexdef, ' ON ONLY ', ' ON ') FROM pg_indexes "
+                "WHERE schemaname = 'partition_test' AND tablename = 'donations' AND indexname NOT LIKE 'donations_pkey%'"
+            )).all())
+
+        with models.engine.connect() as conn:
+            try:
+                conn.execute(text("CREATE SCHEMA partition_test"))
+                conn.execute(text("SET LOCAL search_path TO partition_test, public"))
+                conn.execute(text("CREATE SEQUENCE donations_id_seq"))
+                conn.execute(text("CREATE TABLE donations (LIKE public.donations INCLUDING ALL)"))
+                conn.execute(text("CREATE UNIQUE INDEX ux_partition_test ON donations (payment_method, transaction_id) "
+                                  "NULLS NOT DISTINCT WHERE transaction_id IS NOT NULL"))
+                before = indexes(conn)
+                partitions.partition_table(conn)
+                self.assertTrue(partitions.is_partitioned(conn))
+                after = indexes(conn)
+            finally:
+                conn.rollback()
+
+        self.assertEqual(set(after), set(before))
+        self.assertEqual(after["ux_partition_test"], before["ux_partition_test"].replace(
+            "(payment_method, transaction_id)", "(payment_method, transaction_id, donation_date)"))
+        for name in before.keys() - {"ux_partition_test"}:
+            if "UNIQUE" not in before[name]:
+                self.assertEqual(after[name], before[name])
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,138 @@
+# admission.py
+"""Admission control: per-route-class and per-route concurrency limits.
+
+Every request is assigned to a route class ("dashboard" for /reports/dashboard/,
+"reports" for the rest of /reports/*, "crud" for everything else). Each class, and optionally individual routes, admit a limited
+number of concurrent requests and keep a bounded queue. A request that finds the
+queue full, or waits longer than ADMISSION_QUEUE_TIMEOUT, gets an immediate 503
+with Retry-After instead of tying up a DB connection and a threadpool slot.
+
+Configuration (environment):
+    ADMISSION_CRUD_LIMIT / ADMISSION_CRUD_QUEUE          default 32 / 64
+    ADMISSION_REPORTS_LIMIT / ADMISSION_REPORTS_QUEUE    default REPORT_POOL_SIZE / 8
+    ADMISSION_DASHBOARD_LIMIT / ADMISSION_DASHBOARD_QUEUE  default 1 / 4
+    ADMISSION_ROUTE_LIMITS   e.g. "/reports/donations-by-donor/=1:2,/reports/pending-thank-you-notes/=1:2"
+    ADMISSION_QUEUE_TIMEOUT  seconds a queued request may wait, default 2
+    ADMISSION_RETRY_AFTER    Retry-After value in seconds, default 1
+"""
+import asyncio
+import os
+
+from starlette.responses import JSONResponse
+
+from models import REPORT_POOL_SIZE
+
+QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "2"))
+RETRY_AFTER = os.getenv("ADMISSION_RETRY_AFTER", "1")
+
+# Never limited: health/landing page, metrics, and long-lived streams
+EXEMPT_PATHS = ("/", "/metrics/admission", "/docs", "/openapi.json")
+DASHBOARD_PATH = "/reports/dashboard/"
+
+
+class Limiter:
+    def __init__(self, name: str, limit: int, queue_size: int):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.semaphore = asyncio.Semaphore(limit)
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    async def acquire(self) -> bool:
+        if self.semaphore.locked() and self.queued >= self.queue_size:
+            self.rejected += 1
+            return False
+
+        self.queued += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout=QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return False
+        finally:
+            self.queued -= 1
+
+        self.in_flight += 1
+        self.admitted += 1
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+        self.semaphore.release()
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "queue_size": self.queue_size, "in_flight": self.in_flight,
+                "queued": self.queued, "admitted": self.admitted, "rejected": self.rejected}
+
+
+def parse_route_limits(config: str) -> dict:
+    limiters = {}
+    for entry in filter(None, (item.strip() for item in config.split(","))):
+        path, _, sizes = entry.partition("=")
+        limit, _, queue_size = sizes.partition(":")
+        limiters[path] = Limiter(path, int(limit), int(queue_size or 0))
+    return limiters
+
+
+class AdmissionControlMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self.classes = {
+            "crud": Limiter("crud", int(os.getenv("ADMISSION_CRUD_LIMIT", "32")),
+                            int(os.getenv("ADMISSION_CRUD_QUEUE", "64"))),
+            # One admitted report per report-pool connection, so the rest wait here (or get a 503)
+            # rather than in a threadpool thread for the pool timeout
+            "reports": Limiter("reports", int(os.getenv("ADMISSION_REPORTS_LIMIT", str(REPORT_POOL_SIZE))),
+                               int(os.getenv("ADMISSION_REPORTS_QUEUE", "8"))),
+            # A dashboard holds a dashboard-pool connection per section; the pool fits one dashboard at a time
+            "dashboard": Limiter("dashboard", int(os.getenv("ADMISSION_DASHBOARD_LIMIT", "1")),
+                                 int(os.getenv("ADMISSION_DASHBOARD_QUEUE", "4"))),
+        }
+        self.routes = parse_route_limits(os.getenv("ADMISSION_ROUTE_LIMITS", ""))
+        admission_state["middleware"] = self
+
+    def route_class(self, path: str) -> str:
+        if path == DASHBOARD_PATH:
+            return "dashboard"
+        return "reports" if path.startswith("/reports/") else "crud"
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if scope["type"] != "http" or path in EXEMPT_PATHS or path.endswith("/stream"):
+            await self.app(scope, receive, send)
+            return
+
+        limiters = [limiter for limiter in (self.routes.get(path), self.classes[self.route_class(path)]) if limiter]
+        acquired = []
+        try:
+            for limiter in limiters:
+                if not await limiter.acquire():
+                    response = JSONResponse(
+                        {"detail": f"Too many concurrent {limiter.name} requests, retry later"},
+                        status_code=503, headers={"Retry-After": RETRY_AFTER},
+                    )
+                    await response(scope, receive, send)
+                    return
+                acquired.append(limiter)
+            await self.app(scope, receive, send)
+        finally:
+            for limiter in acquired:
+                limiter.release()
+
+    def stats(self) -> dict:
+        return {
+            "classes": {name: limiter.stats() for name, limiter in self.classes.items()},
+            "routes": {path: limiter.stats() for path, limiter in self.routes.items()},
+        }
+
+
+# The middleware instance is built by Starlette; the metrics endpoint finds it here
+admission_state = {}
+
+
+def admission_stats() -> dict:
+    middleware = admission_state.get("middleware")
+    return middleware.stats() if middleware else {"classes": {}, "routes": {}}
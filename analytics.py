@@ -0,0 +1,305 @@
+# analytics.py
+"""Donor retention reports computed on an in-memory columnar snapshot of donations.
+
+Each worker keeps (id, donor_id, program_id, day, cents) for every donation in
+NumPy arrays (about 26 bytes per donation). The snapshot is loaded once and then
+refreshed at most every ANALYTICS_REFRESH_SECONDS from rows whose updated_at
+moved and from donation tombstones, the same way the change feed reads changes.
+
+Reports work on DonorYears: one entry per (donor, year) with the amount given,
+built with a single sort and cached until the next refresh. Every report is a
+handful of vectorized passes over those arrays rather than a query per donor.
+"""
+import os
+import threading
+import time
+from datetime import date, timedelta
+from typing import Optional
+
+import numpy as np
+from sqlalchemy import select, text
+from sqlalchemy.orm import Session
+
+from changes import commit_horizon
+from models import Donor, SessionLocal, Tombstone
+
+ANALYTICS_REFRESH_SECONDS = float(os.getenv("ANALYTICS_REFRESH_SECONDS", "60"))
+FETCH_SIZE = 100_000
+YEAR_KEY = 10_000  # (donor, year) pairs are encoded as donor * YEAR_KEY + year
+
+REPLAYED_SQL = text("SELECT NOT pg_is_in_recovery() OR pg_last_wal_replay_lsn() >= CAST(:lsn AS pg_lsn)")
+
+COLUMNS_SQL = (
+    "SELECT id, coalesce(donor_id, -1), coalesce(program_id, -1), "
+    "donation_date - date '1970-01-01', round(amount * 100)::bigint FROM donations"
+)
+
+
+class DonationColumns:
+    """Donations as parallel arrays, one element per donation."""
+
+    names = ("id", "donor_id", "program_id", "day", "cents", "year")
+
+    def __init__(self, id, donor_id, program_id, day, cents, year=None):
+        self.id = id.astype(np.int32, copy=False)
+        self.donor_id = donor_id.astype(np.int32, copy=False)      # -1 when missing
+        self.program_id = program_id.astype(np.int32, copy=False)  # -1 when missing
+        self.day = day.astype(np.int32, copy=False)                # days since 1970-01-01
+        self.cents = cents.astype(np.int64, copy=False)
+        if year is None:
+            year = self.day.astype("datetime64[D]").astype("datetime64[Y]").astype(np.int16) + 1970
+        self.year = year.astype(np.int16, copy=False)
+
+    @classmethod
+    def empty(cls):
+        return cls(*(np.empty(0, dtype=np.int64) for _ in range(5)))
+
+    def __len__(self):
+        return len(self.id)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in self.names)
+
+    def without(self, ids: np.ndarray) -> "DonationColumns":
+        keep = ~np.isin(self.id, ids)
+        return DonationColumns(*(getattr(self, name)[keep] for name in self.names))
+
+    def concat(self, other: "DonationColumns") -> "DonationColumns":
+        return DonationColumns(*(np.concatenate([getattr(self, name), getattr(other, name)]) for name in self.names))
+
+
+def fetch_columns(db: Session, where: str = "", params: dict = None) -> DonationColumns:
+    """Stream donations into column arrays, FETCH_SIZE rows at a time."""
+    result = db.connection().execution_options(stream_results=True, max_row_buffer=FETCH_SIZE) \
+        .execute(text(COLUMNS_SQL + where), params or {})
+    chunks = [np.array(rows, dtype=np.int64) for rows in result.partitions(FETCH_SIZE)]
+    if not chunks:
+        return DonationColumns.empty()
+    # Convert per column so only one int64 copy of a column exists at a time
+    return DonationColumns(*(np.concatenate([chunk[:, i] for chunk in chunks]) for i in range(5)))
+
+
+class DonorYears:
+    """One entry per (donor, year) with the cents given, sorted by donor then year."""
+
+    def __init__(self, columns: DonationColumns, program_id: Optional[int] = None):
+        mask = columns.donor_id >= 0
+        if program_id is not None:
+            mask &= columns.program_id == program_id
+        keys, inverse = np.unique(columns.donor_id[mask].astype(np.int64) * YEAR_KEY + columns.year[mask],
+                                  return_inverse=True)
+        self.donor = (keys // YEAR_KEY).astype(np.int32)
+        self.year = (keys % YEAR_KEY).astype(np.int32)
+        self.cents = np.bincount(inverse, weights=columns.cents[mask], minlength=len(keys)).astype(np.int64)
+
+        # The donor's previous giving year and its total (0 for a donor's first year)
+        same_donor = np.r_[False, self.donor[1:] == self.donor[:-1]]
+        self.prev_year = np.where(same_donor, np.r_[0, self.year[:-1]], 0)
+        self.prev_cents = np.where(same_donor, np.r_[0, self.cents[:-1]], 0)
+
+    def __len__(self):
+        return len(self.donor)
+
+
+class DonationSnapshot:
+    def __init__(self):
+        self._state = (DonationColumns.empty(), {})  # columns, DonorYears cache by program_id
+        self.loaded = False
+        self.synced_until = None  # database time up to which changes are loaded
+        self.refreshed_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def columns(self) -> DonationColumns:
+        return self._state[0]
+
+    def refresh(self, db: Session, force: bool = False):
+        """Load the snapshot, or apply the changes since the last refresh if it is older than the interval."""
+        with self._lock:
+            if self.loaded and not force and time.monotonic() - self.refreshed_at < ANALYTICS_REFRESH_SECONDS:
+                return
+
+            # Rows stamped after the oldest open transaction started may not have committed yet; reading
+            # from the previous horizon again next time picks them up (see changes.py). The horizon
+            # comes from the primary, so a replica must have replayed up to it before it is used.
+            with SessionLocal() as primary:
+                horizon = commit_horizon(primary)
+                lsn = primary.scalar(text("SELECT pg_current_wal_lsn()::text"))
+            while not db.scalar(REPLAYED_SQL, {"lsn": lsn}):
+                if self.loaded:
+                    return  # the replica is behind; keep the current snapshot until a later call
+                time.sleep(0.1)
+            columns = self.columns
+            if not self.loaded:
+                columns = fetch_columns(db)
+            else:
+                changed = fetch_columns(db, " WHERE updated_at >= :since", {"since": self.synced_until})
+                deleted = np.fromiter(db.scalars(select(Tombstone.entity_id).where(
+                    Tombstone.entity == "donations", Tombstone.deleted_at >= self.synced_until
+                )), dtype=np.int64)
+                if len(changed) or len(deleted):
+                    columns = columns.without(np.concatenate([changed.id, deleted])).concat(changed)
+
+            if columns is not self.columns:
+                self._state = (columns, {})
+            self.loaded = True
+            self.synced_until = horizon
+            self.refreshed_at = time.monotonic()
+
+    def donor_years(self, program_id: Optional[int] = None) -> DonorYears:
+        columns, cache = self._state
+        if program_id not in cache:
+            cache[program_id] = DonorYears(columns, program_id)
+        return cache[program_id]
+
+
+snapshot = DonationSnapshot()
+
+
+def donor_years(db: Session, program_id: Optional[int] = None) -> DonorYears:
+    snapshot.refresh(db)
+    return snapshot.donor_years(program_id)
+
+
+def dollars(cents) -> float:
+    return round(float(cents) / 100, 2)
+
+
+# Reports
+
+def retention_summary(pairs: DonorYears) -> list:
+    """Per year: donors, new, retained from the year before, reactivated, lapsed and the retention rate."""
+    if not len(pairs):
+        return []
+    first_year = int(pairs.year.min())
+    years = np.arange(first_year, int(pairs.year.max()) + 1)
+    index = pairs.year - first_year
+
+    def per_year(weights=None):
+        return np.bincount(index, weights=weights, minlength=len(years))
+
+    donors = per_year()
+    new = per_year(pairs.prev_year == 0)
+    retained = per_year(pairs.prev_year == pairs.year - 1)
+    reactivated = per_year((pairs.prev_year > 0) & (pairs.prev_year < pairs.year - 1))
+    cents = per_year(pairs.cents)
+
+    result = []
+    for i, year in enumerate(years):
+        previous = int(donors[i - 1]) if i else 0
+        result.append({
+            "year": int(year),
+            "donors": int(donors[i]),
+            "new_donors": int(new[i]),
+            "retained_donors": int(retained[i]),
+            "reactivated_donors": int(reactivated[i]),
+            "lapsed_donors": previous - int(retained[i]),
+            "retention_rate": round(float(retained[i]) / previous, 4) if previous else None,
+            "total_amount": dollars(cents[i]),
+        })
+    return result
+
+
+def lapsed_donors(pairs: DonorYears, year: int):
+    """Donors whose last gift up to ``year`` was before ``year``.
+
+    Returns (donor ids, year of their last gift, total given that year, lifetime total in cents).
+    """
+    upto = pairs.year <= year
+    donor, gift_year, cents = pairs.donor[upto], pairs.year[upto], pairs.cents[upto]
+    starts = np.flatnonzero(np.r_[True, donor[1:] != donor[:-1]]) if len(donor) else np.empty(0, dtype=np.int64)
+    last = np.r_[starts[1:] - 1, len(donor) - 1] if len(starts) else starts
+    lifetime = np.add.reduceat(cents, starts) if len(starts) else cents
+    lapsed = gift_year[last] < year
+    return donor[last][lapsed], gift_year[last][lapsed], cents[last][lapsed], lifetime[lapsed]
+
+
+def last_gift_days(columns: DonationColumns, donor_ids: np.ndarray, year: int,
+                   program_id: Optional[int] = None) -> np.ndarray:
+    """Most recent donation day up to ``year`` for each of a (small) page of donors."""
+    mask = np.isin(columns.donor_id, donor_ids) & (columns.year <= year)
+    if program_id is not None:
+        mask &= columns.program_id == program_id
+    last = np.full(len(donor_ids), np.iinfo(np.int32).min, dtype=np.int32)
+    order = np.argsort(donor_ids)
+    position = order[np.searchsorted(donor_ids, columns.donor_id[mask], sorter=order)]
+    np.maximum.at(last, position, columns.day[mask])
+    return last
+
+
+def donor_list(db: Session, pairs: DonorYears, year: int, kind: str, limit: int, offset: int,
+               program_id: Optional[int] = None) -> dict:
+    """LYBUNT (gave last year but not this year) or SYBUNT (gave in an earlier year, not last year or this year)."""
+    donor, last_year, last_year_cents, lifetime = lapsed_donors(pairs, year)
+    if kind == "lybunt":
+        selected = last_year == year - 1
+        rank = last_year_cents
+    else:
+        selected = last_year < year - 1
+        rank = lifetime
+    donor, last_year, last_year_cents, lifetime = (array[selected] for array in (donor, last_year, last_year_cents, lifetime))
+
+    page = np.argsort(-rank[selected], kind="stable")[offset:offset + limit]
+    page_donors = donor[page]
+    last_days = last_gift_days(snapshot.columns, page_donors, year, program_id)
+    donors = {row.id: row for row in db.query(Donor).filter(Donor.id.in_(page_donors.tolist()))}
+
+    result = []
+    for position, i in enumerate(page):
+        donor_id = int(donor[i])
+        record = donors.get(donor_id)
+        result.append({
+            "donor_id": donor_id,
+            "donor_name": (f"{record.first_name} {record.last_name}" if record.donor_type == "individual"
+                           else record.organization_name) if record else None,
+            "email": record.email if record else None,
+            "last_gift_year": int(last_year[i]),
+            "last_gift_year_amount": dollars(last_year_cents[i]),
+            "lifetime_amount": dollars(lifetime[i]),
+            "last_donation_date": date(1970, 1, 1) + timedelta(days=int(last_days[position])),
+        })
+    return {"year": year, "kind": kind, "count": int(len(donor)), "donors": result}
+
+
+def cohorts(pairs: DonorYears) -> list:
+    """Donors by first-gift year and how many of them gave in each later year."""
+    if not len(pairs):
+        return []
+    first = pairs.prev_year == 0
+    cohort = pairs.year[first][np.cumsum(first) - 1]
+    first_year = int(pairs.year.min())
+    span = int(pairs.year.max()) - first_year + 1
+    matrix = np.bincount((cohort - first_year) * span + (pairs.year - first_year),
+                         minlength=span * span).reshape(span, span)
+
+    result = []
+    for i in range(span):
+        size = int(matrix[i, i])
+        if not size:
+            continue
+        result.append({
+            "cohort_year": first_year + i,
+            "donors": size,
+            "active_donors": {str(first_year + j): int(matrix[i, j]) for j in range(i, span)},
+            "retention": {str(first_year + j): round(int(matrix[i, j]) / size, 4) for j in range(i + 1, span)},
+        })
+    return result
+
+
+def upgrades(pairs: DonorYears, year: int) -> dict:
+    """Donors who gave in both ``year`` - 1 and ``year``, split by whether they gave more, less or the same."""
+    both = (pairs.year == year) & (pairs.prev_year == year - 1)
+    current, previous = pairs.cents[both], pairs.prev_cents[both]
+
+    def group(mask):
+        return {"donors": int(mask.sum()), "previous_amount": dollars(previous[mask].sum()),
+                "current_amount": dollars(current[mask].sum()),
+                "change": dollars((current[mask] - previous[mask]).sum())}
+
+    return {
+        "year": year,
+        "upgraded": group(current > previous),
+        "downgraded": group(current < previous),
+        "unchanged": group(current == previous),
+    }
@@ -0,0 +1,61 @@
+import argparse
+import time
+
+import numpy as np
+
+import analytics
+
+
+def synthetic_columns(donations: int, donors: int, programs: int, first_year: int, last_year: int, seed: int = 7):
+    """Random donations with a skewed number of gifts per donor, like a real donor file."""
+    rng = np.random.default_rng(seed)
+    day_from = (np.datetime64(f"{first_year}-01-01") - np.datetime64("1970-01-01")).astype(int)
+    day_to = (np.datetime64(f"{last_year + 1}-01-01") - np.datetime64("1970-01-01")).astype(int)
+    return analytics.DonationColumns(
+        id=np.arange(1, donations + 1),
+        donor_id=np.minimum(rng.zipf(1.3, donations), donors),
+        program_id=rng.integers(1, programs + 1, donations),
+        day=rng.integers(day_from, day_to, donations),
+        cents=rng.integers(500, 500_000, donations),
+    )
+
+
+def timed(label, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    print(f"{label:<32} {time.perf_counter() - start:8.3f}s")
+    return result
+
+
+def main():
+    """Time the retention reports on a synthetic snapshot (10M donations by default)"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--donations", type=int, default=10_000_000)
+    parser.add_argument("--donors", type=int, default=1_000_000)
+    parser.add_argument("--programs", type=int, default=20)
+    parser.add_argument("--first-year", type=int, default=2015)
+    parser.add_argument("--last-year", type=int, default=2025)
+    args = parser.parse_args()
+
+    columns = timed("generate donations", synthetic_columns, args.donations, args.donors, args.programs,
+                    args.first_year, args.last_year)
+    print(f"snapshot size                    {columns.nbytes / 2 ** 20:8.1f} MiB for {len(columns):,} donations")
+
+    pairs = timed("build donor-years", analytics.DonorYears, columns)
+    program_pairs = timed("build donor-years (1 program)", analytics.DonorYears, columns, 1)
+    timed("retention summary", analytics.retention_summary, pairs)
+    timed("retention summary (1 program)", analytics.retention_summary, program_pairs)
+    timed("cohorts", analytics.cohorts, pairs)
+    timed("upgrades", analytics.upgrades, pairs, args.last_year)
+    donor, last_year, _, _ = timed("lapsed donors (LYBUNT/SYBUNT)", analytics.lapsed_donors, pairs, args.last_year)
+    print(f"  LYBUNT {int((last_year == args.last_year - 1).sum()):,}  SYBUNT {int((last_year < args.last_year - 1).sum()):,}")
+    timed("last gift dates (page of 100)", analytics.last_gift_days, columns, donor[:100], args.last_year)
+    changed = timed("incremental refresh (1k rows)", lambda: columns.without(np.arange(1, 1001)).concat(
+        synthetic_columns(1000, args.donors, args.programs, args.last_year, args.last_year, seed=8)))
+    print(f"after refresh                    {len(changed):,} donations")
+
+
+if __name__ == "__main__":
+    print("Starting retention analytics benchmark...")
+    main()
+    print("Retention analytics benchmark completed.")
@@ -0,0 +1,78 @@
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+IMPORT_SCRIPT = "import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)"
+
+
+def import_times(runs: int) -> list:
+    """Seconds to import main in a fresh interpreter, once per run."""
+    return [float(subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], check=True, capture_output=True,
+                                 text=True).stdout.strip().splitlines()[-1])
+            for _ in range(runs)]
+
+
+def wait_for_port(port: int, process: subprocess.Popen, timeout: float = 60.0):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"server exited with code {process.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.1):
+                return
+        except OSError:
+            time.sleep(0.005)
+    raise SystemExit(f"server did not listen on port {port} within {timeout}s")
+
+
+def get(url: str) -> float:
+    start = time.perf_counter()
+    with urllib.request.urlopen(url) as response:
+        response.read()
+    return time.perf_counter() - start
+
+
+def cold_start(port: int, path: str) -> dict:
+    """Start a server process and time it until the first response, then time the first and a warm request."""
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"])
+    try:
+        wait_for_port(port, process)
+        listening = time.perf_counter() - start
+        first = get(f"http://127.0.0.1:{port}{path}")
+        ready = time.perf_counter() - start
+        warm = min(get(f"http://127.0.0.1:{port}{path}") for _ in range(5))
+    finally:
+        process.terminate()
+        process.wait()
+    return {"listening": listening, "first_request": first, "first_response": ready, "warm_request": warm}
+
+
+def main():
+    """Time importing the app and a cold start up to the first response"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--path", default="/donors/?limit=1")
+    args = parser.parse_args()
+    if not os.getenv("DATABASE_URL"):
+        sys.exit("DATABASE_URL must point at a migrated database (python migrate.py)")
+
+    times = import_times(args.runs)
+    print(f"import main                      {statistics.median(times):8.3f}s median, {min(times):.3f}s best of {args.runs}")
+
+    starts = [cold_start(args.port, args.path) for _ in range(args.runs)]
+    for name, label in (("listening", "process start to listening"), ("first_response", "process start to first response"),
+                        ("first_request", "first request"), ("warm_request", "warm request")):
+        values = [start[name] for start in starts]
+        print(f"{label:<32} {statistics.median(values):8.3f}s median, {min(values):.3f}s best of {args.runs}")
+
+
+if __name__ == "__main__":
+    print("Starting cold start benchmark...")
+    main()
@@ -0,0 +1,81 @@
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+ENDPOINT = "/donors/?limit=20"
+
+
+def wait_until_ready(base_url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"{base_url}/").status_code == 200:
+                return
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Server at {base_url} did not start within {timeout}s")
+
+
+def drive_load(base_url, seconds, clients):
+    """Hit ENDPOINT from `clients` threads for `seconds` and return (ok, errors)."""
+    counts = {"ok": 0, "errors": 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def client():
+        session = requests.Session()
+        ok = errors = 0
+        while time.monotonic() < deadline:
+            try:
+                if session.get(f"{base_url}{ENDPOINT}").status_code == 200:
+                    ok += 1
+                else:
+                    errors += 1
+            except requests.RequestException:
+                errors += 1
+        with lock:
+            counts["ok"] += ok
+            counts["errors"] += errors
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts["ok"], counts["errors"]
+
+
+def main():
+    """Compare GET /donors/ throughput with 1, 2 and 4 worker processes"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--seconds", type=int, default=15)
+    args = parser.parse_args()
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    for workers in [int(value) for value in args.workers.split(",")]:
+        env = dict(os.environ, APP_ENV="production", WEB_CONCURRENCY=str(workers),
+                   HOST="127.0.0.1", PORT=str(args.port))
+        process = subprocess.Popen([sys.executable, "main.py"], env=env)
+        try:
+            wait_until_ready(base_url)
+            drive_load(base_url, 2, args.clients)  # warm up every worker
+            ok, errors = drive_load(base_url, args.seconds, args.clients)
+            print(f"workers={workers:<3} requests/s={ok / args.seconds:8.1f} errors={errors}")
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    print("Starting worker throughput benchmark...")
+    main()
+    print("Worker throughput benchmark completed.")
@@ -0,0 +1,150 @@
+# campaigns.py
+"""Bulk thank-you note campaigns.
+
+A campaign selects donations that have no thank-you note yet, renders the chosen
+template for each donor in a process pool, appends the rendered notes to one
+export file per contact method and writes the ThankYouNote rows in one batch per
+chunk. Each batch commits together with its checkpoint (the export file offsets),
+and export files are truncated back to that checkpoint on resume, so a resumed
+campaign duplicates neither notes nor output.
+"""
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+from sqlalchemy import func, insert, select
+
+from jobs import EXPORT_DIR, JobContext, job_handler
+from models import SessionLocal, Donor, Program, Donation, ThankYouNote
+
+BATCH_SIZE = 5000
+RENDER_CHUNK_SIZE = 500
+CAMPAIGN_PROCESSES = int(os.getenv("CAMPAIGN_PROCESSES", os.cpu_count() or 1))
+
+TEMPLATES = {
+    "standard": (
+        "Dear {donor_name},\n\n"
+        "Thank you for your gift of ${amount:,.2f} on {donation_date}{program_clause}. "
+        "Your support makes our work possible.\n\n"
+        "With gratitude,\nULEM\n"
+    ),
+    "major_gift": (
+        "Dear {donor_name},\n\n"
+        "Your generous gift of ${amount:,.2f} on {donation_date}{program_clause} is a remarkable "
+        "investment in our community. Our president will be in touch to thank you personally.\n\n"
+        "With deep gratitude,\nULEM\n"
+    ),
+    "organization": (
+        "To the team at {donor_name},\n\n"
+        "On behalf of ULEM, thank you for your organization's contribution of ${amount:,.2f} "
+        "on {donation_date}{program_clause}.\n\n"
+        "Sincerely,\nULEM\n"
+    ),
+}
+
+
+def render_notes(template_used: str, rows: list) -> list:
+    """Render one note per donation row. Runs in a worker process."""
+    template = TEMPLATES[template_used]
+    return [
+        template.format(
+            donor_name=(f"{row['first_name']} {row['last_name']}" if row["donor_type"] == "individual"
+                        else row["organization_name"]),
+            amount=row["amount"],
+            donation_date=row["donation_date"],
+            program_clause=f" to {row['program_name']}" if row["program_name"] else "",
+        )
+        for row in rows
+    ]
+
+
+def pending_donations(params: dict):
+    """Select donations without a thank-you note that match the campaign filters."""
+    query = (
+        select(Donation.id.label("donation_id"), Donation.donor_id, Donation.amount, Donation.donation_date,
+               Donor.donor_type, Donor.first_name, Donor.last_name, Donor.organization_name,
+               Donor.preferred_contact_method, Program.name.label("program_name"))
+        .join(Donor, Donor.id == Donation.donor_id)
+        .outerjoin(Program, Program.id == Donation.program_id)
+        .where(~select(ThankYouNote.id).where(ThankYouNote.donation_id == Donation.id).exists())
+    )
+
+    if params.get("start_date"):
+        query = query.where(Donation.donation_date >= date.fromisoformat(params["start_date"]))
+    if params.get("end_date"):
+        query = query.where(Donation.donation_date <= date.fromisoformat(params["end_date"]))
+    if params.get("min_amount") is not None:
+        query = query.where(Donation.amount >= params["min_amount"])
+    if params.get("program_id"):
+        query = query.where(Donation.program_id == params["program_id"])
+    if params.get("preferred_contact_method"):
+        query = query.where(Donor.preferred_contact_method == params["preferred_contact_method"])
+
+    return query
+
+
+@job_handler("thank_you_campaign")
+def run_thank_you_campaign(ctx: JobContext, params: dict):
+    template_used = params["template_used"]
+    if template_used not in TEMPLATES:
+        raise ValueError(f"template_used must be one of: {', '.join(TEMPLATES)}")
+    sent_date = date.fromisoformat(params["sent_date"]) if params.get("sent_date") else None
+
+    output_dir = os.path.join(EXPORT_DIR, f"campaign_{ctx.job_id}")
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint = ctx.checkpoint or {"last_donation_id": 0, "created": 0, "offsets": {}}
+    for name in os.listdir(output_dir):
+        os.truncate(os.path.join(output_dir, name), checkpoint["offsets"].get(name[:-len(".txt")], 0))
+
+    query = pending_donations(params)
+    with SessionLocal() as db:
+        if "total" not in checkpoint:
+            checkpoint["total"] = db.scalar(select(func.count()).select_from(query.subquery()))
+        total = checkpoint["total"] or 1
+
+        # spawn, not fork: the parent is a threaded server process
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=CAMPAIGN_PROCESSES, mp_context=context) as pool:
+            while True:
+                # KEY SHARE locks hold off a concurrent delete_donation until this batch's notes are committed
+                rows = db.execute(
+                    query.where(Donation.id > checkpoint["last_donation_id"]).order_by(Donation.id).limit(BATCH_SIZE)
+                    .with_for_update(read=True, key_share=True, of=Donation)
+                ).mappings().all()
+                if not rows:
+                    break
+
+                chunks = [rows[start:start + RENDER_CHUNK_SIZE] for start in range(0, len(rows), RENDER_CHUNK_SIZE)]
+                rendered = [note for notes in pool.map(render_notes, [template_used] * len(chunks),
+                                                       [[dict(row) for row in chunk] for chunk in chunks])
+                            for note in notes]
+
+                # Write the export first; if the batch is not committed the files are truncated back on resume
+                by_method = {}
+                for row, note in zip(rows, rendered):
+                    method = re.sub(r"[^A-Za-z0-9_-]", "_", row["preferred_contact_method"] or "unspecified")
+                    by_method.setdefault(method, []).append((row, note))
+                for method, notes in by_method.items():
+                    with open(os.path.join(output_dir, f"{method}.txt"), "a") as output:
+                        for row, note in notes:
+                            output.write(f"--- donation {row['donation_id']} / donor {row['donor_id']} ---\n{note}\n")
+                        checkpoint["offsets"][method] = output.tell()
+
+                db.execute(insert(ThankYouNote), [
+                    {"donor_id": row["donor_id"], "donation_id": row["donation_id"],
+                     "sent_date": sent_date,
+                     "method": params.get("method") or row["preferred_contact_method"],
+                     "template_used": template_used, "notes": params.get("notes")}
+                    for row in rows
+                ])
+                checkpoint["last_donation_id"] = rows[-1]["donation_id"]
+                checkpoint["created"] += len(rows)
+                ctx.stage_checkpoint(db, checkpoint)
+                db.commit()
+
+                ctx.report(100.0 * checkpoint["created"] / total)
+
+    return {"created": checkpoint["created"], "output_dir": output_dir,
+            "files": sorted(checkpoint["offsets"])}
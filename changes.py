@@ -0,0 +1,116 @@
+# changes.py
+"""Change feed for incremental sync clients.
+
+Rows are read in (updated_at, id) order from an index, and deletes come from
+the tombstones table written by the delete endpoints, so each page costs the
+same regardless of table size. The cursor records the last (timestamp, id)
+position in both streams and is handed to clients as an opaque string.
+
+updated_at (and deleted_at) is set from the database clock at transaction
+start, and a transaction can commit long after a later one (batch jobs, merges).
+So a page only goes up to the start of the oldest transaction still open in
+the database: every row stamped before that is committed. Rows of a long
+transaction are returned once it commits, however long it took; while it
+runs, newer rows wait behind it. Seeing other sessions' xact_start in
+pg_stat_activity needs the same database role or pg_read_all_stats.
+"""
+import base64
+import json
+from datetime import datetime, timezone
+
+from sqlalchemy import func, select, text, tuple_
+from sqlalchemy.orm import Session
+
+from models import (Donor, Donation, Pledge, Tombstone,
+                    DonorResponse, DonationResponse, PledgeResponse)
+
+MAX_PAGE_SIZE = 5000
+
+# Start of the oldest open transaction (other than this one) that could still write, or now()
+HORIZON_SQL = text("""
+    SELECT least(now(), min(xact_start))
+    FROM pg_stat_activity
+    WHERE datname = current_database() AND backend_type = 'client backend'
+      AND xact_start IS NOT NULL AND pid <> pg_backend_pid()
+""")
+
+FEEDS = {
+    "donors": (Donor, DonorResponse),
+    "donations": (Donation, DonationResponse),
+    "pledges": (Pledge, PledgeResponse),
+}
+
+
+def commit_horizon(db: Session) -> datetime:
+    """Timestamp before which every row written on this (primary) database has committed."""
+    return db.scalar(HORIZON_SQL)
+
+
+def record_deletion(db: Session, entity: str, entity_id: int):
+    """Add a tombstone for a deleted row; commits with the caller's transaction."""
+    db.add(Tombstone(entity=entity, entity_id=entity_id, deleted_at=func.now()))
+
+
+def encode_cursor(position: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def aware(timestamp: datetime) -> datetime:
+    # Cursors from before empty positions were encoded as null hold a naive datetime.min
+    return timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=timezone.utc)
+
+
+def decode_cursor(cursor: str) -> dict:
+    """Decode a cursor; raises ValueError if it is malformed."""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return {stream: (aware(datetime.fromisoformat(position[stream][0])), int(position[stream][1]))
+                if position[stream] else None
+                for stream in ("rows", "deleted")}
+    except Exception as exc:
+        raise ValueError("Invalid cursor") from exc
+
+
+def read_changes(db: Session, entity: str, cursor: str = None, limit: int = 500) -> dict:
+    model, response_model = FEEDS[entity]
+    position = decode_cursor(cursor) if cursor else {"rows": None, "deleted": None}
+    horizon = commit_horizon(db)
+
+    query = select(model).where(model.updated_at < horizon)
+    if position["rows"]:
+        query = query.where(tuple_(model.updated_at, model.id) > tuple_(*position["rows"]))
+    rows = db.scalars(query.order_by(model.updated_at, model.id).limit(limit + 1)).all()
+
+    tombstones = select(Tombstone).where(Tombstone.entity == entity, Tombstone.deleted_at < horizon)
+    if position["deleted"]:
+        tombstones = tombstones.where(tuple_(Tombstone.deleted_at, Tombstone.id) > tuple_(*position["deleted"]))
+    deleted = db.scalars(tombstones.order_by(Tombstone.deleted_at, Tombstone.id).limit(limit + 1)).all()
+
+    has_more = len(rows) > limit or len(deleted) > limit
+    rows, deleted = rows[:limit], deleted[:limit]
+
+    since = position["rows"][0] if position["rows"] else None
+    next_position = {
+        "rows": (rows[-1].updated_at, rows[-1].id) if rows else position["rows"],
+        "deleted": (deleted[-1].deleted_at, deleted[-1].id) if deleted else position["deleted"],
+    }
+    next_cursor = encode_cursor({
+        stream: [value[0].isoformat(), value[1]] if value else None
+        for stream, value in next_position.items()
+    })
+
+    return {
+        "entity": entity,
+        "changes": [
+            {
+                "op": "created" if since is None or row.created_at > since else "updated",
+                "id": row.id,
+                "updated_at": row.updated_at,
+                "data": response_model.model_validate(row),
+            }
+            for row in rows
+        ],
+        "deleted": [{"id": tombstone.entity_id, "deleted_at": tombstone.deleted_at} for tombstone in deleted],
+        "next_cursor": next_cursor,
+        "has_more": has_more,
+    }
@@ -0,0 +1,206 @@
+# dashboard.py
+"""The /reports/dashboard/ payload: several summary sections built concurrently.
+
+Each section runs on its own session from the dashboard pool (DASHBOARD_POOL_SIZE,
+one connection per section) in a thread pool of the same size, so sections never
+wait for a connection and never take one from the report pool. Some sections
+scan tables that grow with the data (pending thank-you notes is an anti-join
+over all donations), so admission control gives the dashboard its own route
+class, by default one request at a time. The dashboard takes about as long as
+its slowest section.
+A section returns summary figures plus at most ``limit`` rows, and the payload
+records how long each section took.
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from models import (DASHBOARD_POOL_SIZE, DashboardSessionLocal, DonationMonthlyRollup, Donation, Donor, Pledge,
+                    Program, ThankYouNote)
+
+RECENT_DAYS = int(os.getenv("DASHBOARD_RECENT_DAYS", "30"))
+
+
+def donor_name(row) -> str:
+    """Name from a row that selected donor_columns()."""
+    return f"{row.first_name} {row.last_name}" if row.donor_type == "individual" else row.organization_name
+
+
+def donor_columns():
+    return Donor.donor_type, Donor.first_name, Donor.last_name, Donor.organization_name
+
+
+def programs(db: Session, limit: int) -> dict:
+    """Programs that raised the most, from the monthly rollups rather than the donations table."""
+    raised = func.coalesce(func.sum(DonationMonthlyRollup.total_amount), 0)
+    gifts = func.coalesce(func.sum(DonationMonthlyRollup.gift_count), 0)
+    rows = db.execute(
+        select(Program.id, Program.name, Program.goal_amount, raised, gifts)
+        .outerjoin(DonationMonthlyRollup, DonationMonthlyRollup.program_id == Program.id)
+        .group_by(Program.id)
+        .order_by(raised.desc(), Program.id)
+        .limit(limit)
+    ).all()
+    count, total_amount = db.execute(select(
+        select(func.count()).select_from(Program).scalar_subquery(),
+        select(func.coalesce(func.sum(DonationMonthlyRollup.total_amount), 0)).scalar_subquery()
+    )).one()
+    return {
+        "count": count,
+        "total_amount": float(total_amount),
+        "rows": [
+            {
+                "program_id": program_id,
+                "program_name": name,
+                "total_amount": float(amount),
+                "total_donations": gifts,
+                "goal_amount": float(goal_amount) if goal_amount else None,
+                "progress_percentage": float(amount) / float(goal_amount) * 100 if goal_amount else None
+            }
+            for program_id, name, goal_amount, amount, gifts in rows
+        ]
+    }
+
+
+def unfulfilled_pledges(db: Session, limit: int) -> dict:
+    """Open pledges, oldest first."""
+    open_pledge = (Pledge.amount_fulfilled < Pledge.amount) | (Pledge.status != "fulfilled")
+    count, remaining = db.execute(
+        select(func.count(), func.coalesce(func.sum(Pledge.amount - Pledge.amount_fulfilled), 0)).where(open_pledge)
+    ).one()
+    rows = db.execute(
+        select(Pledge.id, Pledge.donor_id, Pledge.program_id, Pledge.amount, Pledge.amount_fulfilled,
+               Pledge.pledge_date, Pledge.status, *donor_columns())
+        .outerjoin(Donor, Donor.id == Pledge.donor_id)
+        .where(open_pledge).order_by(Pledge.pledge_date, Pledge.id).limit(limit)
+    ).all()
+    return {
+        "count": count,
+        "remaining_amount": float(remaining),
+        "rows": [
+            {
+                "pledge_id": row.id,
+                "donor_id": row.donor_id,
+                "donor_name": donor_name(row),
+                "program_id": row.program_id,
+                "pledge_amount": float(row.amount),
+                "remaining_amount": float(row.amount - row.amount_fulfilled),
+                "pledge_date": row.pledge_date,
+                "status": row.status
+            }
+            for row in rows
+        ]
+    }
+
+
+def pending_thank_you_notes(db: Session, limit: int) -> dict:
+    """Donations without a thank-you note, most recent first."""
+    pending = ~select(ThankYouNote.id).where(ThankYouNote.donation_id == Donation.id).exists()
+    count = db.scalar(select(func.count()).select_from(Donation).where(pending))
+    rows = db.execute(
+        select(Donation.id, Donation.donor_id, Donation.amount, Donation.donation_date, *donor_columns(),
+               Donor.preferred_contact_method)
+        .outerjoin(Donor, Donor.id == Donation.donor_id)
+        .where(pending).order_by(Donation.donation_date.desc(), Donation.id.desc()).limit(limit)
+    ).all()
+    return {
+        "count": count,
+        "rows": [
+            {
+                "donation_id": row.id,
+                "donor_id": row.donor_id,
+                "donor_name": donor_name(row),
+                "donation_amount": float(row.amount),
+                "donation_date": row.donation_date,
+                "preferred_contact_method": row.preferred_contact_method
+            }
+            for row in rows
+        ]
+    }
+
+
+def recent_donations(db: Session, limit: int) -> dict:
+    """Donations of the last RECENT_DAYS days, newest first."""
+    since = date.today() - timedelta(days=RECENT_DAYS)
+    count, total_amount = db.execute(
+        select(func.count(), func.coalesce(func.sum(Donation.amount), 0)).where(Donation.donation_date >= since)
+    ).one()
+    rows = db.execute(
+        select(Donation.id, Donation.donor_id, Donation.program_id, Donation.amount, Donation.donation_date,
+               *donor_columns())
+        .outerjoin(Donor, Donor.id == Donation.donor_id)
+        .where(Donation.donation_date >= since)
+        .order_by(Donation.donation_date.desc(), Donation.id.desc()).limit(limit)
+    ).all()
+    return {
+        "days": RECENT_DAYS,
+        "count": count,
+        "total_amount": float(total_amount),
+        "rows": [
+            {
+                "donation_id": row.id,
+                "donor_id": row.donor_id,
+                "donor_name": donor_name(row),
+                "program_id": row.program_id,
+                "amount": float(row.amount),
+                "donation_date": row.donation_date
+            }
+            for row in rows
+        ]
+    }
+
+
+def recent_donors(db: Session, limit: int) -> dict:
+    """Newest donors."""
+    rows = db.execute(
+        select(Donor.id, *donor_columns(), Donor.email, Donor.created_at)
+        .order_by(Donor.id.desc()).limit(limit)
+    ).all()
+    return {
+        "count": db.scalar(select(func.count()).select_from(Donor)),
+        "rows": [
+            {
+                "donor_id": row.id,
+                "donor_name": donor_name(row),
+                "email": row.email,
+                "created_at": row.created_at
+            }
+            for row in rows
+        ]
+    }
+
+
+SECTIONS = {
+    "programs": programs,
+    "unfulfilled_pledges": unfulfilled_pledges,
+    "pending_thank_you_notes": pending_thank_you_notes,
+    "recent_donations": recent_donations,
+    "recent_donors": recent_donors,
+}
+
+# One thread per dashboard-pool connection, so a running section always has its connection
+executor = ThreadPoolExecutor(max_workers=DASHBOARD_POOL_SIZE, thread_name_prefix="dashboard")
+
+
+def run_section(name: str, limit: int) -> dict:
+    started = time.perf_counter()
+    with DashboardSessionLocal() as db:
+        section = SECTIONS[name](db, limit)
+    section["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return section
+
+
+def build_dashboard(names: list, limit: int) -> dict:
+    """Run the named sections concurrently and combine them into one payload."""
+    started = time.perf_counter()
+    futures = {name: executor.submit(run_section, name, limit) for name in names}
+    sections = {name: future.result() for name, future in futures.items()}
+    return {
+        "limit": limit,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        "sections": sections,
+    }
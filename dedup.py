@@ -0,0 +1,321 @@
+# dedup.py
+"""Duplicate donor detection and merging.
+
+A scan gives every donor a few blocking keys and only compares donors that
+share a key, instead of all n² pairs:
+
+- ``email``: the normalized email address
+- ``postal``: normalized postal code + Soundex of the surname (or organization name)
+- ``domain``: email domain + Soundex of the surname
+- ``phone``: the last 10 digits of the phone number
+
+Blocks of up to MAX_BLOCK_SIZE donors are compared pair by pair. Larger blocks
+(a common surname at gmail.com) are sorted by name, and each donor is compared
+with its next BLOCK_WINDOW neighbours. Pairs are scored with difflib on the
+normalized name, email, phone and address. Pairs scoring at least
+DEDUP_MIN_SCORE are written to donor_merge_suggestions, lower id first.
+
+Keys are spilled to DEDUP_BUCKETS temporary files by key hash and grouped one
+bucket at a time, so only that fraction of the keys is in memory at once.
+
+Usage:
+    python dedup.py scan
+"""
+import csv
+import os
+import re
+import sys
+import tempfile
+import unicodedata
+import zlib
+from collections import Counter, defaultdict
+from difflib import SequenceMatcher
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from sqlalchemy import delete, func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session, aliased
+
+import changes
+from jobs import JobContext, job_handler
+from leaderboards import refresh_donor_totals
+from models import AnnualStatement, Donation, Donor, DonorMergeSuggestion, Pledge, PledgeAllocation, ThankYouNote
+from rollups import refresh_rollups
+
+DEDUP_MIN_SCORE = float(os.getenv("DEDUP_MIN_SCORE", "0.8"))
+DEDUP_BUCKETS = int(os.getenv("DEDUP_BUCKETS", "32"))
+MAX_BLOCK_SIZE = 50
+BLOCK_WINDOW = 10
+FETCH_SIZE = 10_000
+INSERT_BATCH_SIZE = 1000
+
+# Field weights in the score; a field only counts when both donors have it
+WEIGHTS = {"name": 0.5, "email": 0.2, "phone": 0.15, "address": 0.15}
+ORGANIZATION_SUFFIXES = {"inc", "incorporated", "llc", "ltd", "limited", "corp", "corporation", "co", "company", "the"}
+SOUNDEX_CODES = {letter: str(code) for code, letters in enumerate(
+    ("aeiouyhw", "bfpv", "cgjkqsxz", "dt", "l", "mn", "r")) for letter in letters}
+
+
+def normalize(value) -> str:
+    """Lowercase ASCII words separated by single spaces."""
+    if not value:
+        return ""
+    value = unicodedata.normalize("NFKD", value).encode("ascii", "ignore").decode().lower()
+    return " ".join(re.findall(r"[a-z0-9]+", value))
+
+
+def soundex(word: str) -> str:
+    letters = [letter for letter in word if letter in SOUNDEX_CODES]
+    if not letters:
+        return ""
+    code, previous = letters[0].upper(), SOUNDEX_CODES[letters[0]]
+    for letter in letters[1:]:
+        digit = SOUNDEX_CODES[letter]
+        if digit != "0" and digit != previous:
+            code += digit
+        if letter not in "hw":  # h and w don't separate letters with the same code
+            previous = digit
+    return (code + "000")[:4]
+
+
+def donor_record(row) -> tuple:
+    """(id, donor_type, name, surname key, email, phone, address, postal code), all normalized."""
+    if row.donor_type == "individual":
+        name = normalize(f"{row.first_name or ''} {row.last_name or ''}")
+        surname = soundex(normalize(row.last_name).replace(" ", ""))
+    else:
+        name = " ".join(word for word in normalize(row.organization_name).split() if word not in ORGANIZATION_SUFFIXES)
+        surname = soundex(name.split()[0]) if name else ""
+    email = (row.email or "").strip().lower()
+    phone = re.sub(r"\D", "", row.phone or "")[-10:]
+    postal = re.sub(r"[^0-9A-Z]", "", (row.postal_code or "").upper())
+    if postal.isdigit():
+        postal = postal[:5]  # ZIP+4
+    address = normalize(row.address_line1)
+    return row.id, row.donor_type, name, surname, email, phone, address, postal
+
+
+def blocking_keys(record: tuple) -> list:
+    _, donor_type, _, surname, email, phone, _, postal = record
+    keys = []
+    if email:
+        keys.append(f"email:{email}")
+        if surname and "@" in email:
+            keys.append(f"domain:{email.rsplit('@', 1)[1]}:{surname}")
+    if postal and surname:
+        keys.append(f"postal:{postal}:{surname}")
+    if len(phone) >= 7:
+        keys.append(f"phone:{phone}")
+    # Keep individuals and organizations in separate blocks
+    return [f"{donor_type}:{key}" for key in keys]
+
+
+@lru_cache(maxsize=100_000)
+def letter_counts(value: str) -> dict:
+    return Counter(value)
+
+
+def quick_ratio(a: str, b: str) -> float:
+    """Upper bound of SequenceMatcher(None, a, b).ratio() from letter counts (as SequenceMatcher.quick_ratio)."""
+    counts_b = letter_counts(b)
+    common = sum(min(count, counts_b.get(letter, 0)) for letter, count in letter_counts(a).items())
+    return 2.0 * common / (len(a) + len(b))
+
+
+def similarity(a: str, b: str) -> float:
+    return 1.0 if a == b else SequenceMatcher(None, a, b).ratio()
+
+
+def score(a: tuple, b: tuple, min_score: float = DEDUP_MIN_SCORE) -> float:
+    """Weighted similarity of two donor records (0-1), or 0 when it can't reach ``min_score``."""
+    if not a[2] or not b[2]:
+        return 0.0
+    scores = {}
+    if a[4] and b[4]:
+        scores["email"] = 1.0 if a[4] == b[4] else 0.0
+    if a[5] and b[5]:
+        scores["phone"] = 1.0 if a[5] == b[5] else 0.0
+    total = WEIGHTS["name"] + sum(WEIGHTS[field] for field in scores) + \
+        (WEIGHTS["address"] if a[6] and b[6] else 0.0)
+
+    # Bound the score with the cheap estimates before running the full comparisons
+    def best_case(name_upper):
+        rest = sum(WEIGHTS[field] * value for field, value in scores.items())
+        return (WEIGHTS["name"] * name_upper + rest + (WEIGHTS["address"] if a[6] and b[6] else 0.0)) / total
+
+    if best_case(quick_ratio(a[2], b[2])) < min_score:
+        return 0.0
+    scores["name"] = similarity(a[2], b[2])
+    if a[6] and b[6]:
+        scores["address"] = similarity(f"{a[6]} {a[7]}", f"{b[6]} {b[7]}")
+    return sum(WEIGHTS[field] * value for field, value in scores.items()) / total
+
+
+def candidate_pairs(block: list):
+    if len(block) <= MAX_BLOCK_SIZE:
+        for i, a in enumerate(block):
+            for b in block[i + 1:]:
+                yield a, b
+    else:
+        # Sorted neighbourhood: each donor against the next BLOCK_WINDOW by name
+        block = sorted(block, key=lambda record: record[2])
+        for i, a in enumerate(block):
+            for b in block[i + 1:i + 1 + BLOCK_WINDOW]:
+                yield a, b
+
+
+def find_duplicates(rows, total: int, ctx: JobContext = None, min_score: float = DEDUP_MIN_SCORE) -> dict:
+    """Block and score donor rows; returns {(donor_id, duplicate_id): (score, matched keys)} plus counts.
+
+    ``rows`` have the Donor columns read by ``scan``; ``total`` is only used for progress.
+    """
+    counts = defaultdict(int)
+    pairs = {}
+
+    with tempfile.TemporaryDirectory(prefix="dedup_") as spill:
+        files = [open(os.path.join(spill, f"{i}.csv"), "w", newline="") for i in range(DEDUP_BUCKETS)]
+        writers = [csv.writer(file) for file in files]
+        for row in rows:
+            record = donor_record(row)
+            for key in blocking_keys(record):
+                writers[zlib.crc32(key.encode()) % DEDUP_BUCKETS].writerow((key, *record))
+            counts["donors"] += 1
+            if ctx and counts["donors"] % 100_000 == 0:
+                ctx.report(50.0 * counts["donors"] / (total or 1))
+        for file in files:
+            file.close()
+
+        for i in range(DEDUP_BUCKETS):
+            with open(os.path.join(spill, f"{i}.csv"), newline="") as file:
+                keyed = [(key, (int(donor_id), *fields)) for key, donor_id, *fields in csv.reader(file)]
+            keyed.sort(key=itemgetter(0))
+            for key, group in groupby(keyed, key=itemgetter(0)):
+                block = [record for _, record in group]
+                if len(block) < 2:
+                    continue
+                counts["blocks"] += 1
+                counts["large_blocks"] += len(block) > MAX_BLOCK_SIZE
+                for a, b in candidate_pairs(block):
+                    if a[0] == b[0]:
+                        continue
+                    pair = (a[0], b[0]) if a[0] < b[0] else (b[0], a[0])
+                    counts["compared_pairs"] += 1
+                    if pair in pairs:
+                        pairs[pair][1].add(key.split(":")[1])
+                        continue
+                    value = score(a, b, min_score)
+                    if value >= min_score:
+                        pairs[pair] = (round(value, 3), {key.split(":")[1]})
+            if ctx:
+                ctx.report(50.0 + 50.0 * (i + 1) / DEDUP_BUCKETS)
+
+    counts["suggestions"] = len(pairs)
+    return {"pairs": pairs, "counts": dict(counts)}
+
+
+def save_suggestions(db: Session, pairs: dict):
+    """Replace the open suggestions; dismissed pairs stay dismissed."""
+    db.execute(delete(DonorMergeSuggestion).where(DonorMergeSuggestion.status == "open"))
+    rows = [{"donor_id": donor_id, "duplicate_id": duplicate_id, "score": value, "reasons": ",".join(sorted(keys))}
+            for (donor_id, duplicate_id), (value, keys) in pairs.items()]
+    table = DonorMergeSuggestion.__table__
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        db.execute(pg_insert(table).on_conflict_do_nothing(index_elements=[table.c.donor_id, table.c.duplicate_id]),
+                   rows[start:start + INSERT_BATCH_SIZE])
+    db.commit()
+
+
+def scan(db: Session, ctx: JobContext = None) -> dict:
+    rows = db.execute(
+        select(Donor.id, Donor.donor_type, Donor.first_name, Donor.last_name, Donor.organization_name,
+               Donor.email, Donor.phone, Donor.address_line1, Donor.postal_code)
+        .execution_options(yield_per=FETCH_SIZE)
+    )
+    result = find_duplicates(rows, db.scalar(select(func.count()).select_from(Donor)), ctx)
+    save_suggestions(db, result["pairs"])
+    return result["counts"]
+
+
+# Filled in on the surviving donor when it has no value and the duplicate has one
+MERGE_FILL_COLUMNS = ("first_name", "last_name", "organization_name", "email", "phone", "address_line1",
+                      "address_line2", "city", "state", "postal_code", "country", "preferred_contact_method")
+
+
+def merge_donors(db: Session, donor_id: int, duplicate_id: int) -> Donor:
+    """Move everything of ``duplicate_id`` to ``donor_id`` and delete it, in the caller's transaction.
+
+    Donations, pledges, thank-you notes, pledge allocations and annual statements are repointed.
+    Tax receipts reference donations, so they follow their donations. Empty
+    contact fields of the surviving donor are filled from the duplicate. Raises
+    ValueError when merging a donor into itself and LookupError when either
+    donor doesn't exist.
+    """
+    if donor_id == duplicate_id:
+        raise ValueError("A donor can't be merged into itself")
+    # Lock both rows in id order so concurrent merges of the same pair can't deadlock
+    donors = {donor.id: donor for donor in db.scalars(
+        select(Donor).where(Donor.id.in_((donor_id, duplicate_id))).order_by(Donor.id).with_for_update()
+    )}
+    if len(donors) < 2:
+        raise LookupError("Donor not found")
+    donor, duplicate = donors[donor_id], donors[duplicate_id]
+
+    donations = Donation.__table__
+    touched = db.execute(
+        update(donations).where(donations.c.donor_id == duplicate_id)
+        .values(donor_id=donor_id, updated_at=func.now())
+        .returning(donations.c.program_id, donations.c.donation_date)
+    ).all()
+    for model in (Pledge, ThankYouNote):
+        db.execute(update(model.__table__).where(model.__table__.c.donor_id == duplicate_id)
+                   .values(donor_id=donor_id, updated_at=func.now()))
+    db.execute(update(PledgeAllocation).where(PledgeAllocation.donor_id == duplicate_id).values(donor_id=donor_id))
+    # One statement per donor and year: the duplicate's statements for years the donor already has
+    # stay with the duplicate and are deleted with it
+    kept = aliased(AnnualStatement)
+    db.execute(update(AnnualStatement).where(
+        AnnualStatement.donor_id == duplicate_id,
+        ~select(kept.id).where(kept.donor_id == donor_id, kept.year == AnnualStatement.year).exists(),
+    ).values(donor_id=donor_id))
+
+    suggestions = DonorMergeSuggestion.__table__
+    db.execute(delete(suggestions).where(
+        or_(suggestions.c.donor_id == duplicate_id, suggestions.c.duplicate_id == duplicate_id)))
+
+    for column in MERGE_FILL_COLUMNS:
+        if getattr(donor, column) is None and getattr(duplicate, column) is not None:
+            setattr(donor, column, getattr(duplicate, column))
+    donor.updated_at = func.now()
+    db.expunge(duplicate)
+    db.execute(delete(Donor.__table__).where(Donor.__table__.c.id == duplicate_id))
+    changes.record_deletion(db, "donors", duplicate_id)
+    # Distinct donor counts change where both donors gave
+    refresh_rollups(db, touched)
+    refresh_donor_totals(db, [donor_id])
+    db.flush()
+    return donor
+
+
+@job_handler("donor_dedup")
+def find_duplicate_donors(ctx: JobContext, params: dict):
+    """Scan donors for likely duplicates and replace the open merge suggestions."""
+    from models import SessionLocal
+
+    with SessionLocal() as db:
+        return scan(db, ctx)
+
+
+if __name__ == "__main__":
+    from models import SessionLocal
+
+    if sys.argv[1:] != ["scan"]:
+        sys.exit("usage: python dedup.py scan")
+    with SessionLocal() as session:
+        for name, count in scan(session).items():
+            print(f"{name:<16} {count}")
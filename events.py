@@ -0,0 +1,121 @@
+# events.py
+"""Live program progress updates for Server-Sent Events subscribers.
+
+Write endpoints call ``stage_progress`` inside their transaction. Once the
+transaction commits, the new value reaches the in-process ProgressHub, which
+coalesces updates and pushes at most one event per program every
+PROGRESS_PUSH_INTERVAL seconds to each subscriber.
+
+With PROGRESS_NOTIFY=1 the value is sent with Postgres NOTIFY instead (which is
+also delivered only on commit), and every worker process LISTENs and feeds its
+own hub, so subscribers connected to any worker see writes made on any other.
+"""
+import asyncio
+import json
+import os
+import select
+import threading
+import time
+
+from sqlalchemy import event, func
+from sqlalchemy import select as sql_select
+from sqlalchemy.orm import Session
+
+from models import engine
+
+PROGRESS_PUSH_INTERVAL = float(os.getenv("PROGRESS_PUSH_INTERVAL", "1"))
+PROGRESS_NOTIFY = os.getenv("PROGRESS_NOTIFY", "0") == "1"
+CHANNEL = "program_progress"
+
+
+class ProgressHub:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.subscribers = {}  # program_id -> set of asyncio.Queue
+        self.pending = {}      # program_id -> latest progress not yet pushed
+        self.loop = None
+        self._flusher = None
+        self._stop = threading.Event()
+
+    def start(self, loop):
+        self.loop = loop
+        self._stop.clear()
+        self._flusher = loop.create_task(self._flush_periodically())
+        if PROGRESS_NOTIFY:
+            threading.Thread(target=self._listen, name="progress-listener", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        if self._flusher:
+            self._flusher.cancel()
+
+    def subscribe(self, program_id: int) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=1)
+        self.subscribers.setdefault(program_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, program_id: int, queue: asyncio.Queue):
+        queues = self.subscribers.get(program_id, set())
+        queues.discard(queue)
+        if not queues:
+            self.subscribers.pop(program_id, None)
+
+    def publish(self, program_id: int, progress: float):
+        """Thread-safe: record the latest value; it is pushed on the next flush."""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.pending.__setitem__, program_id, progress)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            pending, self.pending = self.pending, {}
+            for program_id, progress in pending.items():
+                for queue in self.subscribers.get(program_id, ()):
+                    # Slow consumers only ever get the newest value
+                    if queue.full():
+                        queue.get_nowait()
+                    queue.put_nowait(progress)
+
+    def _listen(self):
+        import psycopg2
+        import psycopg2.extensions
+
+        dsn = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+        while not self._stop.is_set():
+            try:
+                connection = psycopg2.connect(dsn)
+                connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                connection.cursor().execute(f"LISTEN {CHANNEL}")
+                while not self._stop.is_set():
+                    if select.select([connection], [], [], 5) == ([], [], []):
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        payload = json.loads(connection.notifies.pop(0).payload)
+                        self.publish(payload["program_id"], payload["current_progress"])
+            except psycopg2.Error:
+                time.sleep(1)
+
+
+progress_hub = ProgressHub(PROGRESS_PUSH_INTERVAL)
+
+
+def stage_progress(db: Session, program_id: int, current_progress):
+    """Queue a program's new current_progress for subscribers once ``db`` commits."""
+    progress = float(current_progress) if current_progress is not None else None
+    if PROGRESS_NOTIFY:
+        payload = json.dumps({"program_id": program_id, "current_progress": progress})
+        db.execute(sql_select(func.pg_notify(CHANNEL, payload)))
+    else:
+        db.info.setdefault("progress_updates", {})[program_id] = progress
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_committed_progress(session):
+    for program_id, progress in session.info.pop("progress_updates", {}).items():
+        progress_hub.publish(program_id, progress)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_rolled_back_progress(session):
+    session.info.pop("progress_updates", None)
@@ -0,0 +1,275 @@
+# fulfillment.py
+"""Pledge fulfillment reconciliation.
+
+Donations are matched to a donor's pledges and the matches are stored in
+pledge_allocations. A donation counts toward a pledge when it comes from the same
+donor, goes to the pledge's program (a pledge without a program takes any
+donation) and is dated within PLEDGE_WINDOW_DAYS after the pledge date. Each
+donation is split oldest-pledge-first: it fills the oldest pledge that still has a
+balance, and whatever is left over goes to the next one. The pledge's
+amount_fulfilled, status and fulfillment_date are then derived from its
+allocations. Only pledges whose status is empty, pending, partially_fulfilled or
+fulfilled are reconciled. Other statuses (e.g. cancelled) are left alone.
+
+Allocation depends on the order of a donor's gifts, so a donor is always
+re-allocated as a whole. Donors are processed in batches sorted by donor id, one
+transaction per batch. Donations are streamed in donor order, so memory is
+bounded by the batch's pledges and the largest donor's donations.
+
+An incremental run re-allocates only the donors with donations or pledges that
+were changed or deleted since the last run. A full rebuild processes every donor
+that has pledges. Both then move the checkpoint in reconciliation_checkpoints.
+
+Usage:
+    python fulfillment.py run       # incremental (a full rebuild if there is no checkpoint yet)
+    python fulfillment.py rebuild
+"""
+import os
+import sys
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from itertools import groupby
+from typing import Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from sqlalchemy import bindparam, delete, func, insert, or_, select, union, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from changes import commit_horizon
+from jobs import JobContext, job_handler
+from models import Donation, Pledge, PledgeAllocation, ReconciliationCheckpoint, Tombstone
+
+PLEDGE_WINDOW_DAYS = int(os.getenv("PLEDGE_WINDOW_DAYS", "365"))
+DONOR_BATCH_SIZE = 500
+FETCH_SIZE = 10_000
+CHECKPOINT_NAME = "pledge_fulfillment"
+
+RECONCILED_STATUSES = ("pending", "partially_fulfilled", "fulfilled")
+reconciled = or_(Pledge.status.is_(None), Pledge.status.in_(RECONCILED_STATUSES))
+
+
+def allocate(pledges: list, donations, window_days: int = PLEDGE_WINDOW_DAYS):
+    """Split one donor's donations over their pledges, oldest pledge first.
+
+    ``pledges`` are rows with id, program_id, amount and pledge_date, sorted by
+    (pledge_date, id). ``donations`` are rows with id, program_id, amount and
+    donation_date, sorted by (donation_date, id). Returns the allocations as
+    (pledge_id, donation_id, amount, donation_date) tuples and, per pledge id,
+    (amount allocated, date the pledge was fully paid or None).
+    """
+    window = timedelta(days=window_days)
+    balance = {pledge.id: Decimal(pledge.amount) for pledge in pledges}
+    totals = {pledge.id: [Decimal(0), None] for pledge in pledges}
+    open_pledges = list(pledges)
+    allocations = []
+
+    for donation in donations:
+        left = Decimal(donation.amount)
+        # Donations arrive in date order, so pledges that are paid or out of their window stay that way
+        open_pledges = [pledge for pledge in open_pledges
+                        if balance[pledge.id] > 0 and donation.donation_date <= pledge.pledge_date + window]
+        for pledge in open_pledges:
+            if left <= 0:
+                break
+            if donation.donation_date < pledge.pledge_date:
+                break  # later pledges are newer still
+            if pledge.program_id is not None and pledge.program_id != donation.program_id:
+                continue
+            amount = min(left, balance[pledge.id])
+            if amount <= 0:
+                continue
+            allocations.append((pledge.id, donation.id, amount, donation.donation_date))
+            balance[pledge.id] -= amount
+            totals[pledge.id][0] += amount
+            left -= amount
+            if balance[pledge.id] <= 0:
+                totals[pledge.id][1] = donation.donation_date
+
+    return allocations, {pledge_id: tuple(total) for pledge_id, total in totals.items()}
+
+
+def pledge_state(amount, allocated: Decimal, fulfilled_on: Optional[date]) -> dict:
+    if allocated >= Decimal(amount):
+        status = "fulfilled"
+    elif allocated > 0:
+        status = "partially_fulfilled"
+    else:
+        status = "pending"
+    return {"amount_fulfilled": allocated, "status": status, "fulfillment_date": fulfilled_on}
+
+
+def reconcile_donors(db: Session, donor_ids: list) -> dict:
+    """Re-allocate every donation of ``donor_ids`` in the caller's transaction; the caller commits."""
+    pledges = {}
+    # Lock the pledges so a concurrent PUT/PATCH can't interleave with the rewrite
+    for donor_id, rows in groupby(db.execute(
+            select(Pledge.id, Pledge.donor_id, Pledge.program_id, Pledge.amount, Pledge.pledge_date,
+                   Pledge.amount_fulfilled, Pledge.status, Pledge.fulfillment_date)
+            .where(Pledge.donor_id.in_(donor_ids), reconciled)
+            .order_by(Pledge.donor_id, Pledge.pledge_date, Pledge.id)
+            .with_for_update()
+    ), key=lambda row: row.donor_id):
+        pledges[donor_id] = list(rows)
+
+    allocations, changed = [], []
+
+    def apply(donor_id, donations):
+        donor_allocations, totals = allocate(pledges[donor_id], donations)
+        allocations.extend(
+            {"pledge_id": pledge_id, "donation_id": donation_id, "donor_id": donor_id,
+             "amount": amount, "donation_date": donation_date}
+            for pledge_id, donation_id, amount, donation_date in donor_allocations
+        )
+        for pledge in pledges[donor_id]:
+            state = pledge_state(pledge.amount, *totals[pledge.id])
+            if (Decimal(pledge.amount_fulfilled), pledge.status, pledge.fulfillment_date) != \
+                    (state["amount_fulfilled"], state["status"], state["fulfillment_date"]):
+                changed.append({"pledge_id": pledge.id, **state})
+
+    if pledges:
+        earliest_pledge = select(func.min(Pledge.pledge_date)).where(Pledge.donor_id == Donation.donor_id, reconciled)
+        donations = db.execute(
+            select(Donation.id, Donation.donor_id, Donation.program_id, Donation.amount, Donation.donation_date)
+            .where(Donation.donor_id.in_(list(pledges)), Donation.donation_date >= earliest_pledge.scalar_subquery())
+            .order_by(Donation.donor_id, Donation.donation_date, Donation.id)
+            .execution_options(yield_per=FETCH_SIZE)
+        )
+        # One donor's donations at a time
+        without_donations = set(pledges)
+        for donor_id, rows in groupby(donations, key=lambda row: row.donor_id):
+            apply(donor_id, rows)
+            without_donations.discard(donor_id)
+        for donor_id in without_donations:
+            apply(donor_id, ())
+
+    db.execute(delete(PledgeAllocation).where(PledgeAllocation.donor_id.in_(donor_ids)))
+    if allocations:
+        db.execute(insert(PledgeAllocation), allocations)
+    if changed:
+        pledges_table = Pledge.__table__
+        db.execute(
+            update(pledges_table).where(pledges_table.c.id == bindparam("pledge_id")).values(
+                amount_fulfilled=bindparam("amount_fulfilled"), status=bindparam("status"),
+                fulfillment_date=bindparam("fulfillment_date"), updated_at=func.now(),
+            ),
+            changed,
+        )
+    return {"allocations": len(allocations), "pledges_updated": len(changed)}
+
+
+def deleted_ids(entity: str, since: datetime):
+    return select(Tombstone.entity_id).where(Tombstone.entity == entity, Tombstone.deleted_at >= since)
+
+
+def sorted_donor_ids(*queries):
+    donor_id = union(*queries).subquery().c[0]
+    return select(donor_id).order_by(donor_id)
+
+
+def changed_donors(db: Session, since: datetime) -> list:
+    """Donors whose allocation may differ because of writes at or after ``since``."""
+    has_pledges = select(Pledge.donor_id).where(Pledge.donor_id == Donation.donor_id).exists()
+    return db.scalars(sorted_donor_ids(
+        select(Donation.donor_id).where(Donation.updated_at >= since, has_pledges),
+        select(Pledge.donor_id).where(Pledge.updated_at >= since),
+        # The donor a changed or deleted donation (or a deleted pledge) was allocated to before
+        select(PledgeAllocation.donor_id).where(or_(
+            PledgeAllocation.donation_id.in_(select(Donation.id).where(Donation.updated_at >= since)),
+            PledgeAllocation.donation_id.in_(deleted_ids("donations", since)),
+            PledgeAllocation.pledge_id.in_(deleted_ids("pledges", since)),
+        )),
+    )).all()
+
+
+def donors_with_pledges(db: Session, after: int, limit: int) -> list:
+    return db.scalars(sorted_donor_ids(
+        select(Pledge.donor_id).where(Pledge.donor_id > after),
+        select(PledgeAllocation.donor_id).where(PledgeAllocation.donor_id > after),
+    ).limit(limit)).all()
+
+
+def load_checkpoint(db: Session) -> Optional[datetime]:
+    return db.scalar(select(ReconciliationCheckpoint.synced_until)
+                     .where(ReconciliationCheckpoint.name == CHECKPOINT_NAME))
+
+
+def save_checkpoint(db: Session, synced_until: datetime):
+    table = ReconciliationCheckpoint.__table__
+    statement = pg_insert(table).values(name=CHECKPOINT_NAME, synced_until=synced_until, updated_at=func.now())
+    db.execute(statement.on_conflict_do_update(
+        index_elements=[table.c.name],
+        set_={"synced_until": statement.excluded.synced_until, "updated_at": statement.excluded.updated_at},
+    ))
+
+
+def reconcile(db: Session, full: bool = False, ctx: Optional[JobContext] = None) -> dict:
+    """Run an incremental reconciliation, or a full rebuild if ``full`` or there is no checkpoint yet.
+
+    With a job context, the run resumes from ``ctx.checkpoint`` after each committed batch.
+    """
+    state = dict(ctx.checkpoint) if ctx else {}
+    if state:
+        full, horizon = state["full"], datetime.fromisoformat(state["horizon"])
+    else:
+        # Rows stamped after the oldest open transaction started may not have committed yet (see changes.py)
+        horizon = commit_horizon(db)
+        since = None if full else load_checkpoint(db)
+        full = since is None
+        state = {"full": full, "horizon": horizon.isoformat(), "since": since and since.isoformat(),
+                 "last_donor_id": 0, "donors": 0, "allocations": 0, "pledges_updated": 0}
+
+    if full:
+        total = db.scalar(select(func.count()).select_from(union(
+            select(Pledge.donor_id), select(PledgeAllocation.donor_id)).subquery())) or 1
+        pending = None
+    else:
+        pending = [donor_id for donor_id in changed_donors(db, datetime.fromisoformat(state["since"]))
+                   if donor_id > state["last_donor_id"]]
+        total = state["donors"] + len(pending) or 1
+
+    while True:
+        if pending is None:
+            batch = donors_with_pledges(db, state["last_donor_id"], DONOR_BATCH_SIZE)
+        else:
+            batch, pending = pending[:DONOR_BATCH_SIZE], pending[DONOR_BATCH_SIZE:]
+        if not batch:
+            break
+
+        counts = reconcile_donors(db, batch)
+        state.update(last_donor_id=batch[-1], donors=state["donors"] + len(batch),
+                     allocations=state["allocations"] + counts["allocations"],
+                     pledges_updated=state["pledges_updated"] + counts["pledges_updated"])
+        if ctx:
+            ctx.stage_checkpoint(db, state)
+        db.commit()
+        if ctx:
+            ctx.report(min(99.0, 100.0 * state["donors"] / total))
+
+    save_checkpoint(db, horizon)
+    db.commit()
+    return {"full": full, "donors": state["donors"], "allocations": state["allocations"],
+            "pledges_updated": state["pledges_updated"], "synced_until": horizon.isoformat()}
+
+
+@job_handler("pledge_reconciliation")
+def reconcile_pledges(ctx: JobContext, params: dict):
+    """Match donations to pledges; ``{"full": true}`` rebuilds every donor."""
+    from models import SessionLocal
+
+    with SessionLocal() as db:
+        return reconcile(db, bool(params.get("full")), ctx)
+
+
+if __name__ == "__main__":
+    from models import SessionLocal
+
+    if sys.argv[1:] not in (["run"], ["rebuild"]):
+        sys.exit("usage: python fulfillment.py run|rebuild")
+    with SessionLocal() as session:
+        result = reconcile(session, full=sys.argv[1] == "rebuild")
+    print(f"{'full rebuild' if result['full'] else 'incremental run'}: {result['donors']} donors, "
+          f"{result['allocations']} allocations, {result['pledges_updated']} pledges updated")
@@ -0,0 +1,197 @@
+# idempotency.py
+"""Idempotent donation ingestion.
+
+Clients that retry (e.g. payment webhooks) send an ``Idempotency-Key`` header.
+The first response for a key is stored with the write, in the same transaction,
+and a retry with the same key is answered from the stored response with one
+primary key lookup. Keys expire after IDEMPOTENCY_KEY_TTL_HOURS (default 24).
+
+Independently of the header, ``python idempotency.py unique-transactions`` adds a
+unique index on donations (payment_method, transaction_id). POST /donations/ then
+returns the existing donation instead of inserting a duplicate, or 409 if the
+request records a different donation under the same transaction id.
+
+Usage:
+    python idempotency.py duplicates            # list transaction ids that occur more than once
+    python idempotency.py unique-transactions   # create the unique index (fails while duplicates exist)
+    python idempotency.py purge                 # delete expired idempotency keys
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+from datetime import timedelta
+from typing import Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from sqlalchemy import delete, func, select, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from models import IdempotencyKey, engine, SessionLocal
+
+IDEMPOTENCY_KEY_TTL_HOURS = float(os.getenv("IDEMPOTENCY_KEY_TTL_HOURS", "24"))
+TRANSACTION_INDEX = "ux_donations_payment_method_transaction_id"
+
+
+def request_hash(payload: BaseModel) -> str:
+    return hashlib.sha256(json.dumps(payload.model_dump(mode="json"), sort_keys=True).encode()).hexdigest()
+
+
+def expires_before():
+    return func.now() - timedelta(hours=IDEMPOTENCY_KEY_TTL_HOURS)
+
+
+def replay(db: Session, endpoint: str, key: str, payload: BaseModel) -> Optional[JSONResponse]:
+    """The stored response for ``key``, or None if the key is new or expired.
+
+    Raises ValueError if the key was used for a different request body.
+    """
+    stored = db.scalar(select(IdempotencyKey).where(
+        IdempotencyKey.endpoint == endpoint,
+        IdempotencyKey.key == key,
+        IdempotencyKey.created_at > expires_before(),
+    ))
+    if stored is None:
+        return None
+    if stored.request_hash != request_hash(payload):
+        raise ValueError("Idempotency-Key was already used with a different request body")
+    return JSONResponse(content=stored.response, status_code=stored.status_code,
+                        headers={"Idempotent-Replayed": "true"})
+
+
+def save(db: Session, endpoint: str, key: str, payload: BaseModel, response: BaseModel, status_code: int = 200) -> bool:
+    """Store the response for ``key`` in the caller's transaction.
+
+    Returns False if a concurrent request with the same key committed first;
+    the caller should roll back and replay that request's response instead.
+    An expired key is overwritten.
+    """
+    table = IdempotencyKey.__table__
+    statement = insert(table).values(
+        endpoint=endpoint, key=key, request_hash=request_hash(payload),
+        status_code=status_code, response=jsonable_encoder(response),
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.endpoint, table.c.key],
+        set_={"request_hash": statement.excluded.request_hash, "status_code": statement.excluded.status_code,
+              "response": statement.excluded.response, "created_at": func.now()},
+        where=table.c.created_at <= expires_before(),
+    )
+    return db.execute(statement.returning(table.c.key)).first() is not None
+
+
+_transaction_index_columns = None
+
+
+def transaction_index_columns(db: Session) -> list:
+    """Columns of the unique transaction index, or [] until ``unique-transactions`` has created it.
+
+    Looked up on the first donation insert and cached for the life of the process, whether
+    or not the index exists. When the index is created, or donations is partitioned, later,
+    the insert fails on the stale value (see stale_transaction_index) and the caller calls
+    forget_transaction_index and retries.
+    """
+    global _transaction_index_columns
+    if _transaction_index_columns is None:
+        exists, partitioned = db.execute(text(
+            "SELECT to_regclass(:index) IS NOT NULL, "
+            "EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('donations'))"
+        ), {"index": TRANSACTION_INDEX}).one()
+        _transaction_index_columns = (["payment_method", "transaction_id"] + (["donation_date"] if partitioned else [])
+                                      if exists else [])
+    return _transaction_index_columns
+
+
+def forget_transaction_index():
+    global _transaction_index_columns
+    _transaction_index_columns = None
+
+
+def stale_transaction_index(exc: DBAPIError) -> bool:
+    """Whether a donation insert failed because the cached transaction index columns are out of date.
+
+    Either ON CONFLICT names columns no unique index has any more (42P10), or the index
+    was created after it was cached as missing and the insert hit it (23505).
+    """
+    code = getattr(exc.orig, "pgcode", None)
+    if code == "23505":
+        detail = getattr(getattr(exc.orig, "diag", None), "message_detail", None) or ""
+        return _transaction_index_columns == [] and detail.startswith("Key (payment_method, transaction_id")
+    return code == "42P10"
+
+
+def purge_expired(db: Session) -> int:
+    result = db.execute(delete(IdempotencyKey).where(IdempotencyKey.created_at <= expires_before()))
+    db.commit()
+    return result.rowcount
+
+
+def find_duplicate_transactions(conn, limit: int = 50):
+    return conn.execute(text(
+        "SELECT payment_method, transaction_id, count(*) AS copies, array_agg(id ORDER BY id) AS donation_ids "
+        "FROM donations WHERE transaction_id IS NOT NULL "
+        "GROUP BY payment_method, transaction_id HAVING count(*) > 1 "
+        "ORDER BY count(*) DESC LIMIT :limit"
+    ), {"limit": limit}).all()
+
+
+def create_transaction_index():
+    """Create the unique (payment_method, transaction_id) index on donations.
+
+    A payment method of NULL counts as a value (NULLS NOT DISTINCT, Postgres 15+).
+    Unique indexes on a partitioned table must contain the partition key, so once
+    donations is partitioned the index also includes donation_date and only
+    catches duplicates with the same date, which is what a retried request sends.
+    """
+    from partitions import is_partitioned
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if find_duplicate_transactions(conn, limit=1):
+            raise SystemExit("donations has duplicate transaction ids; "
+                             "run `python idempotency.py duplicates` and resolve them first")
+        if is_partitioned(conn):
+            columns, concurrently = "payment_method, transaction_id, donation_date", ""
+        else:
+            columns, concurrently = "payment_method, transaction_id", "CONCURRENTLY "
+        conn.execute(text(
+            f"CREATE UNIQUE INDEX {concurrently}IF NOT EXISTS {TRANSACTION_INDEX} "
+            f"ON donations ({columns}) NULLS NOT DISTINCT WHERE transaction_id IS NOT NULL"
+        ))
+    forget_transaction_index()
+    print(f"{TRANSACTION_INDEX} on donations ({columns})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Donation deduplication and idempotency key maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+    duplicates = commands.add_parser("duplicates", help="list transaction ids that occur more than once")
+    duplicates.add_argument("--limit", type=int, default=50)
+    commands.add_parser("unique-transactions", help="create the unique (payment_method, transaction_id) index")
+    commands.add_parser("purge", help="delete expired idempotency keys")
+    args = parser.parse_args(argv)
+
+    if args.command == "duplicates":
+        with engine.connect() as conn:
+            rows = find_duplicate_transactions(conn, args.limit)
+        for row in rows:
+            print(f"{row.payment_method} {row.transaction_id}: {row.copies} donations {row.donation_ids}")
+        print(f"{len(rows)} duplicated transaction ids")
+    elif args.command == "unique-transactions":
+        create_transaction_index()
+    elif args.command == "purge":
+        with SessionLocal() as db:
+            print(f"deleted {purge_expired(db)} expired idempotency keys")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,328 @@
+# jobs.py
+"""In-process background jobs with progress polling and database checkpoints.
+
+Handlers are registered with ``@job_handler("kind")`` and called as
+``handler(ctx, params)``. They work in batches, commit each batch, then call
+``ctx.report(progress, checkpoint)``. The checkpoint is stored on the job row, so a
+job interrupted by a worker restart is picked up again (by this or another worker)
+and resumes from ``ctx.checkpoint`` instead of starting over. A batch may be
+replayed after a crash, so handlers must make each batch idempotent.
+
+While a handler runs, a thread heartbeats the job every JOB_HEARTBEAT_SECONDS, so
+only jobs whose worker died go stale, however long a single batch takes.
+Handlers defined in other modules are listed in HANDLER_MODULES; a module is
+imported when its first job is submitted or run.
+"""
+import csv
+import importlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+from sqlalchemy import func, insert, literal, select, update
+
+from models import (SessionLocal, Job, Donor, Program, Donation, Pledge, TaxReceipt, ThankYouNote)
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# A running job whose heartbeat is older than this is considered orphaned and is resumed
+JOB_STALE_SECONDS = int(os.getenv("JOB_STALE_SECONDS", "300"))
+# Running jobs heartbeat from a separate thread this often, however long a batch takes
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", JOB_STALE_SECONDS / 3))
+EXPORT_DIR = os.getenv("EXPORT_DIR", "exports")
+BATCH_SIZE = 1000
+
+FINISHED_STATUSES = ("succeeded", "failed", "cancelled")
+
+handlers = {}
+# Job kinds whose handlers live in modules the app doesn't import at startup
+HANDLER_MODULES = {
+    "annual_statements": "statements",
+    "thank_you_campaign": "campaigns",
+    "donor_segments": "segments",
+    "pledge_reconciliation": "fulfillment",
+    "donor_dedup": "dedup",
+}
+executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+_stop = threading.Event()
+
+
+class JobCancelled(Exception):
+    """Raised from JobContext.report when the job has been cancelled."""
+
+
+def job_handler(kind: str):
+    def register(handler):
+        handlers[kind] = handler
+        return handler
+    return register
+
+
+def get_handler(kind: str):
+    """The handler for ``kind``, importing the module that registers it; None for an unknown kind."""
+    if kind not in handlers and kind in HANDLER_MODULES:
+        importlib.import_module(HANDLER_MODULES[kind])
+    return handlers.get(kind)
+
+
+def job_kinds() -> list:
+    return list(dict.fromkeys([*handlers, *HANDLER_MODULES]))
+
+
+class JobContext:
+    def __init__(self, job_id: int, checkpoint: dict = None):
+        self.job_id = job_id
+        self.checkpoint = checkpoint or {}
+
+    def report(self, progress: float, checkpoint: dict = None):
+        """Save progress (0-100) and an optional checkpoint; raise JobCancelled if cancellation was requested."""
+        values = {"progress": round(min(progress, 100.0), 2), "heartbeat_at": func.now(), "updated_at": func.now()}
+        if checkpoint is not None:
+            self.checkpoint = values["checkpoint"] = checkpoint
+
+        with SessionLocal() as db:
+            cancel_requested = db.execute(
+                update(Job).where(Job.id == self.job_id).values(**values).returning(Job.cancel_requested)
+            ).scalar()
+            db.commit()
+
+        if cancel_requested:
+            raise JobCancelled()
+
+    def stage_checkpoint(self, db, checkpoint: dict):
+        """Write a checkpoint in the caller's transaction, so it commits atomically with the batch's work."""
+        self.checkpoint = checkpoint
+        db.execute(update(Job).where(Job.id == self.job_id).values(checkpoint=checkpoint, updated_at=func.now()))
+
+
+def submit_job(db, kind: str, params: dict) -> Job:
+    job = Job(kind=kind, params=params, status="queued", progress=0, cancel_requested=False)
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    executor.submit(run_job, job.id)
+    return job
+
+
+def cancel_job(db, job: Job) -> Job:
+    """Cancel a queued job immediately, or ask a running job to stop at its next progress report."""
+    if job.status == "queued":
+        db.execute(update(Job).where(Job.id == job.id, Job.status == "queued").values(
+            status="cancelled", finished_at=func.now(), updated_at=func.now()
+        ))
+    if job.status in ("queued", "running"):
+        db.execute(update(Job).where(Job.id == job.id).values(cancel_requested=True, updated_at=func.now()))
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def retry_job(db, job: Job) -> Job:
+    """Requeue a failed or cancelled job; it resumes from its last checkpoint."""
+    db.execute(update(Job).where(Job.id == job.id, Job.status.in_(("failed", "cancelled"))).values(
+        status="queued", error=None, cancel_requested=False, finished_at=None, updated_at=func.now()
+    ))
+    db.commit()
+    db.refresh(job)
+    executor.submit(run_job, job.id)
+    return job
+
+
+def _finish(job_id: int, status: str, **values):
+    with SessionLocal() as db:
+        db.execute(update(Job).where(Job.id == job_id).values(
+            status=status, finished_at=func.now(), updated_at=func.now(), **values
+        ))
+        db.commit()
+
+
+def keep_alive(job_id: int, done: threading.Event):
+    """Heartbeat a running job until ``done`` is set, so only a dead worker's jobs go stale."""
+    while not done.wait(JOB_HEARTBEAT_SECONDS):
+        try:
+            with SessionLocal() as db:
+                db.execute(update(Job).where(Job.id == job_id, Job.status == "running").values(heartbeat_at=func.now()))
+                db.commit()
+        except Exception:
+            pass  # the database is unreachable; try again at the next beat
+
+
+def run_job(job_id: int):
+    # Claim the job; another worker may have picked it up already
+    with SessionLocal() as db:
+        job = db.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status == "queued", Job.cancel_requested.is_(False))
+            .values(status="running", started_at=func.coalesce(Job.started_at, func.now()),
+                    heartbeat_at=func.now(), updated_at=func.now())
+            .returning(Job.kind, Job.params, Job.checkpoint)
+        ).first()
+        db.commit()
+    if job is None:
+        return
+
+    done = threading.Event()
+    threading.Thread(target=keep_alive, args=(job_id, done), name=f"job-{job_id}-heartbeat", daemon=True).start()
+    try:
+        handler = get_handler(job.kind)
+        if handler is None:
+            raise ValueError(f"Unknown job kind {job.kind}")
+        result = handler(JobContext(job_id, job.checkpoint), job.params or {})
+    except JobCancelled:
+        _finish(job_id, "cancelled")
+    except Exception as exc:
+        _finish(job_id, "failed", error=f"{type(exc).__name__}: {exc}")
+    else:
+        _finish(job_id, "succeeded", progress=100, result=result)
+    finally:
+        done.set()
+
+
+def resume_jobs():
+    """Requeue orphaned running jobs and hand every queued job to the worker pool."""
+    with SessionLocal() as db:
+        db.execute(
+            update(Job)
+            .where(Job.status == "running", Job.heartbeat_at < func.now() - timedelta(seconds=JOB_STALE_SECONDS))
+            .values(status="queued", updated_at=func.now())
+        )
+        queued = db.scalars(select(Job.id).where(Job.status == "queued").order_by(Job.id)).all()
+        db.commit()
+    for job_id in queued:
+        executor.submit(run_job, job_id)
+
+
+def start_worker():
+    """Resume jobs now and then periodically, so jobs orphaned by a dead worker are picked up."""
+    def watch():
+        while not _stop.is_set():
+            resume_jobs()
+            _stop.wait(JOB_STALE_SECONDS)
+
+    _stop.clear()
+    threading.Thread(target=watch, name="job-watcher", daemon=True).start()
+
+
+def stop_worker():
+    # Running jobs stay 'running' in the database and are resumed from their checkpoint later
+    _stop.set()
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Job handlers
+
+@job_handler("tax_receipts")
+def generate_tax_receipts(ctx: JobContext, params: dict):
+    """Create a tax receipt for every tax-deductible donation in ``params["year"]`` that lacks one."""
+    year = int(params["year"])
+    year_filter = (
+        Donation.donation_date >= date(year, 1, 1),
+        Donation.donation_date <= date(year, 12, 31),
+        Donation.is_tax_deductible == True,
+    )
+    last_id = ctx.checkpoint.get("last_donation_id", 0)
+    processed = ctx.checkpoint.get("processed", 0)
+    generated = ctx.checkpoint.get("generated", 0)
+
+    missing_receipt = ~select(TaxReceipt.id).where(TaxReceipt.donor_id == Donation.id).exists()
+
+    with SessionLocal() as db:
+        total = db.scalar(select(func.count()).select_from(Donation).where(*year_filter)) or 1
+        while True:
+            ids = db.scalars(
+                select(Donation.id).where(*year_filter, Donation.id > last_id).order_by(Donation.id).limit(BATCH_SIZE)
+            ).all()
+            if not ids:
+                break
+
+            generated += db.execute(insert(TaxReceipt).from_select(
+                ["donor_id", "year_donated", "total_amount", "generated_date"],
+                select(Donation.id, literal(date(year, 1, 1)), Donation.amount, func.current_date())
+                .where(Donation.id.in_(ids), missing_receipt)
+                # Holds off a concurrent delete_donation until these receipts are committed
+                .with_for_update(read=True, key_share=True, of=Donation)
+            )).rowcount
+            db.commit()
+
+            last_id = ids[-1]
+            processed += len(ids)
+            ctx.report(100.0 * processed / total,
+                       {"last_donation_id": last_id, "processed": processed, "generated": generated})
+
+    return {"year": year, "generated": generated}
+
+
+EXPORTABLE = {
+    "donors": Donor,
+    "programs": Program,
+    "donations": Donation,
+    "pledges": Pledge,
+    "tax_receipts": TaxReceipt,
+    "thank_you_notes": ThankYouNote,
+}
+
+
+@job_handler("export")
+def export_table(ctx: JobContext, params: dict):
+    """Write every row of ``params["entity"]`` to a CSV file under EXPORT_DIR."""
+    entity = params.get("entity")
+    if entity not in EXPORTABLE:
+        raise ValueError(f"entity must be one of: {', '.join(EXPORTABLE)}")
+    model = EXPORTABLE[entity]
+    columns = [column.name for column in model.__table__.columns]
+    path = os.path.join(EXPORT_DIR, f"job_{ctx.job_id}_{entity}.csv")
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+
+    last_id = ctx.checkpoint.get("last_id", 0)
+    rows = ctx.checkpoint.get("rows", 0)
+    if ctx.checkpoint:
+        # Drop anything written after the last checkpoint before appending
+        os.truncate(path, ctx.checkpoint["offset"])
+        output = open(path, "a", newline="")
+    else:
+        output = open(path, "w", newline="")
+        csv.writer(output).writerow(columns)
+
+    with output, SessionLocal() as db:
+        writer = csv.writer(output)
+        total = db.scalar(select(func.count()).select_from(model)) or 1
+        while True:
+            batch = db.execute(
+                select(*model.__table__.columns).where(model.id > last_id).order_by(model.id).limit(BATCH_SIZE)
+            ).all()
+            if not batch:
+                break
+            writer.writerows(batch)
+            output.flush()
+
+            last_id = batch[-1].id
+            rows += len(batch)
+            ctx.report(100.0 * rows / total, {"last_id": last_id, "rows": rows, "offset": output.tell()})
+
+    return {"entity": entity, "path": path, "rows": rows}
+
+
+@job_handler("recompute_progress")
+def recompute_program_progress(ctx: JobContext, params: dict):
+    """Recompute programs.current_progress from the donations table."""
+    last_id = ctx.checkpoint.get("last_program_id", 0)
+    processed = ctx.checkpoint.get("processed", 0)
+
+    with SessionLocal() as db:
+        total = db.scalar(select(func.count()).select_from(Program)) or 1
+        while True:
+            ids = db.scalars(select(Program.id).where(Program.id > last_id).order_by(Program.id).limit(100)).all()
+            if not ids:
+                break
+
+            donated = select(func.coalesce(func.sum(Donation.amount), 0)).where(Donation.program_id == Program.id)
+            db.execute(update(Program).where(Program.id.in_(ids)).values(
+                current_progress=donated.scalar_subquery(), updated_at=func.now()
+            ))
+            db.commit()
+
+            last_id = ids[-1]
+            processed += len(ids)
+            ctx.report(100.0 * processed / total, {"last_program_id": last_id, "processed": processed})
+
+    return {"programs": processed}
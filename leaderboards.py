@@ -0,0 +1,134 @@
+# leaderboards.py
+"""Top donors and largest gifts, overall, per program and per year.
+
+Top donors read ``donor_totals``: one row per donor for all gifts, per program,
+per year and per program and year (0 stands for "all" in program_id and year).
+The donation endpoints call ``refresh_donor_totals`` with the donors a write
+touched, which recomputes just those donors' rows in one GROUPING SETS query.
+A leaderboard is then a walk of the first N entries of one slice of the
+(program_id, year, total_amount DESC, donor_id) index.
+
+Largest gifts walk the (amount DESC, id) and (program_id, amount DESC, id)
+indexes of donations directly. Year leaderboards filter that walk by date; with
+donations partitioned by year (see partitions.py) it reads one partition's index.
+
+Ties go to the lower donor or donation id, so pages are stable.
+
+Usage:
+    python leaderboards.py rebuild
+"""
+import sys
+from datetime import date
+from typing import Iterable, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from sqlalchemy import bindparam, select, text
+from sqlalchemy.orm import Session
+
+from models import Donation, Donor, DonorTotal
+
+TOTALS_SQL = """
+    INSERT INTO donor_totals (donor_id, program_id, year, total_amount, gift_count, last_donation_date, updated_at)
+    SELECT donor_id, program_key, year_key, total_amount, gift_count, last_donation_date, now()
+    FROM (
+        SELECT donor_id,
+               CASE WHEN grouping(program_id) = 1 THEN 0 ELSE program_id END AS program_key,
+               CASE WHEN grouping(year) = 1 THEN 0 ELSE year END AS year_key,
+               sum(amount) AS total_amount, count(*) AS gift_count, max(donation_date) AS last_donation_date
+        FROM (
+            SELECT donor_id, program_id, extract(year FROM donation_date)::int AS year, amount, donation_date
+            FROM donations
+            WHERE {where}
+        ) gifts
+        GROUP BY GROUPING SETS ((donor_id), (donor_id, program_id), (donor_id, year), (donor_id, program_id, year))
+    ) totals
+    -- Per-program rows of gifts without a program would collide with the all-programs row
+    WHERE program_key IS NOT NULL
+"""
+
+
+def refresh_donor_totals(db: Session, donor_ids: Iterable[Optional[int]]):
+    """Recompute every donor_totals row of the given donors.
+
+    Runs inside the caller's transaction; the caller commits.
+    """
+    donor_ids = sorted({donor_id for donor_id in donor_ids if donor_id})
+    if not donor_ids:
+        return
+    params = {"donor_ids": donor_ids}
+    # Concurrent writes for the same donor take turns, so each recompute sees the other's committed donations
+    db.execute(text("SELECT pg_advisory_xact_lock(hashtext('donor_totals'), donor_id) FROM unnest(:donor_ids) AS donor_id"),
+               params)
+    db.execute(text("DELETE FROM donor_totals WHERE donor_id IN :donor_ids")
+               .bindparams(bindparam("donor_ids", expanding=True)), params)
+    db.execute(text(TOTALS_SQL.format(where="donor_id IN :donor_ids"))
+               .bindparams(bindparam("donor_ids", expanding=True)), params)
+
+
+def rebuild_donor_totals(db: Session):
+    """Recompute donor_totals from the donations table in bulk."""
+    db.execute(text("DELETE FROM donor_totals"))
+    db.execute(text(TOTALS_SQL.format(where="donor_id IS NOT NULL")))
+
+
+def donor_name(donor: Donor) -> str:
+    return f"{donor.first_name} {donor.last_name}" if donor.donor_type == "individual" else donor.organization_name
+
+
+def top_donors(db: Session, limit: int, program_id: Optional[int] = None, year: Optional[int] = None) -> list:
+    """The ``limit`` donors who gave the most, overall or to one program and/or in one year."""
+    rows = db.execute(
+        select(DonorTotal, Donor).join(Donor, Donor.id == DonorTotal.donor_id)
+        .where(DonorTotal.program_id == (program_id or 0), DonorTotal.year == (year or 0))
+        .order_by(DonorTotal.total_amount.desc(), DonorTotal.donor_id)
+        .limit(limit)
+    ).all()
+    return [
+        {
+            "rank": rank,
+            "donor_id": donor.id,
+            "donor_name": donor_name(donor),
+            "donor_type": donor.donor_type,
+            "total_amount": float(total.total_amount),
+            "gift_count": total.gift_count,
+            "last_donation_date": total.last_donation_date
+        }
+        for rank, (total, donor) in enumerate(rows, start=1)
+    ]
+
+
+def top_gifts(db: Session, limit: int, program_id: Optional[int] = None, year: Optional[int] = None) -> list:
+    """The ``limit`` largest donations, overall or to one program and/or in one year."""
+    query = select(Donation, Donor).outerjoin(Donor, Donor.id == Donation.donor_id)
+    if program_id:
+        query = query.where(Donation.program_id == program_id)
+    if year:
+        # A date range rather than EXTRACT(YEAR ...), so partitions are pruned
+        query = query.where(Donation.donation_date >= date(year, 1, 1), Donation.donation_date < date(year + 1, 1, 1))
+    rows = db.execute(query.order_by(Donation.amount.desc(), Donation.id).limit(limit)).all()
+    return [
+        {
+            "rank": rank,
+            "donation_id": donation.id,
+            "donor_id": donation.donor_id,
+            "donor_name": donor_name(donor) if donor else None,
+            "program_id": donation.program_id,
+            "amount": float(donation.amount),
+            "donation_date": donation.donation_date
+        }
+        for rank, (donation, donor) in enumerate(rows, start=1)
+    ]
+
+
+if __name__ == "__main__":
+    from models import SessionLocal
+
+    if sys.argv[1:] != ["rebuild"]:
+        sys.exit("usage: python leaderboards.py rebuild")
+    with SessionLocal() as session:
+        rebuild_donor_totals(session)
+        session.commit()
+    print("donor totals rebuilt")
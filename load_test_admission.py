@@ -0,0 +1,75 @@
+import argparse
+import statistics
+import threading
+import time
+
+import requests
+
+# Base URL for the API
+BASE_URL = "http://localhost:8000"  # Change this if your API is running on a different URL
+
+HEAVY_REPORTS = ["/reports/donations-by-donor/", "/reports/pending-thank-you-notes/"]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float("nan")
+
+
+def measure_crud(base_url, donor_id, seconds):
+    """Hit GET /donors/{id} sequentially and return the latencies in milliseconds."""
+    latencies = []
+    session = requests.Session()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        response = session.get(f"{base_url}/donors/{donor_id}")
+        latencies.append((time.perf_counter() - start) * 1000)
+        response.raise_for_status()
+    return latencies
+
+
+def saturate_reports(base_url, stop, counts):
+    session = requests.Session()
+    while not stop.is_set():
+        for path in HEAVY_REPORTS:
+            status = session.get(f"{base_url}{path}").status_code
+            counts[status] = counts.get(status, 0) + 1
+
+
+def summarize(label, latencies):
+    print(f"{label:<28} n={len(latencies):<6} p50={statistics.median(latencies):7.1f}ms "
+          f"p95={percentile(latencies, 0.95):7.1f}ms p99={percentile(latencies, 0.99):7.1f}ms")
+
+
+def main():
+    """Show that CRUD latency stays flat while report endpoints are saturated"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", default=BASE_URL)
+    parser.add_argument("--donor-id", type=int, default=1)
+    parser.add_argument("--report-clients", type=int, default=16)
+    parser.add_argument("--seconds", type=int, default=15)
+    args = parser.parse_args()
+
+    baseline = measure_crud(args.base_url, args.donor_id, args.seconds)
+
+    stop = threading.Event()
+    counts = {}
+    clients = [threading.Thread(target=saturate_reports, args=(args.base_url, stop, counts), daemon=True)
+               for _ in range(args.report_clients)]
+    for client in clients:
+        client.start()
+    time.sleep(1)  # Let the report clients fill the report pool and queue
+    loaded = measure_crud(args.base_url, args.donor_id, args.seconds)
+    stop.set()
+
+    summarize("GET /donors/{id} idle", baseline)
+    summarize("GET /donors/{id} + reports", loaded)
+    print(f"report responses by status: {dict(sorted(counts.items()))}")
+    print(f"admission metrics: {requests.get(f'{args.base_url}/metrics/admission').json()}")
+
+
+if __name__ == "__main__":
+    print("Starting admission control load test...")
+    main()
+    print("Admission control load test completed.")
@@ -1,46 +1,57 @@
 # main.py
+import asyncio
+import json
 import os
 from datetime import date, datetime
 from typing import List, Optional
 
-import uvicorn
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Depends, Query
-from fastapi.middleware.cors import CORSMiddleware
 
-from models import (Donor, Program, Donation, Pledge, TaxReceipt, ThankYouNote,
-                   DonorBase, DonorCreate, DonorResponse,
-                   ProgramBase, ProgramCreate, ProgramResponse,
-                   DonationBase, DonationCreate, DonationResponse,
-                   PledgeBase, PledgeCreate, PledgeResponse,
-                   TaxReceiptBase, TaxReceiptCreate, TaxReceiptResponse,
-                   ThankYouNoteBase, ThankYouNoteCreate, ThankYouNoteResponse,
-                   get_db, Base, SessionLocal, engine)
-
-
-from pydantic import BaseModel, EmailStr, Field
-from sqlalchemy import create_engine, Column, Integer, String, Text, Date, Boolean, Float, ForeignKey, TIMESTAMP
-from sqlalchemy.dialects.postgresql import NUMERIC
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship, Session
-
-# Load environment variables
+# Load environment variables before models reads DATABASE_URL
 load_dotenv()
 
-# Database connection details
-DATABASE_URL = os.getenv("DATABASE_URL")
-
-# Set up SQLAlchemy
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
+from fastapi import FastAPI, File, HTTPException, Depends, Header, Query, Request, Response, UploadFile
+from fastapi.encoders import jsonable_encoder
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 
-# This assumes 'app' is your FastAPI instance that's already defined
+from models import (Donor, Program, Donation, Pledge, TaxReceipt, ThankYouNote,
+                   DonorCreate, DonorUpdate, DonorResponse, DonorMerge, DonorMergeSuggestion,
+                   ProgramCreate, ProgramUpdate, ProgramResponse,
+                   DonationCreate, DonationUpdate, DonationResponse,
+                   PledgeCreate, PledgeUpdate, PledgeResponse, PledgeAllocation, PledgeAllocationResponse,
+                   TaxReceiptCreate, TaxReceiptUpdate, TaxReceiptResponse, TaxReceiptMarkSent,
+                   ThankYouNoteCreate, ThankYouNoteUpdate, ThankYouNoteResponse, ThankYouCampaignCreate,
+                   ThankYouNoteMarkSent, MarkSentResponse,
+                   Job, JobCreate, JobResponse, DonorSegment,
+                   get_db, get_read_db, get_write_db, get_report_db, ReadSessionLocal)
+from rollups import GRANULARITIES, read_timeseries, refresh_rollups
+import jobs
+import leaderboards
+import changes
+import counts
+import idempotency
+from events import progress_hub, stage_progress
+from admission import AdmissionControlMiddleware, admission_stats
+import server
+# Feature modules (statements, campaigns, segments, fulfillment, dedup, dashboard, reconciliation,
+# analytics) are imported in the endpoints that use them, and job handlers through jobs.HANDLER_MODULES,
+# so a cold start only loads what serving requests needs
+
+from pydantic import BaseModel
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import aliased, Session
+from sqlalchemy import case, delete, exists, func, insert, literal, select, update
+from sqlalchemy.exc import DBAPIError, IntegrityError
 
 
 # Initialize FastAPI app
 app = FastAPI(title="ULEM Tracker API", description="API for ULEM donation tracking system")
 
+# Add admission control (per-route concurrency limits with fast 503s); added first so CORS wraps its 503s
+app.add_middleware(AdmissionControlMiddleware)
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -48,8 +59,211 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allows all methods
     allow_headers=["*"],  # Allows all headers
+    expose_headers=["X-Total-Count", "X-Total-Count-Mode"],
 )
 
+# Sparse fieldsets
+def select_fields(query, model, response_model, fields: Optional[str]):
+    """Restrict a query to the comma-separated ``fields`` requested by the client.
+
+    Returns the (possibly projected) query and the list of selected field names,
+    or ``None`` when no ``fields`` parameter was given. The primary key is always included.
+    """
+    if not fields:
+        return query, None
+
+    requested = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in requested if name not in response_model.model_fields]
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Unknown fields: {', '.join(unknown)}")
+
+    selected = ["id"] + [name for name in dict.fromkeys(requested) if name != "id"]
+    return query.with_entities(*[getattr(model, name) for name in selected]), selected
+
+
+def fields_response(rows, headers: Optional[dict] = None):
+    """Serialize projected rows (or a single row) without going through the full response model."""
+    if isinstance(rows, list):
+        return JSONResponse(content=jsonable_encoder([dict(row._mapping) for row in rows]), headers=headers)
+    return JSONResponse(content=jsonable_encoder(dict(rows._mapping)), headers=headers)
+
+
+# Total counts (?count=exact or ?count=estimated) on the paginated list endpoints
+def set_total_count(response: Response, db: Session, query, count: Optional[str]) -> dict:
+    """Add X-Total-Count for the filtered query (before offset and limit) to the response.
+
+    Returns the headers so a ``fields_response`` can carry them too.
+    """
+    if count and count not in counts.COUNT_MODES:
+        raise HTTPException(status_code=422, detail=f"count must be one of: {', '.join(counts.COUNT_MODES)}")
+    headers = counts.count_headers(db, query, count)
+    response.headers.update(headers)
+    return headers
+
+
+def mark_sent(db: Session, model, conditions: list, values: dict, dry_run: bool) -> MarkSentResponse:
+    """Set sent fields on every row matching ``conditions`` in one UPDATE ... RETURNING (or just count them)."""
+    if dry_run:
+        count = db.scalar(select(func.count()).select_from(model).where(*conditions))
+        return MarkSentResponse(dry_run=True, count=count)
+
+    ids = db.scalars(
+        update(model).where(*conditions).values(**values, updated_at=func.now()).returning(model.id)
+    ).all()
+    db.commit()
+    return MarkSentResponse(dry_run=False, count=len(ids), ids=ids)
+
+
+# Single-transaction writes
+
+# Foreign key column -> detail of the 404 returned when the referenced row is missing
+MISSING_REFERENCES = {"donor_id": "Donor not found", "program_id": "Program not found",
+                      "donation_id": "Donation not found"}
+
+
+def write_returning(db: Session, statement, model, *extra_columns):
+    """Run an INSERT/UPDATE/DELETE on ``model``'s table and return the affected row as a mapping (or None).
+
+    Referenced rows are checked by the table's foreign keys rather than separate SELECTs;
+    a violation rolls back and becomes a 404 naming the missing row.
+    """
+    try:
+        return db.execute(statement.returning(*model.__table__.c, *extra_columns)).mappings().first()
+    except IntegrityError as exc:
+        db.rollback()
+        if getattr(exc.orig, "pgcode", None) == "23503":
+            for column, detail in MISSING_REFERENCES.items():
+                if f"({column})" in str(exc.orig):
+                    raise HTTPException(status_code=404, detail=detail)
+        if getattr(exc.orig, "pgcode", None) == "23505" and not idempotency.stale_transaction_index(exc):
+            raise HTTPException(status_code=409, detail=exc.orig.diag.message_detail or "Duplicate row")
+        raise
+
+
+def donation_exists(donation_id: int):
+    """EXISTS clause for a donation that also takes a KEY SHARE lock on it.
+
+    Once donations is partitioned, tax receipts and thank-you notes have no foreign key to it;
+    the lock makes a concurrent delete_donation wait for this write and then see its row.
+    """
+    return select(Donation.id).where(Donation.id == donation_id).with_for_update(read=True, key_share=True).exists()
+
+
+def adjust_progress(db: Session, amounts: list):
+    """Add (program_id, amount) pairs to programs.current_progress in one UPDATE ... RETURNING.
+
+    The new totals are staged for live progress subscribers; the caller commits.
+    """
+    deltas = {}
+    for program_id, amount in amounts:
+        if program_id:
+            deltas[program_id] = deltas.get(program_id, 0) + amount
+    deltas = {program_id: delta for program_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    programs = Program.__table__
+    rows = db.execute(
+        update(programs)
+        .where(programs.c.id.in_(deltas))
+        .values(current_progress=func.coalesce(programs.c.current_progress, 0) + case(deltas, value=programs.c.id, else_=0),
+                updated_at=func.now())
+        .returning(programs.c.id, programs.c.current_progress)
+    )
+    for program_id, current_progress in rows:
+        stage_progress(db, program_id, current_progress)
+
+
+def locked_donation(donation_id: int):
+    """CTE that locks a donation and keeps its donor, program, amount and date from before an UPDATE."""
+    donations = Donation.__table__
+    return select(donations.c.id, donations.c.donor_id, donations.c.program_id, donations.c.amount,
+                  donations.c.donation_date) \
+        .where(donations.c.id == donation_id).with_for_update().cte("old")
+
+
+# Partial updates (PATCH)
+
+def patch_changes(patch: BaseModel, create_model) -> dict:
+    """Fields present in a PATCH body; null is rejected for fields the create model requires."""
+    changes = patch.model_dump(exclude_unset=True)
+    not_nullable = [name for name, value in changes.items()
+                    if value is None and create_model.model_fields[name].is_required()]
+    if not_nullable:
+        raise HTTPException(status_code=422, detail=f"Fields cannot be null: {', '.join(not_nullable)}")
+    return changes
+
+
+def parse_if_match(if_match: Optional[str]) -> Optional[datetime]:
+    """The updated_at timestamp a client sent in If-Match (the ETag of a previous response)."""
+    if if_match is None:
+        return None
+    try:
+        return datetime.fromisoformat(if_match.strip().removeprefix("W/").strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=422, detail="If-Match must be the resource's updated_at timestamp")
+
+
+def patch_row(db: Session, model, row_id: int, changes: dict, if_match: Optional[str], not_found: str,
+              guards: tuple = (), old=None):
+    """Apply ``changes`` to one row with a single UPDATE ... RETURNING of only those columns.
+
+    With If-Match the UPDATE only matches while updated_at is unchanged; otherwise 412.
+    ``guards`` are extra conditions on the write (e.g. a referenced donation exists), and
+    ``old`` is an optional CTE from locked_donation whose columns come back as old_<name>.
+    Returns None if a guard failed. Only the failure path runs a second query.
+    """
+    table = model.__table__
+    expected = parse_if_match(if_match)
+    conditions = [table.c.id == row_id, *guards]
+    if expected is not None:
+        conditions.append(table.c.updated_at == expected)
+    extra_columns = []
+    if old is not None:
+        conditions.append(table.c.id == old.c.id)
+        extra_columns = [column.label(f"old_{column.name}") for column in old.c]
+
+    if changes:
+        row = write_returning(db, update(table).where(*conditions).values(**changes, updated_at=func.now()),
+                              model, *extra_columns)
+    else:
+        row = db.execute(select(*table.c, *extra_columns).where(*conditions)).mappings().first()
+
+    if row is None:
+        updated_at = db.scalar(select(table.c.updated_at).where(table.c.id == row_id))
+        if updated_at is None:
+            raise HTTPException(status_code=404, detail=not_found)
+        if expected is not None and updated_at != expected:
+            raise HTTPException(status_code=412, detail=f"Modified since If-Match; updated_at is now {updated_at.isoformat()}")
+    return row
+
+
+def etag(updated_at: datetime) -> str:
+    return f'"{updated_at.isoformat()}"'
+
+
+def set_etag(response: Response, row):
+    response.headers["ETag"] = etag(row["updated_at"])
+
+
+def read_one(query, model, response_model, fields: Optional[str], response: Response, not_found: str):
+    """A single-row GET (all columns or the requested ``fields``) with its updated_at as the ETag for If-Match."""
+    query, selected = select_fields(query, model, response_model, fields)
+    if selected:
+        # updated_at comes along for the ETag even when it is not one of the requested fields
+        query = query.add_columns(model.updated_at.label("etag_updated_at"))
+    row = query.first()
+    if row is None:
+        raise HTTPException(status_code=404, detail=not_found)
+    if not selected:
+        if row.updated_at is not None:
+            response.headers["ETag"] = etag(row.updated_at)
+        return row
+    content = dict(row._mapping)
+    updated_at = content.pop("etag_updated_at")
+    return JSONResponse(content=jsonable_encoder(content), headers={"ETag": etag(updated_at)} if updated_at else None)
+
+
 # API Endpoints
 
 # Landing page or home route
@@ -60,9 +274,15 @@ def landing_page():
 
 
 
+# Admission control queue depths and rejection counts
+@app.get("/metrics/admission", tags=["Metrics"])
+def get_admission_metrics():
+    return admission_stats()
+
+
 # Donors
 @app.post("/donors/", response_model=DonorResponse, tags=["Donors"])
-def create_donor(donor: DonorCreate, db: Session = Depends(get_db)):
+def create_donor(donor: DonorCreate, db: Session = Depends(get_write_db)):
     db_donor = Donor(**donor.dict())
     db.add(db_donor)
     db.commit()
@@ -72,11 +292,14 @@ def create_donor(donor: DonorCreate, db: Session = Depends(get_db)):
 
 @app.get("/donors/", response_model=List[DonorResponse], tags=["Donors"])
 def read_donors(
+        response: Response,
         skip: int = 0,
         limit: int = 100,
         donor_type: Optional[str] = None,
         search: Optional[str] = None,
-        db: Session = Depends(get_db)
+        fields: Optional[str] = None,
+        count: Optional[str] = None,
+        db: Session = Depends(get_read_db)
 ):
     query = db.query(Donor)
 
@@ -92,19 +315,19 @@ def read_donors(
             (Donor.email.ilike(search_term))
         )
 
-    return query.offset(skip).limit(limit).all()
+    query, selected = select_fields(query, Donor, DonorResponse, fields)
+    headers = set_total_count(response, db, query, count)
+    rows = query.offset(skip).limit(limit).all()
+    return fields_response(rows, headers) if selected else rows
 
 
 @app.get("/donors/{donor_id}", response_model=DonorResponse, tags=["Donors"])
-def read_donor(donor_id: int, db: Session = Depends(get_db)):
-    donor = db.query(Donor).filter(Donor.id == donor_id).first()
-    if donor is None:
-        raise HTTPException(status_code=404, detail="Donor not found")
-    return donor
+def read_donor(donor_id: int, response: Response, fields: Optional[str] = None, db: Session = Depends(get_read_db)):
+    return read_one(db.query(Donor).filter(Donor.id == donor_id), Donor, DonorResponse, fields, response, "Donor not found")
 
 
 @app.put("/donors/{donor_id}", response_model=DonorResponse, tags=["Donors"])
-def update_donor(donor_id: int, donor: DonorCreate, db: Session = Depends(get_db)):
+def update_donor(donor_id: int, donor: DonorCreate, db: Session = Depends(get_write_db)):
     db_donor = db.query(Donor).filter(Donor.id == donor_id).first()
     if db_donor is None:
         raise HTTPException(status_code=404, detail="Donor not found")
@@ -112,26 +335,109 @@ def update_donor(donor_id: int, donor: DonorCreate, db: Session = Depends(get_db
     for key, value in donor.dict().items():
         setattr(db_donor, key, value)
 
-    db_donor.updated_at = datetime.now()
+    db_donor.updated_at = func.now()
     db.commit()
     db.refresh(db_donor)
     return db_donor
 
 
+@app.patch("/donors/{donor_id}", response_model=DonorResponse, tags=["Donors"])
+def patch_donor(donor_id: int, donor: DonorUpdate, response: Response,
+                if_match: Optional[str] = Header(None), db: Session = Depends(get_write_db)):
+    db_donor = patch_row(db, Donor, donor_id, patch_changes(donor, DonorCreate), if_match, "Donor not found")
+    db.commit()
+    set_etag(response, db_donor)
+    return db_donor
+
+
 @app.delete("/donors/{donor_id}", response_model=DonorResponse, tags=["Donors"])
-def delete_donor(donor_id: int, db: Session = Depends(get_db)):
+def delete_donor(donor_id: int, db: Session = Depends(get_write_db)):
     donor = db.query(Donor).filter(Donor.id == donor_id).first()
     if donor is None:
         raise HTTPException(status_code=404, detail="Donor not found")
 
     db.delete(donor)
+    changes.record_deletion(db, "donors", donor.id)
     db.commit()
     return donor
 
 
+# Merge a duplicate donor into this one: its donations, pledges and thank-you notes move here and it is deleted
+@app.post("/donors/{donor_id}/merge", response_model=DonorResponse, tags=["Donors"])
+def merge_donor(donor_id: int, merge: DonorMerge, db: Session = Depends(get_write_db)):
+    import dedup
+
+    try:
+        donor = dedup.merge_donors(db, donor_id, merge.duplicate_id)
+    except LookupError as exc:
+        raise HTTPException(status_code=404, detail=str(exc))
+    except ValueError as exc:
+        raise HTTPException(status_code=422, detail=str(exc))
+
+    db.commit()
+    db.refresh(donor)
+    return donor
+
+
+# Likely duplicate donors, best matches first (found by `python dedup.py scan` or a donor_dedup job)
+@app.get("/donor-merge-suggestions/", tags=["Donors"])
+def read_merge_suggestions(
+        response: Response,
+        status: str = "open",
+        min_score: float = 0,
+        skip: int = 0,
+        limit: int = Query(100, le=1000),
+        count: Optional[str] = None,
+        db: Session = Depends(get_read_db)
+):
+    duplicate = aliased(Donor)
+    query = db.query(DonorMergeSuggestion, Donor, duplicate) \
+        .join(Donor, Donor.id == DonorMergeSuggestion.donor_id) \
+        .join(duplicate, duplicate.id == DonorMergeSuggestion.duplicate_id) \
+        .filter(DonorMergeSuggestion.status == status, DonorMergeSuggestion.score >= min_score)
+    set_total_count(response, db, query, count)
+    rows = query.order_by(DonorMergeSuggestion.score.desc(), DonorMergeSuggestion.id) \
+        .offset(skip).limit(limit).all()
+
+    def summary(donor):
+        return {
+            "id": donor.id,
+            "donor_name": f"{donor.first_name} {donor.last_name}" if donor.donor_type == "individual" else donor.organization_name,
+            "email": donor.email,
+            "phone": donor.phone,
+            "postal_code": donor.postal_code
+        }
+
+    return [
+        {
+            "id": suggestion.id,
+            "score": suggestion.score,
+            "reasons": suggestion.reasons.split(","),
+            "status": suggestion.status,
+            "donor": summary(donor),
+            "duplicate": summary(duplicate_donor),
+            "created_at": suggestion.created_at
+        }
+        for suggestion, donor, duplicate_donor in rows
+    ]
+
+
+@app.post("/donor-merge-suggestions/{suggestion_id}/dismiss", tags=["Donors"])
+def dismiss_merge_suggestion(suggestion_id: int, db: Session = Depends(get_write_db)):
+    suggestions = DonorMergeSuggestion.__table__
+    row = db.execute(
+        update(suggestions).where(suggestions.c.id == suggestion_id).values(status="dismissed")
+        .returning(suggestions.c.id, suggestions.c.donor_id, suggestions.c.duplicate_id, suggestions.c.status)
+    ).first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Merge suggestion not found")
+    db.commit()
+    return row._asdict()
+
+
 # Programs
 @app.post("/programs/", response_model=ProgramResponse, tags=["Programs"])
-def create_program(program: ProgramCreate, db: Session = Depends(get_db)):
+def create_program(program: ProgramCreate, db: Session = Depends(get_write_db)):
     db_program = Program(**program.dict())
     db.add(db_program)
     db.commit()
@@ -141,11 +447,14 @@ def create_program(program: ProgramCreate, db: Session = Depends(get_db)):
 
 @app.get("/programs/", response_model=List[ProgramResponse], tags=["Programs"])
 def read_programs(
+        response: Response,
         skip: int = 0,
         limit: int = 100,
         search: Optional[str] = None,
         active_only: bool = False,
-        db: Session = Depends(get_db)
+        fields: Optional[str] = None,
+        count: Optional[str] = None,
+        db: Session = Depends(get_read_db)
 ):
     query = db.query(Program)
 
@@ -163,19 +472,48 @@ def read_programs(
             ((Program.end_date >= today) | (Program.end_date.is_(None)))
         )
 
-    return query.offset(skip).limit(limit).all()
+    query, selected = select_fields(query, Program, ProgramResponse, fields)
+    headers = set_total_count(response, db, query, count)
+    rows = query.offset(skip).limit(limit).all()
+    return fields_response(rows, headers) if selected else rows
 
 
 @app.get("/programs/{program_id}", response_model=ProgramResponse, tags=["Programs"])
-def read_program(program_id: int, db: Session = Depends(get_db)):
-    program = db.query(Program).filter(Program.id == program_id).first()
+def read_program(program_id: int, response: Response, fields: Optional[str] = None, db: Session = Depends(get_read_db)):
+    return read_one(db.query(Program).filter(Program.id == program_id), Program, ProgramResponse, fields, response, "Program not found")
+
+
+# Push current_progress to the client whenever donations for the program change (Server-Sent Events)
+@app.get("/programs/{program_id}/progress/stream", tags=["Programs"])
+async def stream_program_progress(program_id: int, request: Request):
+    def current_progress():
+        with ReadSessionLocal() as db:
+            return db.query(Program.current_progress).filter(Program.id == program_id).first()
+
+    program = await run_in_threadpool(current_progress)
     if program is None:
         raise HTTPException(status_code=404, detail="Program not found")
-    return program
+
+    async def events():
+        queue = progress_hub.subscribe(program_id)
+        try:
+            progress = float(program.current_progress) if program.current_progress is not None else None
+            yield f"event: progress\ndata: {json.dumps({'program_id': program_id, 'current_progress': progress})}\n\n"
+            while not await request.is_disconnected():
+                try:
+                    progress = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: progress\ndata: {json.dumps({'program_id': program_id, 'current_progress': progress})}\n\n"
+        finally:
+            progress_hub.unsubscribe(program_id, queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 
 @app.put("/programs/{program_id}", response_model=ProgramResponse, tags=["Programs"])
-def update_program(program_id: int, program: ProgramCreate, db: Session = Depends(get_db)):
+def update_program(program_id: int, program: ProgramCreate, db: Session = Depends(get_write_db)):
     db_program = db.query(Program).filter(Program.id == program_id).first()
     if db_program is None:
         raise HTTPException(status_code=404, detail="Program not found")
@@ -183,14 +521,27 @@ def update_program(program_id: int, program: ProgramCreate, db: Session = Depend
     for key, value in program.dict().items():
         setattr(db_program, key, value)
 
-    db_program.updated_at = datetime.now()
+    db_program.updated_at = func.now()
+    stage_progress(db, db_program.id, db_program.current_progress)
     db.commit()
     db.refresh(db_program)
     return db_program
 
 
+@app.patch("/programs/{program_id}", response_model=ProgramResponse, tags=["Programs"])
+def patch_program(program_id: int, program: ProgramUpdate, response: Response,
+                  if_match: Optional[str] = Header(None), db: Session = Depends(get_write_db)):
+    changes = patch_changes(program, ProgramCreate)
+    db_program = patch_row(db, Program, program_id, changes, if_match, "Program not found")
+    if "current_progress" in changes:
+        stage_progress(db, program_id, db_program["current_progress"])
+    db.commit()
+    set_etag(response, db_program)
+    return db_program
+
+
 @app.delete("/programs/{program_id}", response_model=ProgramResponse, tags=["Programs"])
-def delete_program(program_id: int, db: Session = Depends(get_db)):
+def delete_program(program_id: int, db: Session = Depends(get_write_db)):
     program = db.query(Program).filter(Program.id == program_id).first()
     if program is None:
         raise HTTPException(status_code=404, detail="Program not found")
@@ -200,46 +551,80 @@ def delete_program(program_id: int, db: Session = Depends(get_db)):
     return program
 
 
-# Donations
-@app.post("/donations/", response_model=DonationResponse, tags=["Donations"])
-def create_donation(donation: DonationCreate, db: Session = Depends(get_db)):
-    # Check if donor exists
-    donor = db.query(Donor).filter(Donor.id == donation.donor_id).first()
-    if not donor:
-        raise HTTPException(status_code=404, detail="Donor not found")
-
-    # Check if program exists (if program_id is provided)
-    if donation.program_id:
-        program = db.query(Program).filter(Program.id == donation.program_id).first()
-        if not program:
-            raise HTTPException(status_code=404, detail="Program not found")
+def insert_donation(db: Session, donation: DonationCreate):
+    """INSERT ... RETURNING the donation; returns (row, conflict columns).
 
-    db_donation = Donation(**donation.dict())
-    db.add(db_donation)
-    db.commit()
-    db.refresh(db_donation)
+    With the unique transaction index (python idempotency.py unique-transactions) a repeated
+    transaction inserts nothing and the row is None.
+    """
+    statement = pg_insert(Donation.__table__).values(**donation.dict())
+    conflict_columns = idempotency.transaction_index_columns(db) if donation.transaction_id is not None else []
+    if conflict_columns:
+        statement = statement.on_conflict_do_nothing(index_elements=conflict_columns,
+                                                     index_where=Donation.transaction_id.isnot(None))
+    return write_returning(db, statement, Donation), conflict_columns
 
-    # Update program's current_progress if program_id is provided
-    if donation.program_id:
-        program = db.query(Program).filter(Program.id == donation.program_id).first()
-        if program.current_progress is None:
-            program.current_progress = 0
-        program.current_progress += donation.amount
-        program.updated_at = datetime.now()
-        db.commit()
 
+# Donations
+@app.post("/donations/", response_model=DonationResponse, tags=["Donations"])
+def create_donation(donation: DonationCreate, idempotency_key: Optional[str] = Header(None),
+                    db: Session = Depends(get_write_db)):
+    # A retry with the same Idempotency-Key gets the original response back
+    endpoint = "POST /donations/"
+    if idempotency_key:
+        try:
+            replayed = idempotency.replay(db, endpoint, idempotency_key, donation)
+        except ValueError as exc:
+            raise HTTPException(status_code=422, detail=str(exc))
+        if replayed is not None:
+            return replayed
+
+    try:
+        db_donation, conflict_columns = insert_donation(db, donation)
+    except DBAPIError as exc:
+        if not idempotency.stale_transaction_index(exc):
+            raise
+        # The transaction index was created or changed since this process looked it up
+        db.rollback()
+        idempotency.forget_transaction_index()
+        db_donation, conflict_columns = insert_donation(db, donation)
+    if db_donation is None:
+        values = donation.dict()
+        db_donation = db.execute(select(*Donation.__table__.c).where(
+            *[getattr(Donation, column).is_not_distinct_from(values[column]) for column in conflict_columns]
+        )).mappings().first()
+        if db_donation is None:
+            raise HTTPException(status_code=409, detail="The existing donation for this transaction was just deleted")
+        if DonationCreate.model_validate(dict(db_donation)) != donation:
+            raise HTTPException(status_code=409, detail=f"Transaction {donation.transaction_id} is already "
+                                                        f"recorded as donation {db_donation['id']} with different details")
+    else:
+        # Update program's current_progress if program_id is provided
+        adjust_progress(db, [(db_donation["program_id"], db_donation["amount"])])
+        refresh_rollups(db, [(db_donation["program_id"], db_donation["donation_date"])])
+        leaderboards.refresh_donor_totals(db, [db_donation["donor_id"]])
+
+    if idempotency_key and not idempotency.save(db, endpoint, idempotency_key, donation,
+                                                 DonationResponse.model_validate(dict(db_donation))):
+        # A concurrent request with the same key committed first: drop this insert and return its response
+        db.rollback()
+        return idempotency.replay(db, endpoint, idempotency_key, donation)
+    db.commit()
     return db_donation
 
 
 @app.get("/donations/", response_model=List[DonationResponse], tags=["Donations"])
 def read_donations(
+        response: Response,
         skip: int = 0,
         limit: int = 100,
         donor_id: Optional[int] = None,
         program_id: Optional[int] = None,
         start_date: Optional[date] = None,
         end_date: Optional[date] = None,
-        db: Session = Depends(get_db)
+        fields: Optional[str] = None,
+        count: Optional[str] = None,
+        db: Session = Depends(get_read_db)
 ):
     query = db.query(Donation)
 
@@ -255,114 +640,105 @@ def read_donations(
     if end_date:
         query = query.filter(Donation.donation_date <= end_date)
 
-    return query.offset(skip).limit(limit).all()
+    query, selected = select_fields(query, Donation, DonationResponse, fields)
+    headers = set_total_count(response, db, query, count)
+    rows = query.offset(skip).limit(limit).all()
+    return fields_response(rows, headers) if selected else rows
 
 
 @app.get("/donations/{donation_id}", response_model=DonationResponse, tags=["Donations"])
-def read_donation(donation_id: int, db: Session = Depends(get_db)):
-    donation = db.query(Donation).filter(Donation.id == donation_id).first()
-    if donation is None:
-        raise HTTPException(status_code=404, detail="Donation not found")
-    return donation
+def read_donation(donation_id: int, response: Response, fields: Optional[str] = None, db: Session = Depends(get_read_db)):
+    return read_one(db.query(Donation).filter(Donation.id == donation_id), Donation, DonationResponse, fields, response, "Donation not found")
 
 
 @app.put("/donations/{donation_id}", response_model=DonationResponse, tags=["Donations"])
-def update_donation(donation_id: int, donation: DonationCreate, db: Session = Depends(get_db)):
-    db_donation = db.query(Donation).filter(Donation.id == donation_id).first()
+def update_donation(donation_id: int, donation: DonationCreate, db: Session = Depends(get_write_db)):
+    # Lock the current row and return its old program, amount and date from the same UPDATE
+    donations = Donation.__table__
+    old = locked_donation(donation_id)
+    db_donation = write_returning(
+        db,
+        update(donations).where(donations.c.id == old.c.id).values(**donation.dict(), updated_at=func.now()),
+        Donation,
+        old.c.donor_id.label("old_donor_id"), old.c.program_id.label("old_program_id"),
+        old.c.amount.label("old_amount"), old.c.donation_date.label("old_donation_date"),
+    )
     if db_donation is None:
         raise HTTPException(status_code=404, detail="Donation not found")
 
-    # If program is being changed or amount is being updated, update program progress
-    old_program_id = db_donation.program_id
-    old_amount = db_donation.amount
-
-    # Check if donor exists
-    donor = db.query(Donor).filter(Donor.id == donation.donor_id).first()
-    if not donor:
-        raise HTTPException(status_code=404, detail="Donor not found")
-
-    # Check if program exists (if program_id is provided)
-    if donation.program_id:
-        program = db.query(Program).filter(Program.id == donation.program_id).first()
-        if not program:
-            raise HTTPException(status_code=404, detail="Program not found")
+    # Move the amount between programs (or apply the difference to the same program)
+    adjust_progress(db, [(db_donation["old_program_id"], -db_donation["old_amount"]),
+                         (db_donation["program_id"], db_donation["amount"])])
+    refresh_rollups(db, [(db_donation["old_program_id"], db_donation["old_donation_date"]),
+                         (db_donation["program_id"], db_donation["donation_date"])])
+    leaderboards.refresh_donor_totals(db, [db_donation["old_donor_id"], db_donation["donor_id"]])
+    db.commit()
+    return db_donation
 
-    for key, value in donation.dict().items():
-        setattr(db_donation, key, value)
 
-    db_donation.updated_at = datetime.now()
+@app.patch("/donations/{donation_id}", response_model=DonationResponse, tags=["Donations"])
+def patch_donation(donation_id: int, donation: DonationUpdate, response: Response,
+                   if_match: Optional[str] = Header(None), db: Session = Depends(get_write_db)):
+    changes = patch_changes(donation, DonationCreate)
+    db_donation = patch_row(db, Donation, donation_id, changes, if_match, "Donation not found",
+                            old=locked_donation(donation_id))
+
+    adjust_progress(db, [(db_donation["old_program_id"], -db_donation["old_amount"]),
+                         (db_donation["program_id"], db_donation["amount"])])
+    # Rollups only depend on who gave how much to which program on which day
+    if changes.keys() & {"donor_id", "program_id", "amount", "donation_date"}:
+        refresh_rollups(db, [(db_donation["old_program_id"], db_donation["old_donation_date"]),
+                             (db_donation["program_id"], db_donation["donation_date"])])
+        leaderboards.refresh_donor_totals(db, [db_donation["old_donor_id"], db_donation["donor_id"]])
     db.commit()
-    db.refresh(db_donation)
-
-    # Update the progress for old program (if applicable)
-    if old_program_id:
-        old_program = db.query(Program).filter(Program.id == old_program_id).first()
-        if old_program and old_program.current_progress is not None:
-            old_program.current_progress -= old_amount
-            old_program.updated_at = datetime.now()
-            db.commit()
-
-    # Update the progress for new program (if applicable)
-    if db_donation.program_id:
-        new_program = db.query(Program).filter(Program.id == db_donation.program_id).first()
-        if new_program:
-            if new_program.current_progress is None:
-                new_program.current_progress = 0
-            new_program.current_progress += db_donation.amount
-            new_program.updated_at = datetime.now()
-            db.commit()
-
+    set_etag(response, db_donation)
     return db_donation
 
 
 @app.delete("/donations/{donation_id}", response_model=DonationResponse, tags=["Donations"])
-def delete_donation(donation_id: int, db: Session = Depends(get_db)):
-    donation = db.query(Donation).filter(Donation.id == donation_id).first()
-    if donation is None:
+def delete_donation(donation_id: int, db: Session = Depends(get_write_db)):
+    # Lock first: writers of receipts and notes hold a KEY SHARE lock on the donation (see donation_exists),
+    # so the reference check below runs after they commit. There are no foreign keys once donations is partitioned.
+    if db.scalar(select(Donation.id).where(Donation.id == donation_id).with_for_update()) is None:
         raise HTTPException(status_code=404, detail="Donation not found")
 
+    donations = Donation.__table__
+    donation = write_returning(db, delete(donations).where(
+        donations.c.id == donation_id,
+        ~exists().where(TaxReceipt.donor_id == donation_id),  # donor_id is actually donation_id
+        ~exists().where(ThankYouNote.donation_id == donation_id)
+    ), Donation)
+    if donation is None:
+        raise HTTPException(status_code=409, detail="Donation has tax receipts or thank you notes; delete them first")
+
     # Update program progress if applicable
-    if donation.program_id:
-        program = db.query(Program).filter(Program.id == donation.program_id).first()
-        if program and program.current_progress is not None:
-            program.current_progress -= donation.amount
-            program.updated_at = datetime.now()
-            db.commit()
-
-    db.delete(donation)
+    adjust_progress(db, [(donation["program_id"], -donation["amount"])])
+    changes.record_deletion(db, "donations", donation_id)
+    refresh_rollups(db, [(donation["program_id"], donation["donation_date"])])
+    leaderboards.refresh_donor_totals(db, [donation["donor_id"]])
     db.commit()
     return donation
 
 
 # Pledges
 @app.post("/pledges/", response_model=PledgeResponse, tags=["Pledges"])
-def create_pledge(pledge: PledgeCreate, db: Session = Depends(get_db)):
-    # Check if donor exists
-    donor = db.query(Donor).filter(Donor.id == pledge.donor_id).first()
-    if not donor:
-        raise HTTPException(status_code=404, detail="Donor not found")
-
-    # Check if program exists (if program_id is provided)
-    if pledge.program_id:
-        program = db.query(Program).filter(Program.id == pledge.program_id).first()
-        if not program:
-            raise HTTPException(status_code=404, detail="Program not found")
-
-    db_pledge = Pledge(**pledge.dict())
-    db.add(db_pledge)
+def create_pledge(pledge: PledgeCreate, db: Session = Depends(get_write_db)):
+    db_pledge = write_returning(db, insert(Pledge.__table__).values(**pledge.dict()), Pledge)
     db.commit()
-    db.refresh(db_pledge)
     return db_pledge
 
 
 @app.get("/pledges/", response_model=List[PledgeResponse], tags=["Pledges"])
 def read_pledges(
+        response: Response,
         skip: int = 0,
         limit: int = 100,
         donor_id: Optional[int] = None,
         program_id: Optional[int] = None,
         status: Optional[str] = None,
-        db: Session = Depends(get_db)
+        fields: Optional[str] = None,
+        count: Optional[str] = None,
+        db: Session = Depends(get_read_db)
 ):
     query = db.query(Pledge)
 
@@ -375,60 +751,72 @@ def read_pledges(
     if status:
         query = query.filter(Pledge.status == status)
 
-    return query.offset(skip).limit(limit).all()
+    query, selected = select_fields(query, Pledge, PledgeResponse, fields)
+    headers = set_total_count(response, db, query, count)
+    rows = query.offset(skip).limit(limit).all()
+    return fields_response(rows, headers) if selected else rows
 
 
 @app.get("/pledges/{pledge_id}", response_model=PledgeResponse, tags=["Pledges"])
-def read_pledge(pledge_id: int, db: Session = Depends(get_db)):
-    pledge = db.query(Pledge).filter(Pledge.id == pledge_id).first()
-    if pledge is None:
-        raise HTTPException(status_code=404, detail="Pledge not found")
-    return pledge
+def read_pledge(pledge_id: int, response: Response, fields: Optional[str] = None, db: Session = Depends(get_read_db)):
+    return read_one(db.query(Pledge).filter(Pledge.id == pledge_id), Pledge, PledgeResponse, fields, response, "Pledge not found")
 
 
 @app.put("/pledges/{pledge_id}", response_model=PledgeResponse, tags=["Pledges"])
-def update_pledge(pledge_id: int, pledge: PledgeCreate, db: Session = Depends(get_db)):
-    db_pledge = db.query(Pledge).filter(Pledge.id == pledge_id).first()
+def update_pledge(pledge_id: int, pledge: PledgeCreate, db: Session = Depends(get_write_db)):
+    pledges = Pledge.__table__
+    db_pledge = write_returning(
+        db, update(pledges).where(pledges.c.id == pledge_id).values(**pledge.dict(), updated_at=func.now()), Pledge
+    )
     if db_pledge is None:
         raise HTTPException(status_code=404, detail="Pledge not found")
 
-    # Check if donor exists
-    donor = db.query(Donor).filter(Donor.id == pledge.donor_id).first()
-    if not donor:
-        raise HTTPException(status_code=404, detail="Donor not found")
-
-    # Check if program exists (if program_id is provided)
-    if pledge.program_id:
-        program = db.query(Program).filter(Program.id == pledge.program_id).first()
-        if not program:
-            raise HTTPException(status_code=404, detail="Program not found")
+    db.commit()
+    return db_pledge
 
-    for key, value in pledge.dict().items():
-        setattr(db_pledge, key, value)
 
-    db_pledge.updated_at = datetime.now()
+@app.patch("/pledges/{pledge_id}", response_model=PledgeResponse, tags=["Pledges"])
+def patch_pledge(pledge_id: int, pledge: PledgeUpdate, response: Response,
+                 if_match: Optional[str] = Header(None), db: Session = Depends(get_write_db)):
+    db_pledge = patch_row(db, Pledge, pledge_id, patch_changes(pledge, PledgeCreate), if_match, "Pledge not found")
     db.commit()
-    db.refresh(db_pledge)
+    set_etag(response, db_pledge)
     return db_pledge
 
 
 @app.delete("/pledges/{pledge_id}", response_model=PledgeResponse, tags=["Pledges"])
-def delete_pledge(pledge_id: int, db: Session = Depends(get_db)):
-    pledge = db.query(Pledge).filter(Pledge.id == pledge_id).first()
+def delete_pledge(pledge_id: int, db: Session = Depends(get_write_db)):
+    pledge = write_returning(db, delete(Pledge.__table__).where(Pledge.__table__.c.id == pledge_id), Pledge)
     if pledge is None:
         raise HTTPException(status_code=404, detail="Pledge not found")
 
-    db.delete(pledge)
+    changes.record_deletion(db, "pledges", pledge_id)
     db.commit()
     return pledge
 
 
+# Donations matched to a pledge by the last reconciliation run
+@app.get("/pledges/{pledge_id}/allocations", response_model=List[PledgeAllocationResponse], tags=["Pledges"])
+def read_pledge_allocations(pledge_id: int, db: Session = Depends(get_read_db)):
+    if db.get(Pledge, pledge_id) is None:
+        raise HTTPException(status_code=404, detail="Pledge not found")
+    return db.scalars(
+        select(PledgeAllocation).where(PledgeAllocation.pledge_id == pledge_id)
+        .order_by(PledgeAllocation.donation_date, PledgeAllocation.donation_id)
+    ).all()
+
+
+# Match donations to pledges and update fulfillment in a background job
+@app.post("/pledges/reconcile/", response_model=JobResponse, status_code=202, tags=["Pledges"])
+def reconcile_pledges(full: bool = False, db: Session = Depends(get_db)):
+    return jobs.submit_job(db, "pledge_reconciliation", {"full": full})
+
+
 # Tax Receipts
 @app.post("/tax-receipts/", response_model=TaxReceiptResponse, tags=["Tax Receipts"])
-def create_tax_receipt(tax_receipt: TaxReceiptCreate, db: Session = Depends(get_db)):
-    # Check if donation exists
-    donation = db.query(Donation).filter(Donation.id == tax_receipt.donor_id).first()
-    if not donation:
+def create_tax_receipt(tax_receipt: TaxReceiptCreate, db: Session = Depends(get_write_db)):
+    # Check if donation exists (and lock it against a concurrent delete)
+    if not db.scalar(select(donation_exists(tax_receipt.donor_id))):
         raise HTTPException(status_code=404, detail="Donation not found")
 
     db_tax_receipt = TaxReceipt(**tax_receipt.dict())
@@ -438,15 +826,44 @@ def create_tax_receipt(tax_receipt: TaxReceiptCreate, db: Session = Depends(get_
     return db_tax_receipt
 
 
+# Mark many tax receipts as sent, by id list or filter
+@app.post("/tax-receipts/mark-sent/", response_model=MarkSentResponse, tags=["Tax Receipts"])
+def mark_tax_receipts_sent(request: TaxReceiptMarkSent, db: Session = Depends(get_write_db)):
+    conditions = []
+    if request.ids is not None:
+        conditions.append(TaxReceipt.id.in_(request.ids))
+
+    if request.filter:
+        if request.filter.donation_id:
+            conditions.append(TaxReceipt.donor_id == request.filter.donation_id)  # donor_id is actually donation_id
+        if request.filter.generated_after:
+            conditions.append(TaxReceipt.generated_date >= request.filter.generated_after)
+        if request.filter.generated_before:
+            conditions.append(TaxReceipt.generated_date <= request.filter.generated_before)
+        if request.filter.year_donated:
+            conditions.append(TaxReceipt.year_donated == request.filter.year_donated)
+
+    # unsent_only on its own would still match every unsent row
+    if not conditions:
+        raise HTTPException(status_code=422, detail="Provide ids or at least one filter field")
+    if request.filter and request.filter.unsent_only:
+        conditions.append(TaxReceipt.sent_date.is_(None))
+
+    return mark_sent(db, TaxReceipt, conditions, {"sent_date": request.sent_date}, request.dry_run)
+
+
 @app.get("/tax-receipts/", response_model=List[TaxReceiptResponse], tags=["Tax Receipts"])
 def read_tax_receipts(
+        response: Response,
         skip: int = 0,
         limit: int = 100,
         donation_id: Optional[int] = None,
         generated_after: Optional[date] = None,
         generated_before: Optional[date] = None,
         sent: Optional[bool] = None,
-        db: Session = Depends(get_db)
+        fields: Optional[str] = None,
+        count: Optional[str] = None,
+        db: Session = Depends(get_read_db)
 ):
     query = db.query(TaxReceipt)
 
@@ -465,39 +882,53 @@ def read_tax_receipts(
         else:
             query = query.filter(TaxReceipt.sent_date.is_(None))
 
-    return query.offset(skip).limit(limit).all()
+    query, selected = select_fields(query, TaxReceipt, TaxReceiptResponse, fields)
+    headers = set_total_count(response, db, query, count)
+    rows = query.offset(skip).limit(limit).all()
+    return fields_response(rows, headers) if selected else rows
 
 
 @app.get("/tax-receipts/{tax_receipt_id}", response_model=TaxReceiptResponse, tags=["Tax Receipts"])
-def read_tax_receipt(tax_receipt_id: int, db: Session = Depends(get_db)):
-    tax_receipt = db.query(TaxReceipt).filter(TaxReceipt.id == tax_receipt_id).first()
-    if tax_receipt is None:
-        raise HTTPException(status_code=404, detail="Tax receipt not found")
-    return tax_receipt
+def read_tax_receipt(tax_receipt_id: int, response: Response, fields: Optional[str] = None, db: Session = Depends(get_read_db)):
+    return read_one(db.query(TaxReceipt).filter(TaxReceipt.id == tax_receipt_id), TaxReceipt, TaxReceiptResponse, fields, response, "Tax receipt not found")
 
 
 @app.put("/tax-receipts/{tax_receipt_id}", response_model=TaxReceiptResponse, tags=["Tax Receipts"])
-def update_tax_receipt(tax_receipt_id: int, tax_receipt: TaxReceiptCreate, db: Session = Depends(get_db)):
+def update_tax_receipt(tax_receipt_id: int, tax_receipt: TaxReceiptCreate, db: Session = Depends(get_write_db)):
     db_tax_receipt = db.query(TaxReceipt).filter(TaxReceipt.id == tax_receipt_id).first()
     if db_tax_receipt is None:
         raise HTTPException(status_code=404, detail="Tax receipt not found")
 
-    # Check if donation exists
-    donation = db.query(Donation).filter(Donation.id == tax_receipt.donor_id).first()
-    if not donation:
+    # Check if donation exists (and lock it against a concurrent delete)
+    if not db.scalar(select(donation_exists(tax_receipt.donor_id))):
         raise HTTPException(status_code=404, detail="Donation not found")
 
     for key, value in tax_receipt.dict().items():
         setattr(db_tax_receipt, key, value)
 
-    db_tax_receipt.updated_at = datetime.now()
+    db_tax_receipt.updated_at = func.now()
     db.commit()
     db.refresh(db_tax_receipt)
     return db_tax_receipt
 
 
+@app.patch("/tax-receipts/{tax_receipt_id}", response_model=TaxReceiptResponse, tags=["Tax Receipts"])
+def patch_tax_receipt(tax_receipt_id: int, tax_receipt: TaxReceiptUpdate, response: Response,
+                      if_match: Optional[str] = Header(None), db: Session = Depends(get_write_db)):
+    changes = patch_changes(tax_receipt, TaxReceiptCreate)
+    # Check the donation only when it changes (donor_id refers to donations, see TaxReceiptBase)
+    guards = (donation_exists(changes["donor_id"]),) if "donor_id" in changes else ()
+    db_tax_receipt = patch_row(db, TaxReceipt, tax_receipt_id, changes, if_match, "Tax receipt not found", guards)
+    if db_tax_receipt is None:
+        raise HTTPException(status_code=404, detail="Donation not found")
+
+    db.commit()
+    set_etag(response, db_tax_receipt)
+    return db_tax_receipt
+
+
 @app.delete("/tax-receipts/{tax_receipt_id}", response_model=TaxReceiptResponse, tags=["Tax Receipts"])
-def delete_tax_receipt(tax_receipt_id: int, db: Session = Depends(get_db)):
+def delete_tax_receipt(tax_receipt_id: int, db: Session = Depends(get_write_db)):
     tax_receipt = db.query(TaxReceipt).filter(TaxReceipt.id == tax_receipt_id).first()
     if tax_receipt is None:
         raise HTTPException(status_code=404, detail="Tax receipt not found")
@@ -509,32 +940,75 @@ def delete_tax_receipt(tax_receipt_id: int, db: Session = Depends(get_db)):
 
 # Thank You Notes
 @app.post("/thank-you-notes/", response_model=ThankYouNoteResponse, tags=["Thank You Notes"])
-def create_thank_you_note(thank_you_note: ThankYouNoteCreate, db: Session = Depends(get_db)):
-    # Check if donor exists
-    donor = db.query(Donor).filter(Donor.id == thank_you_note.donor_id).first()
-    if not donor:
-        raise HTTPException(status_code=404, detail="Donor not found")
-
-    # Check if donation exists
-    donation = db.query(Donation).filter(Donation.id == thank_you_note.donation_id).first()
-    if not donation:
+def create_thank_you_note(thank_you_note: ThankYouNoteCreate, db: Session = Depends(get_write_db)):
+    # The donation check is part of the INSERT: once donations is partitioned there is no foreign key for it
+    notes = ThankYouNote.__table__
+    values = thank_you_note.dict()
+    row = select(*[literal(value, notes.c[key].type) for key, value in values.items()]) \
+        .where(donation_exists(thank_you_note.donation_id))
+    db_thank_you_note = write_returning(db, insert(notes).from_select(list(values), row), ThankYouNote)
+    if db_thank_you_note is None:
         raise HTTPException(status_code=404, detail="Donation not found")
 
-    db_thank_you_note = ThankYouNote(**thank_you_note.dict())
-    db.add(db_thank_you_note)
     db.commit()
-    db.refresh(db_thank_you_note)
     return db_thank_you_note
 
+# Create thank-you notes for every pending donation matching a filter, in a background job
+@app.post("/thank-you-notes/campaign/", response_model=JobResponse, status_code=202, tags=["Thank You Notes"])
+def create_thank_you_campaign(campaign: ThankYouCampaignCreate, db: Session = Depends(get_db)):
+    import campaigns
+
+    if campaign.template_used not in campaigns.TEMPLATES:
+        raise HTTPException(status_code=422, detail=f"template_used must be one of: {', '.join(campaigns.TEMPLATES)}")
+
+    return jobs.submit_job(db, "thank_you_campaign", campaign.model_dump(mode="json"))
+
+# Mark many thank you notes as sent, by id list or filter
+@app.post("/thank-you-notes/mark-sent/", response_model=MarkSentResponse, tags=["Thank You Notes"])
+def mark_thank_you_notes_sent(request: ThankYouNoteMarkSent, db: Session = Depends(get_write_db)):
+    conditions = []
+    if request.ids is not None:
+        conditions.append(ThankYouNote.id.in_(request.ids))
+
+    if request.filter:
+        if request.filter.donor_id:
+            conditions.append(ThankYouNote.donor_id == request.filter.donor_id)
+        if request.filter.donation_id:
+            conditions.append(ThankYouNote.donation_id == request.filter.donation_id)
+        if request.filter.method:
+            conditions.append(ThankYouNote.method == request.filter.method)
+        if request.filter.template_used:
+            conditions.append(ThankYouNote.template_used == request.filter.template_used)
+        if request.filter.created_after:
+            conditions.append(ThankYouNote.created_at >= request.filter.created_after)
+        if request.filter.created_before:
+            conditions.append(ThankYouNote.created_at <= request.filter.created_before)
+
+    # unsent_only on its own would still match every unsent row
+    if not conditions:
+        raise HTTPException(status_code=422, detail="Provide ids or at least one filter field")
+    if request.filter and request.filter.unsent_only:
+        conditions.append(ThankYouNote.sent_date.is_(None))
+
+    values = {"sent_date": request.sent_date}
+    if request.method:
+        values["method"] = request.method
+
+    return mark_sent(db, ThankYouNote, conditions, values, request.dry_run)
+
+
 @app.get("/thank-you-notes/", response_model=List[ThankYouNoteResponse], tags=["Thank You Notes"])
 def read_thank_you_notes(
+        response: Response,
         skip: int = 0,
         limit: int = 100,
         donor_id: Optional[int] = None,
         donation_id: Optional[int] = None,
         sent: Optional[bool] = None,
         method: Optional[str] = None,
-        db: Session = Depends(get_db)
+        fields: Optional[str] = None,
+        count: Optional[str] = None,
+        db: Session = Depends(get_read_db)
 ):
     query = db.query(ThankYouNote)
 
@@ -553,49 +1027,60 @@ def read_thank_you_notes(
     if method:
         query = query.filter(ThankYouNote.method == method)
 
-    return query.offset(skip).limit(limit).all()
+    query, selected = select_fields(query, ThankYouNote, ThankYouNoteResponse, fields)
+    headers = set_total_count(response, db, query, count)
+    rows = query.offset(skip).limit(limit).all()
+    return fields_response(rows, headers) if selected else rows
 
 
 @app.get("/thank-you-notes/{thank_you_note_id}", response_model=ThankYouNoteResponse, tags=["Thank You Notes"])
-def read_thank_you_note(thank_you_note_id: int, db: Session = Depends(get_db)):
-    thank_you_note = db.query(ThankYouNote).filter(ThankYouNote.id == thank_you_note_id).first()
-    if thank_you_note is None:
-        raise HTTPException(status_code=404, detail="Thank you note not found")
-    return thank_you_note
+def read_thank_you_note(thank_you_note_id: int, response: Response, fields: Optional[str] = None, db: Session = Depends(get_read_db)):
+    return read_one(db.query(ThankYouNote).filter(ThankYouNote.id == thank_you_note_id), ThankYouNote, ThankYouNoteResponse, fields, response, "Thank you note not found")
 
 
 @app.put("/thank-you-notes/{thank_you_note_id}", response_model=ThankYouNoteResponse, tags=["Thank You Notes"])
-def update_thank_you_note(thank_you_note_id: int, thank_you_note: ThankYouNoteCreate, db: Session = Depends(get_db)):
-    db_thank_you_note = db.query(ThankYouNote).filter(ThankYouNote.id == thank_you_note_id).first()
+def update_thank_you_note(thank_you_note_id: int, thank_you_note: ThankYouNoteCreate, db: Session = Depends(get_write_db)):
+    notes = ThankYouNote.__table__
+    db_thank_you_note = write_returning(
+        db,
+        update(notes)
+        .where(notes.c.id == thank_you_note_id, donation_exists(thank_you_note.donation_id))
+        .values(**thank_you_note.dict(), updated_at=func.now()),
+        ThankYouNote,
+    )
     if db_thank_you_note is None:
-        raise HTTPException(status_code=404, detail="Thank you note not found")
+        # Only the failure path pays for finding out which row was missing
+        if db.get(ThankYouNote, thank_you_note_id) is None:
+            raise HTTPException(status_code=404, detail="Thank you note not found")
+        raise HTTPException(status_code=404, detail="Donation not found")
 
-    # Check if donor exists
-    donor = db.query(Donor).filter(Donor.id == thank_you_note.donor_id).first()
-    if not donor:
-        raise HTTPException(status_code=404, detail="Donor not found")
+    db.commit()
+    return db_thank_you_note
 
-    # Check if donation exists
-    donation = db.query(Donation).filter(Donation.id == thank_you_note.donation_id).first()
-    if not donation:
-        raise HTTPException(status_code=404, detail="Donation not found")
 
-    for key, value in thank_you_note.dict().items():
-        setattr(db_thank_you_note, key, value)
+@app.patch("/thank-you-notes/{thank_you_note_id}", response_model=ThankYouNoteResponse, tags=["Thank You Notes"])
+def patch_thank_you_note(thank_you_note_id: int, thank_you_note: ThankYouNoteUpdate, response: Response,
+                         if_match: Optional[str] = Header(None), db: Session = Depends(get_write_db)):
+    changes = patch_changes(thank_you_note, ThankYouNoteCreate)
+    # Check the donation only when it changes
+    guards = (donation_exists(changes["donation_id"]),) if "donation_id" in changes else ()
+    db_thank_you_note = patch_row(db, ThankYouNote, thank_you_note_id, changes, if_match,
+                                  "Thank you note not found", guards)
+    if db_thank_you_note is None:
+        raise HTTPException(status_code=404, detail="Donation not found")
 
-    db_thank_you_note.updated_at = datetime.now()
     db.commit()
-    db.refresh(db_thank_you_note)
+    set_etag(response, db_thank_you_note)
     return db_thank_you_note
 
 
 @app.delete("/thank-you-notes/{thank_you_note_id}", response_model=ThankYouNoteResponse, tags=["Thank You Notes"])
-def delete_thank_you_note(thank_you_note_id: int, db: Session = Depends(get_db)):
-    thank_you_note = db.query(ThankYouNote).filter(ThankYouNote.id == thank_you_note_id).first()
+def delete_thank_you_note(thank_you_note_id: int, db: Session = Depends(get_write_db)):
+    notes = ThankYouNote.__table__
+    thank_you_note = write_returning(db, delete(notes).where(notes.c.id == thank_you_note_id), ThankYouNote)
     if thank_you_note is None:
         raise HTTPException(status_code=404, detail="Thank you note not found")
 
-    db.delete(thank_you_note)
     db.commit()
     return thank_you_note
 
@@ -604,7 +1089,7 @@ def delete_thank_you_note(thank_you_note_id: int, db: Session = Depends(get_db))
 
 # Get donation summary by program
 @app.get("/reports/donations-by-program/", tags=["Reports"])
-def get_donations_by_program(db: Session = Depends(get_db)):
+def get_donations_by_program(db: Session = Depends(get_report_db)):
     programs = db.query(Program).all()
     result = []
 
@@ -628,7 +1113,7 @@ def get_donations_by_program(db: Session = Depends(get_db)):
 
 # Get donation summary by donor
 @app.get("/reports/donations-by-donor/", tags=["Reports"])
-def get_donations_by_donor(db: Session = Depends(get_db)):
+def get_donations_by_donor(db: Session = Depends(get_report_db)):
     donors = db.query(Donor).all()
     result = []
 
@@ -651,7 +1136,7 @@ def get_donations_by_donor(db: Session = Depends(get_db)):
 
 # Get unfulfilled pledges
 @app.get("/reports/unfulfilled-pledges/", tags=["Reports"])
-def get_unfulfilled_pledges(db: Session = Depends(get_db)):
+def get_unfulfilled_pledges(db: Session = Depends(get_report_db)):
     unfulfilled_pledges = db.query(Pledge).filter(
         (Pledge.amount_fulfilled < Pledge.amount) |
         (Pledge.status != "fulfilled")
@@ -680,7 +1165,7 @@ def get_unfulfilled_pledges(db: Session = Depends(get_db)):
 
 # Get pending thank you notes
 @app.get("/reports/pending-thank-you-notes/", tags=["Reports"])
-def get_pending_thank_you_notes(db: Session = Depends(get_db)):
+def get_pending_thank_you_notes(db: Session = Depends(get_report_db)):
     # Find donations without thank you notes
     donations = db.query(Donation).all()
     result = []
@@ -703,56 +1188,432 @@ def get_pending_thank_you_notes(db: Session = Depends(get_db)):
     return result
 
 
-# Generate tax receipts for a specific year
-@app.post("/tax-receipts/generate-for-year/", response_model=List[TaxReceiptResponse], tags=["Tax Receipts"])
+# Get donation totals per program over time from the rollup tables
+@app.get("/reports/donations-timeseries/", tags=["Reports"])
+def get_donations_timeseries(
+        granularity: str = "month",
+        start_date: Optional[date] = None,
+        end_date: Optional[date] = None,
+        program_id: Optional[int] = None,
+        db: Session = Depends(get_report_db)
+):
+    if granularity not in GRANULARITIES:
+        raise HTTPException(status_code=422, detail=f"granularity must be one of: {', '.join(GRANULARITIES)}")
+
+    return [
+        {
+            "program_id": row["program_id"],
+            "bucket_date": row["bucket_date"],
+            "total_amount": float(row["total_amount"]),
+            "gift_count": row["gift_count"],
+            "distinct_donors": row["distinct_donors"]
+        }
+        for row in read_timeseries(db, granularity, start_date, end_date, program_id)
+    ]
+
+
+# Donor retention, computed on the in-memory donation snapshot (see analytics.py).
+# analytics is imported on first use so NumPy doesn't slow down every cold start.
+@app.get("/reports/retention/summary/", tags=["Reports"])
+def get_retention_summary(program_id: Optional[int] = None, db: Session = Depends(get_report_db)):
+    import analytics
+
+    return analytics.retention_summary(analytics.donor_years(db, program_id))
+
+
+# Donors who gave last year but not this year
+@app.get("/reports/retention/lybunt/", tags=["Reports"])
+def get_lybunt_donors(
+        year: Optional[int] = None,
+        program_id: Optional[int] = None,
+        skip: int = 0,
+        limit: int = Query(100, le=1000),
+        db: Session = Depends(get_report_db)
+):
+    import analytics
+
+    pairs = analytics.donor_years(db, program_id)
+    return analytics.donor_list(db, pairs, year or date.today().year, "lybunt", limit, skip, program_id)
+
+
+# Donors who gave in some earlier year but not last year or this year
+@app.get("/reports/retention/sybunt/", tags=["Reports"])
+def get_sybunt_donors(
+        year: Optional[int] = None,
+        program_id: Optional[int] = None,
+        skip: int = 0,
+        limit: int = Query(100, le=1000),
+        db: Session = Depends(get_report_db)
+):
+    import analytics
+
+    pairs = analytics.donor_years(db, program_id)
+    return analytics.donor_list(db, pairs, year or date.today().year, "sybunt", limit, skip, program_id)
+
+
+@app.get("/reports/retention/cohorts/", tags=["Reports"])
+def get_retention_cohorts(program_id: Optional[int] = None, db: Session = Depends(get_report_db)):
+    import analytics
+
+    return analytics.cohorts(analytics.donor_years(db, program_id))
+
+
+# Donors who gave more, less or the same as the year before
+@app.get("/reports/retention/upgrades/", tags=["Reports"])
+def get_retention_upgrades(
+        year: Optional[int] = None,
+        program_id: Optional[int] = None,
+        db: Session = Depends(get_report_db)
+):
+    import analytics
+
+    return analytics.upgrades(analytics.donor_years(db, program_id), year or date.today().year)
+
+
+# Donors by RFM segment or score (refreshed with `python segments.py refresh` or a donor_segments job)
+@app.get("/reports/donor-segments/", tags=["Reports"])
+def get_donor_segments(
+        response: Response,
+        segment: Optional[str] = None,
+        r_score: Optional[int] = Query(None, ge=1, le=5),
+        f_score: Optional[int] = Query(None, ge=1, le=5),
+        m_score: Optional[int] = Query(None, ge=1, le=5),
+        skip: int = 0,
+        limit: int = Query(100, le=1000),
+        count: Optional[str] = None,
+        db: Session = Depends(get_report_db)
+):
+    import segments
+
+    if segment and segment not in segments.SEGMENTS:
+        raise HTTPException(status_code=422, detail=f"segment must be one of: {', '.join(segments.SEGMENTS)}")
+
+    query = db.query(DonorSegment, Donor).join(Donor, Donor.id == DonorSegment.donor_id)
+
+    if segment:
+        query = query.filter(DonorSegment.segment == segment)
+
+    if r_score:
+        query = query.filter(DonorSegment.r_score == r_score)
+
+    if f_score:
+        query = query.filter(DonorSegment.f_score == f_score)
+
+    if m_score:
+        query = query.filter(DonorSegment.m_score == m_score)
+
+    set_total_count(response, db, query, count)
+    rows = query.order_by(DonorSegment.total_amount.desc(), DonorSegment.donor_id).offset(skip).limit(limit).all()
+    return [
+        {
+            "donor_id": donor.id,
+            "donor_name": f"{donor.first_name} {donor.last_name}" if donor.donor_type == "individual" else donor.organization_name,
+            "email": donor.email,
+            "segment": donor_segment.segment,
+            "r_score": donor_segment.r_score,
+            "f_score": donor_segment.f_score,
+            "m_score": donor_segment.m_score,
+            "last_donation_date": donor_segment.last_donation_date,
+            "gift_count": donor_segment.gift_count,
+            "total_amount": float(donor_segment.total_amount),
+            "computed_at": donor_segment.computed_at
+        }
+        for donor_segment, donor in rows
+    ]
+
+
+@app.get("/reports/donor-segments/summary/", tags=["Reports"])
+def get_donor_segment_summary(db: Session = Depends(get_report_db)):
+    import segments
+
+    rows = {
+        row.segment: row for row in db.query(
+            DonorSegment.segment,
+            func.count().label("donors"),
+            func.sum(DonorSegment.total_amount).label("total_amount"),
+            func.max(DonorSegment.computed_at).label("computed_at")
+        ).group_by(DonorSegment.segment)
+    }
+    return [
+        {
+            "segment": segment,
+            "description": description,
+            "donors": rows[segment].donors if segment in rows else 0,
+            "total_amount": float(rows[segment].total_amount) if segment in rows else 0.0,
+            "computed_at": rows[segment].computed_at if segment in rows else None
+        }
+        for segment, description in segments.SEGMENTS.items()
+    ]
+
+
+GEOGRAPHY_LEVELS = ("country", "state", "city", "postal_code")
+
+
+# Donation totals at every level from country down to postal code, in one ROLLUP query
+@app.get("/reports/donations-by-geography/", tags=["Reports"])
+def get_donations_by_geography(
+        start_date: Optional[date] = None,
+        end_date: Optional[date] = None,
+        program_id: Optional[int] = None,
+        level: str = "postal_code",
+        db: Session = Depends(get_report_db)
+):
+    if level not in GEOGRAPHY_LEVELS:
+        raise HTTPException(status_code=422, detail=f"level must be one of: {', '.join(GEOGRAPHY_LEVELS)}")
+
+    # Only roll up as deep as the requested level
+    columns = [getattr(Donor, name) for name in GEOGRAPHY_LEVELS[:GEOGRAPHY_LEVELS.index(level) + 1]]
+    groupings = [func.grouping(column) for column in columns]
+    query = select(
+        *columns,
+        *groupings,
+        # The grand total row is returned even when nothing matches
+        func.coalesce(func.sum(Donation.amount), 0),
+        func.count(),
+        func.count(Donation.donor_id.distinct())
+    ).join(Donor, Donor.id == Donation.donor_id)
+
+    if start_date:
+        query = query.where(Donation.donation_date >= start_date)
+
+    if end_date:
+        query = query.where(Donation.donation_date <= end_date)
+
+    if program_id:
+        query = query.where(Donation.program_id == program_id)
+
+    # Each subtotal comes right before the rows it sums up; the grand total comes first
+    order = []
+    for column, grouping in zip(columns, groupings):
+        order += [grouping.desc(), column]
+    query = query.group_by(func.rollup(*columns)).order_by(*order)
+
+    result = []
+    for row in db.execute(query):
+        values, grouped = row[:len(columns)], row[len(columns):2 * len(columns)]
+        depth = grouped.count(0)
+        result.append({
+            "level": GEOGRAPHY_LEVELS[depth - 1] if depth else "total",
+            **{name: value for name, value in zip(GEOGRAPHY_LEVELS[:depth], values)},
+            "total_amount": float(row[-3]),
+            "gift_count": row[-2],
+            "donor_count": row[-1]
+        })
+    return result
+
+
+# Donors who gave the most, from donor_totals (rebuilt with `python leaderboards.py rebuild`)
+@app.get("/reports/leaderboards/donors/", tags=["Reports"])
+def get_top_donors(
+        program_id: Optional[int] = None,
+        year: Optional[int] = None,
+        limit: int = Query(10, ge=1, le=1000),
+        db: Session = Depends(get_report_db)
+):
+    return leaderboards.top_donors(db, limit, program_id, year)
+
+
+# Largest single donations
+@app.get("/reports/leaderboards/gifts/", tags=["Reports"])
+def get_top_gifts(
+        program_id: Optional[int] = None,
+        year: Optional[int] = None,
+        limit: int = Query(10, ge=1, le=1000),
+        db: Session = Depends(get_report_db)
+):
+    return leaderboards.top_gifts(db, limit, program_id, year)
+
+
+# Dashboard summaries in one round trip; the sections run concurrently (see dashboard.py)
+@app.get("/reports/dashboard/", tags=["Reports"])
+def get_dashboard(sections: Optional[str] = None, limit: int = Query(5, ge=1, le=100)):
+    import dashboard
+
+    names = [name.strip() for name in sections.split(",") if name.strip()] if sections else list(dashboard.SECTIONS)
+    unknown = [name for name in names if name not in dashboard.SECTIONS]
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Unknown sections: {', '.join(unknown)}; "
+                                                    f"choose from: {', '.join(dashboard.SECTIONS)}")
+    return dashboard.build_dashboard(names, limit)
+
+
+# Match a processor/bank statement CSV against donations (see reconciliation.py)
+@app.post("/reports/statement-reconciliation/", tags=["Reports"])
+def reconcile_statement(
+        file: UploadFile = File(...),
+        tolerance_days: Optional[int] = Query(None, ge=0, le=31),
+        start_date: Optional[date] = None,
+        end_date: Optional[date] = None,
+        payment_method: Optional[str] = None,
+        db: Session = Depends(get_report_db)
+):
+    import reconciliation
+
+    if tolerance_days is None:
+        tolerance_days = reconciliation.RECONCILIATION_TOLERANCE_DAYS
+    try:
+        summary = reconciliation.reconcile_statement(db, file.file, tolerance_days, start_date, end_date,
+                                                     payment_method)
+    except reconciliation.StatementError as exc:
+        raise HTTPException(status_code=422, detail=str(exc))
+
+    report = f"/reports/statement-reconciliation/{summary['report_id']}"
+    return {**summary, "files": {name: f"{report}/{name}.csv" for name in reconciliation.RESULT_FILES}}
+
+
+@app.get("/reports/statement-reconciliation/{report_id}", tags=["Reports"])
+def read_statement_reconciliation(report_id: str):
+    import reconciliation
+
+    path = reconciliation.report_path(report_id, "summary.json")
+    if path is None:
+        raise HTTPException(status_code=404, detail="Reconciliation report not found")
+    return FileResponse(path, media_type="application/json")
+
+
+# matched.csv, unmatched_statement.csv or unmatched_database.csv
+@app.get("/reports/statement-reconciliation/{report_id}/{name}", tags=["Reports"])
+def download_statement_reconciliation(report_id: str, name: str):
+    import reconciliation
+
+    path = reconciliation.report_path(report_id, name)
+    if path is None or name == "summary.json":
+        raise HTTPException(status_code=404, detail="Reconciliation report not found")
+    return FileResponse(path, media_type="text/csv", filename=f"reconciliation_{report_id}_{name}")
+
+
+# Generate tax receipts for a specific year's deductible donations in a background job
+@app.post("/tax-receipts/generate-for-year/", response_model=JobResponse, status_code=202, tags=["Tax Receipts"])
 def generate_tax_receipts_for_year(year: int, db: Session = Depends(get_db)):
-    # Get all tax-deductible donations for the year without tax receipts
-    start_date = date(year, 1, 1)
-    end_date = date(year, 12, 31)
-
-    donations = db.query(Donation).filter(
-        Donation.donation_date >= start_date,
-        Donation.donation_date <= end_date,
-        Donation.is_tax_deductible == True
-    ).all()
+    return jobs.submit_job(db, "tax_receipts", {"year": year})
 
-    # Group donations by donor
-    donor_donations = {}
-    for donation in donations:
-        # Check if a tax receipt already exists for this donation
-        existing_receipt = db.query(TaxReceipt).filter(TaxReceipt.donor_id == donation.id).first()
-        if existing_receipt:
-            continue
-
-        if donation.donor_id not in donor_donations:
-            donor_donations[donation.donor_id] = []
-        donor_donations[donation.donor_id].append(donation)
-
-    # Create tax receipts
-    generated_receipts = []
-    for donor_id, donations in donor_donations.items():
-        for donation in donations:
-            tax_receipt = TaxReceipt(
-                donor_id=donation.id,  # This field actually stores donation_id
-                year_donated=start_date,  # First day of the year
-                total_amount=donation.amount,
-                generated_date=date.today(),
-                sent_date=None
-            )
-            db.add(tax_receipt)
-            db.commit()
-            db.refresh(tax_receipt)
-            generated_receipts.append(tax_receipt)
-
-    return generated_receipts
+
+# Change feed for incremental sync; always read from the primary so replica lag cannot skip changes
+@app.get("/changes/{entity}", tags=["Changes"])
+def read_changes(
+        entity: str,
+        cursor: Optional[str] = None,
+        limit: int = Query(500, ge=1, le=changes.MAX_PAGE_SIZE),
+        db: Session = Depends(get_db)
+):
+    if entity not in changes.FEEDS:
+        raise HTTPException(status_code=404, detail=f"No change feed for {entity}. Available: {', '.join(changes.FEEDS)}")
+    try:
+        return changes.read_changes(db, entity, cursor, limit)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+
+# Background jobs
+@app.post("/jobs/", response_model=JobResponse, status_code=202, tags=["Jobs"])
+def create_job(job: JobCreate, db: Session = Depends(get_db)):
+    if jobs.get_handler(job.kind) is None:
+        raise HTTPException(status_code=422, detail=f"Unknown job kind. Available: {', '.join(jobs.job_kinds())}")
+    return jobs.submit_job(db, job.kind, job.params)
+
+
+@app.get("/jobs/", response_model=List[JobResponse], tags=["Jobs"])
+def read_jobs(
+        response: Response,
+        skip: int = 0,
+        limit: int = 100,
+        kind: Optional[str] = None,
+        status: Optional[str] = None,
+        count: Optional[str] = None,
+        db: Session = Depends(get_db)
+):
+    query = db.query(Job)
+
+    if kind:
+        query = query.filter(Job.kind == kind)
+
+    if status:
+        query = query.filter(Job.status == status)
+
+    set_total_count(response, db, query, count)
+    return query.order_by(Job.id.desc()).offset(skip).limit(limit).all()
+
+
+# Job status is polled right after submission, so it is always read from the primary
+@app.get("/jobs/{job_id}", response_model=JobResponse, tags=["Jobs"])
+def read_job(job_id: int, db: Session = Depends(get_db)):
+    job = db.query(Job).filter(Job.id == job_id).first()
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/jobs/{job_id}/result", tags=["Jobs"])
+def read_job_result(job_id: int, db: Session = Depends(get_db)):
+    job = db.query(Job).filter(Job.id == job_id).first()
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status not in jobs.FINISHED_STATUSES:
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    return {"job_id": job.id, "status": job.status, "result": job.result, "error": job.error}
+
+
+@app.post("/jobs/{job_id}/cancel", response_model=JobResponse, tags=["Jobs"])
+def cancel_job(job_id: int, db: Session = Depends(get_db)):
+    job = db.query(Job).filter(Job.id == job_id).first()
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status in jobs.FINISHED_STATUSES:
+        raise HTTPException(status_code=409, detail=f"Job is already {job.status}")
+    return jobs.cancel_job(db, job)
+
+
+@app.post("/jobs/{job_id}/retry", response_model=JobResponse, status_code=202, tags=["Jobs"])
+def retry_job(job_id: int, db: Session = Depends(get_db)):
+    job = db.query(Job).filter(Job.id == job_id).first()
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status not in ("failed", "cancelled"):
+        raise HTTPException(status_code=409, detail=f"Only failed or cancelled jobs can be retried; job is {job.status}")
+    return jobs.retry_job(db, job)
+
+
+# Generate one annual statement per donor in a background job
+@app.post("/tax-receipts/annual-statements/", response_model=JobResponse, status_code=202, tags=["Tax Receipts"])
+def generate_annual_statements(
+        year: int,
+        shards: Optional[int] = None,
+        formats: str = "txt,html",
+        db: Session = Depends(get_db)
+):
+    import statements
+
+    requested_formats = [name.strip() for name in formats.split(",") if name.strip()]
+    unknown = [name for name in requested_formats if name not in statements.STATEMENT_FORMATS]
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Unknown formats: {', '.join(unknown)}")
+
+    return jobs.submit_job(db, "annual_statements", {"year": year, "shards": shards, "formats": requested_formats})
 
 
 # Create and setup the database tables
 @app.on_event("startup")
 async def startup():
-    # Create tables if they don't exist
-    Base.metadata.create_all(bind=engine)
+    # No DDL here: the schema is created and upgraded with `python migrate.py`
+    server.configure_threadpool()
+    await run_in_threadpool(server.warm_up_pools)
+    # Resume queued and interrupted background jobs
+    jobs.start_worker()
+    progress_hub.start(asyncio.get_running_loop())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    jobs.stop_worker()
+    progress_hub.stop()
+    server.dispose_pools()
 
 # Run the application
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    if os.getenv("APP_ENV") == "production":
+        # Multi-worker server configured from the environment (see server.py)
+        server.run()
+    else:
+        import uvicorn
+
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
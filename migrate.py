@@ -0,0 +1,91 @@
+# migrate.py
+"""Versioned schema migrations.
+
+Each file in migrations/ is applied once, in file name order, in its own
+transaction, and recorded in the schema_migrations table. A session advisory
+lock makes concurrent runs (several instances deploying at once) wait for each
+other. The application never runs DDL itself; run this before starting a release.
+
+Every migration uses ``if not exists``, so running them on a database that was
+set up by hand (DDL_of_db.sql and psql) only records them as applied.
+
+Usage:
+    python migrate.py            # apply pending migrations
+    python migrate.py status     # list applied and pending migrations
+"""
+import os
+import sys
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+LOCK_KEY = "schema_migrations"
+
+CREATE_TABLE_SQL = text("""
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version    varchar(200) PRIMARY KEY,
+        applied_at timestamp with time zone NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+""")
+
+
+def available() -> list:
+    """Migration versions on disk (file names without .sql), in order."""
+    return sorted(name.removesuffix(".sql") for name in os.listdir(MIGRATIONS_DIR) if name.endswith(".sql"))
+
+
+def applied(connection) -> set:
+    return set(connection.scalars(text("SELECT version FROM schema_migrations")))
+
+
+def migrate(engine: Engine) -> list:
+    """Apply the pending migrations; returns their versions."""
+    done = []
+    with engine.connect() as connection:
+        connection.execute(text("SELECT pg_advisory_lock(hashtext(:key))"), {"key": LOCK_KEY})
+        try:
+            connection.execute(CREATE_TABLE_SQL)
+            connection.commit()
+            for version in available():
+                if version in applied(connection):
+                    continue
+                with open(os.path.join(MIGRATIONS_DIR, f"{version}.sql")) as file:
+                    connection.exec_driver_sql(file.read())
+                connection.execute(text("INSERT INTO schema_migrations (version) VALUES (:version)"),
+                                   {"version": version})
+                connection.commit()
+                done.append(version)
+        finally:
+            connection.rollback()
+            connection.execute(text("SELECT pg_advisory_unlock(hashtext(:key))"), {"key": LOCK_KEY})
+            connection.commit()
+    return done
+
+
+def status(engine: Engine) -> dict:
+    """Each migration version on disk and whether it has been applied."""
+    with engine.connect() as connection:
+        connection.execute(CREATE_TABLE_SQL)
+        connection.commit()
+        versions = applied(connection)
+    return {version: version in versions for version in available()}
+
+
+if __name__ == "__main__":
+    from models import engine
+
+    if sys.argv[1:] == []:
+        applied_now = migrate(engine)
+        for version in applied_now:
+            print(f"applied {version}")
+        print(f"{len(applied_now)} migration(s) applied; schema is up to date")
+    elif sys.argv[1:] == ["status"]:
+        for version, is_applied in status(engine).items():
+            print(f"{'applied' if is_applied else 'pending':<8} {version}")
+    else:
+        sys.exit("usage: python migrate.py [status]")
@@ -0,0 +1,29 @@
+-- Daily and monthly donation rollups per program, kept current by the donation endpoints.
+-- Populate existing data afterwards with: python rollups.py rebuild
+create table if not exists public.donation_daily_rollups
+(
+    program_id      integer        not null
+        references public.programs on delete cascade,
+    bucket_date     date           not null,
+    total_amount    numeric(14, 2) not null,
+    gift_count      integer        not null,
+    distinct_donors integer        not null,
+    updated_at      timestamp with time zone default CURRENT_TIMESTAMP,
+    primary key (program_id, bucket_date)
+);
+
+create table if not exists public.donation_monthly_rollups
+(
+    program_id      integer        not null
+        references public.programs on delete cascade,
+    bucket_date     date           not null,
+    total_amount    numeric(14, 2) not null,
+    gift_count      integer        not null,
+    distinct_donors integer        not null,
+    updated_at      timestamp with time zone default CURRENT_TIMESTAMP,
+    primary key (program_id, bucket_date)
+);
+
+-- Recomputing one bucket reads a single program's donations for a day or month
+create index if not exists ix_donations_program_id_donation_date
+    on public.donations (program_id, donation_date);
@@ -0,0 +1,22 @@
+-- Background jobs run by the in-process worker pool (see jobs.py).
+create table if not exists public.jobs
+(
+    id               serial
+        primary key,
+    kind             varchar(50) not null,
+    status           varchar(20) not null     default 'queued',
+    params           jsonb,
+    progress         double precision not null default 0,
+    checkpoint       jsonb,
+    result           jsonb,
+    error            text,
+    cancel_requested boolean     not null     default false,
+    heartbeat_at     timestamp with time zone,
+    started_at       timestamp with time zone,
+    finished_at      timestamp with time zone,
+    created_at       timestamp with time zone default CURRENT_TIMESTAMP,
+    updated_at       timestamp with time zone default CURRENT_TIMESTAMP
+);
+
+-- Workers look for queued jobs and stale running jobs on startup
+create index if not exists ix_jobs_status on public.jobs (status) where status in ('queued', 'running');
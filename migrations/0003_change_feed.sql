@@ -0,0 +1,15 @@
+-- Change feed (GET /changes/{entity}): keyset scans on updated_at plus a tombstone table for deletes.
+create index if not exists ix_donors_updated_at_id on public.donors (updated_at, id);
+create index if not exists ix_donations_updated_at_id on public.donations (updated_at, id);
+create index if not exists ix_pledges_updated_at_id on public.pledges (updated_at, id);
+
+create table if not exists public.tombstones
+(
+    id         serial
+        primary key,
+    entity     varchar(50)              not null,
+    entity_id  integer                  not null,
+    deleted_at timestamp with time zone not null default CURRENT_TIMESTAMP
+);
+
+create index if not exists ix_tombstones_entity_deleted_at_id on public.tombstones (entity, deleted_at, id);
@@ -0,0 +1,14 @@
+-- Idempotency-Key support for POST /donations/ (see idempotency.py).
+create table if not exists public.idempotency_keys
+(
+    endpoint     varchar(100)             not null,
+    key          varchar(255)             not null,
+    request_hash varchar(64)              not null,
+    status_code  integer                  not null,
+    response     jsonb                    not null,
+    created_at   timestamp with time zone not null default CURRENT_TIMESTAMP,
+    primary key (endpoint, key)
+);
+
+-- Expired keys are purged by `python idempotency.py purge`
+create index if not exists ix_idempotency_keys_created_at on public.idempotency_keys (created_at);
@@ -0,0 +1,18 @@
+-- RFM donor segments, replaced by `python segments.py refresh` or a donor_segments job (see segments.py).
+create table if not exists public.donor_segments
+(
+    donor_id           integer      not null
+        primary key
+        references public.donors on delete cascade,
+    last_donation_date date         not null,
+    gift_count         integer      not null,
+    total_amount       numeric(14, 2) not null,
+    r_score            smallint     not null,
+    f_score            smallint     not null,
+    m_score            smallint     not null,
+    segment            varchar(30)  not null,
+    computed_at        timestamp with time zone not null default CURRENT_TIMESTAMP
+);
+
+create index if not exists ix_donor_segments_segment_total on public.donor_segments (segment, total_amount desc);
+create index if not exists ix_donor_segments_scores on public.donor_segments (r_score, f_score, m_score);
@@ -0,0 +1,25 @@
+-- Pledge fulfillment reconciliation (see fulfillment.py): donation-to-pledge allocations and the incremental run checkpoint.
+create table if not exists public.pledge_allocations
+(
+    pledge_id     integer        not null,
+    donation_id   integer        not null,
+    donor_id      integer        not null,
+    amount        numeric(10, 2) not null,
+    donation_date date           not null,
+    primary key (pledge_id, donation_id)
+);
+
+create index if not exists ix_pledge_allocations_donor_id on public.pledge_allocations (donor_id);
+create index if not exists ix_pledge_allocations_donation_id on public.pledge_allocations (donation_id);
+
+create table if not exists public.reconciliation_checkpoints
+(
+    name         varchar(50)              not null
+        primary key,
+    synced_until timestamp with time zone not null,
+    updated_at   timestamp with time zone default CURRENT_TIMESTAMP
+);
+
+-- Reconciliation reads a donor's pledges and donations in date order
+create index if not exists ix_pledges_donor_id_pledge_date on public.pledges (donor_id, pledge_date, id);
+create index if not exists ix_donations_donor_id_donation_date on public.donations (donor_id, donation_date, id);
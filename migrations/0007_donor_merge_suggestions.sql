@@ -0,0 +1,18 @@
+-- Duplicate donor suggestions, replaced by `python dedup.py scan` or a donor_dedup job (see dedup.py).
+create table if not exists public.donor_merge_suggestions
+(
+    id           serial
+        primary key,
+    donor_id     integer      not null
+        references public.donors on delete cascade,
+    duplicate_id integer      not null
+        references public.donors on delete cascade,
+    score        double precision not null,
+    reasons      varchar(100) not null,
+    status       varchar(20)  not null default 'open',
+    created_at   timestamp with time zone default CURRENT_TIMESTAMP,
+    unique (donor_id, duplicate_id)
+);
+
+create index if not exists ix_donor_merge_suggestions_status_score on public.donor_merge_suggestions (status, score desc);
+create index if not exists ix_donor_merge_suggestions_duplicate_id on public.donor_merge_suggestions (duplicate_id);
@@ -0,0 +1,7 @@
+-- Supporting indexes for /reports/donations-by-geography/.
+-- A date-filtered report reads donations by donation_date without visiting the heap, and the join to donors
+-- reads the location columns from the index as well (index-only scans once the tables are vacuumed).
+create index if not exists ix_donations_donation_date_geography
+    on public.donations (donation_date) include (donor_id, program_id, amount);
+create index if not exists ix_donors_id_location
+    on public.donors (id) include (country, state, city, postal_code);
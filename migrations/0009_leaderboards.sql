@@ -0,0 +1,22 @@
+-- Leaderboards (see leaderboards.py). donor_totals is kept current by the donation endpoints.
+-- Populate existing data afterwards with: python leaderboards.py rebuild
+create table if not exists public.donor_totals
+(
+    donor_id           integer        not null
+        references public.donors on delete cascade,
+    program_id         integer        not null, -- 0 = all programs
+    year               smallint       not null, -- 0 = all years
+    total_amount       numeric(14, 2) not null,
+    gift_count         integer        not null,
+    last_donation_date date           not null,
+    updated_at         timestamp with time zone default CURRENT_TIMESTAMP,
+    primary key (donor_id, program_id, year)
+);
+
+-- Top donors: walk one (program_id, year) slice of the index in leaderboard order
+create index if not exists ix_donor_totals_leaderboard
+    on public.donor_totals (program_id, year, total_amount desc, donor_id);
+
+-- Largest gifts, overall and per program, in leaderboard order
+create index if not exists ix_donations_amount_id on public.donations (amount desc, id);
+create index if not exists ix_donations_program_id_amount_id on public.donations (program_id, amount desc, id);
@@ -0,0 +1,17 @@
+-- Annual giving statements (see statements.py), kept apart from the per-donation tax_receipts
+-- so each kind of document only skips donors or donations that already have that kind
+create table if not exists public.annual_statements
+(
+    id             serial
+        primary key,
+    donor_id       integer        not null
+        references public.donors on delete cascade,
+    year           smallint       not null,
+    total_amount   numeric(14, 2) not null,
+    gift_count     integer        not null,
+    generated_date date           not null default current_date,
+    sent_date      date,
+    created_at     timestamp with time zone default CURRENT_TIMESTAMP
+);
+
+create index if not exists ix_annual_statements_donor_id_year on public.annual_statements (donor_id, year);
@@ -0,0 +1,8 @@
+-- One annual statement per donor and year, enforced by the database so concurrent or replayed
+-- statement shards (see statements.py) insert with on conflict do nothing instead of duplicating
+delete from public.annual_statements a
+    using public.annual_statements b
+where a.donor_id = b.donor_id and a.year = b.year and a.id > b.id;
+
+create unique index if not exists ux_annual_statements_donor_id_year on public.annual_statements (donor_id, year);
+drop index if exists public.ix_annual_statements_donor_id_year;
@@ -1,20 +1,40 @@
 # models.py
+import math
 import os
+import time
 from datetime import date, datetime
 from typing import List, Optional
 
+from fastapi import Request, Response
 from pydantic import BaseModel, EmailStr, Field
-from sqlalchemy import create_engine, Column, Integer, String, Text, Date, Boolean, Float, ForeignKey, TIMESTAMP
+from sqlalchemy import create_engine, event, Column, Integer, String, Text, Date, Boolean, Float, ForeignKey, TIMESTAMP, JSON, UniqueConstraint
 from sqlalchemy.dialects.postgresql import NUMERIC
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship, Session
+from sqlalchemy.orm import declarative_base, sessionmaker, relationship
 
 # Database connection details
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Optional read replica; reads and reports fall back to the primary when unset
+READ_DATABASE_URL = os.getenv("READ_DATABASE_URL") or DATABASE_URL
+# Seconds a client keeps reading from the primary after a write (0 disables read-your-writes)
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "0"))
+# Small dedicated pool for heavy /reports/* queries, so they cannot take every CRUD connection
+REPORT_POOL_SIZE = int(os.getenv("REPORT_POOL_SIZE", "2"))
+# The dashboard's own pool, one connection per section so a dashboard never waits on another report
+DASHBOARD_POOL_SIZE = int(os.getenv("DASHBOARD_POOL_SIZE", "5"))
+# Connection pool size per engine, per worker process
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
 
 # Set up SQLAlchemy
-engine = create_engine(DATABASE_URL)
+engine = create_engine(DATABASE_URL, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+read_engine = (create_engine(READ_DATABASE_URL, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+               if READ_DATABASE_URL != DATABASE_URL else engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+report_engine = create_engine(READ_DATABASE_URL, pool_size=REPORT_POOL_SIZE, max_overflow=0)
+ReportSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=report_engine)
+dashboard_engine = create_engine(READ_DATABASE_URL, pool_size=DASHBOARD_POOL_SIZE, max_overflow=0)
+DashboardSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=dashboard_engine)
 Base = declarative_base()
 
 # This assumes 'app' is your FastAPI instance that's already defined
@@ -135,6 +155,141 @@ class ThankYouNote(Base):
     donation = relationship("Donation", back_populates="thank_you_notes")
 
 
+class DonationDailyRollup(Base):
+    __tablename__ = "donation_daily_rollups"
+
+    program_id = Column(Integer, ForeignKey("programs.id", ondelete="CASCADE"), primary_key=True)
+    bucket_date = Column(Date, primary_key=True)
+    total_amount = Column(NUMERIC(14, 2), nullable=False)
+    gift_count = Column(Integer, nullable=False)
+    distinct_donors = Column(Integer, nullable=False)
+    updated_at = Column(TIMESTAMP(timezone=True), server_default="CURRENT_TIMESTAMP")
+
+
+class DonationMonthlyRollup(Base):
+    __tablename__ = "donation_monthly_rollups"
+
+    program_id = Column(Integer, ForeignKey("programs.id", ondelete="CASCADE"), primary_key=True)
+    bucket_date = Column(Date, primary_key=True)  # First day of the month
+    total_amount = Column(NUMERIC(14, 2), nullable=False)
+    gift_count = Column(Integer, nullable=False)
+    distinct_donors = Column(Integer, nullable=False)
+    updated_at = Column(TIMESTAMP(timezone=True), server_default="CURRENT_TIMESTAMP")
+
+
+class Tombstone(Base):
+    __tablename__ = "tombstones"
+
+    id = Column(Integer, primary_key=True, index=True)
+    entity = Column(String(50), nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    deleted_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default="CURRENT_TIMESTAMP")
+
+
+class DonorSegment(Base):
+    __tablename__ = "donor_segments"
+
+    donor_id = Column(Integer, ForeignKey("donors.id", ondelete="CASCADE"), primary_key=True)
+    last_donation_date = Column(Date, nullable=False)
+    gift_count = Column(Integer, nullable=False)
+    total_amount = Column(NUMERIC(14, 2), nullable=False)
+    r_score = Column(Integer, nullable=False)
+    f_score = Column(Integer, nullable=False)
+    m_score = Column(Integer, nullable=False)
+    segment = Column(String(30), nullable=False)
+    computed_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default="CURRENT_TIMESTAMP")
+
+
+class DonorTotal(Base):
+    __tablename__ = "donor_totals"
+
+    # One row per donor for all gifts (program_id 0, year 0), per program, per year and per program and year
+    donor_id = Column(Integer, ForeignKey("donors.id", ondelete="CASCADE"), primary_key=True)
+    program_id = Column(Integer, primary_key=True)  # 0 = all programs
+    year = Column(Integer, primary_key=True)  # 0 = all years
+    total_amount = Column(NUMERIC(14, 2), nullable=False)
+    gift_count = Column(Integer, nullable=False)
+    last_donation_date = Column(Date, nullable=False)
+    updated_at = Column(TIMESTAMP(timezone=True), server_default="CURRENT_TIMESTAMP")
+
+
+class AnnualStatement(Base):
+    __tablename__ = "annual_statements"
+    __table_args__ = (UniqueConstraint("donor_id", "year"),)
+
+    # One per donor and year, written by the annual_statements job (see statements.py)
+    id = Column(Integer, primary_key=True, index=True)
+    donor_id = Column(Integer, ForeignKey("donors.id", ondelete="CASCADE"), nullable=False)
+    year = Column(Integer, nullable=False)
+    total_amount = Column(NUMERIC(14, 2), nullable=False)
+    gift_count = Column(Integer, nullable=False)
+    generated_date = Column(Date, nullable=False, server_default="CURRENT_DATE")
+    sent_date = Column(Date)
+    created_at = Column(TIMESTAMP(timezone=True), server_default="CURRENT_TIMESTAMP")
+
+
+class PledgeAllocation(Base):
+    __tablename__ = "pledge_allocations"
+
+    # No foreign keys: rows for deleted pledges and donations are found through tombstones (see fulfillment.py)
+    pledge_id = Column(Integer, primary_key=True)
+    donation_id = Column(Integer, primary_key=True, index=True)
+    donor_id = Column(Integer, nullable=False, index=True)
+    amount = Column(NUMERIC(10, 2), nullable=False)
+    donation_date = Column(Date, nullable=False)
+
+
+class ReconciliationCheckpoint(Base):
+    __tablename__ = "reconciliation_checkpoints"
+
+    name = Column(String(50), primary_key=True)
+    synced_until = Column(TIMESTAMP(timezone=True), nullable=False)
+    updated_at = Column(TIMESTAMP(timezone=True), server_default="CURRENT_TIMESTAMP")
+
+
+class DonorMergeSuggestion(Base):
+    __tablename__ = "donor_merge_suggestions"
+    __table_args__ = (UniqueConstraint("donor_id", "duplicate_id"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    donor_id = Column(Integer, ForeignKey("donors.id", ondelete="CASCADE"), nullable=False)
+    duplicate_id = Column(Integer, ForeignKey("donors.id", ondelete="CASCADE"), nullable=False)
+    score = Column(Float, nullable=False)
+    reasons = Column(String(100), nullable=False)  # blocking keys the pair shared: email, postal, domain, phone
+    status = Column(String(20), nullable=False, default="open")  # open, dismissed
+    created_at = Column(TIMESTAMP(timezone=True), server_default="CURRENT_TIMESTAMP")
+
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+
+    endpoint = Column(String(100), primary_key=True)
+    key = Column(String(255), primary_key=True)
+    request_hash = Column(String(64), nullable=False)
+    status_code = Column(Integer, nullable=False)
+    response = Column(JSON, nullable=False)
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default="CURRENT_TIMESTAMP")
+
+
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String(50), nullable=False)
+    status = Column(String(20), nullable=False, default="queued")  # queued, running, succeeded, failed, cancelled
+    params = Column(JSON)
+    progress = Column(Float, nullable=False, default=0)
+    checkpoint = Column(JSON)  # Handler-specific resume point, saved with each progress update
+    result = Column(JSON)
+    error = Column(Text)
+    cancel_requested = Column(Boolean, nullable=False, default=False)
+    heartbeat_at = Column(TIMESTAMP(timezone=True))
+    started_at = Column(TIMESTAMP(timezone=True))
+    finished_at = Column(TIMESTAMP(timezone=True))
+    created_at = Column(TIMESTAMP(timezone=True), server_default="CURRENT_TIMESTAMP")
+    updated_at = Column(TIMESTAMP(timezone=True), server_default="CURRENT_TIMESTAMP")
+
+
 # Pydantic Models for Request/Response
 class DonorBase(BaseModel):
     donor_type: str
@@ -157,6 +312,28 @@ class DonorCreate(DonorBase):
     pass
 
 
+class DonorUpdate(BaseModel):
+    """Partial update: only the fields present in the request body are changed."""
+    donor_type: Optional[str] = None
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    organization_name: Optional[str] = None
+    email: Optional[EmailStr] = None
+    phone: Optional[str] = None
+    address_line1: Optional[str] = None
+    address_line2: Optional[str] = None
+    city: Optional[str] = None
+    state: Optional[str] = None
+    postal_code: Optional[str] = None
+    country: Optional[str] = None
+    preferred_contact_method: Optional[str] = None
+    notes: Optional[str] = None
+
+
+class DonorMerge(BaseModel):
+    duplicate_id: int
+
+
 class DonorResponse(DonorBase):
     id: int
     created_at: datetime
@@ -180,6 +357,17 @@ class ProgramCreate(ProgramBase):
     pass
 
 
+class ProgramUpdate(BaseModel):
+    """Partial update: only the fields present in the request body are changed."""
+    name: Optional[str] = None
+    description: Optional[str] = None
+    start_date: Optional[date] = None
+    end_date: Optional[date] = None
+    budget: Optional[float] = None
+    goal_amount: Optional[float] = None
+    current_progress: Optional[float] = None
+
+
 class ProgramResponse(ProgramBase):
     id: int
     created_at: datetime
@@ -204,6 +392,18 @@ class DonationCreate(DonationBase):
     pass
 
 
+class DonationUpdate(BaseModel):
+    """Partial update: only the fields present in the request body are changed."""
+    donor_id: Optional[int] = None
+    program_id: Optional[int] = None
+    amount: Optional[float] = None
+    donation_date: Optional[date] = None
+    payment_method: Optional[str] = None
+    transaction_id: Optional[str] = None
+    is_tax_deductible: Optional[bool] = None
+    notes: Optional[str] = None
+
+
 class DonationResponse(DonationBase):
     id: int
     created_at: datetime
@@ -228,6 +428,18 @@ class PledgeCreate(PledgeBase):
     pass
 
 
+class PledgeUpdate(BaseModel):
+    """Partial update: only the fields present in the request body are changed."""
+    donor_id: Optional[int] = None
+    program_id: Optional[int] = None
+    amount: Optional[float] = None
+    pledge_date: Optional[date] = None
+    fulfillment_date: Optional[date] = None
+    status: Optional[str] = None
+    amount_fulfilled: Optional[float] = None
+    notes: Optional[str] = None
+
+
 class PledgeResponse(PledgeBase):
     id: int
     created_at: datetime
@@ -237,6 +449,16 @@ class PledgeResponse(PledgeBase):
         from_attributes = True
 
 
+class PledgeAllocationResponse(BaseModel):
+    pledge_id: int
+    donation_id: int
+    amount: float
+    donation_date: date
+
+    class Config:
+        from_attributes = True
+
+
 class TaxReceiptBase(BaseModel):
     donor_id: int  # This represents the donation ID based on the SQL
     year_donated: Optional[date] = None
@@ -249,6 +471,15 @@ class TaxReceiptCreate(TaxReceiptBase):
     pass
 
 
+class TaxReceiptUpdate(BaseModel):
+    """Partial update: only the fields present in the request body are changed."""
+    donor_id: Optional[int] = None  # This represents the donation ID based on the SQL
+    year_donated: Optional[date] = None
+    total_amount: Optional[float] = None
+    generated_date: Optional[date] = None
+    sent_date: Optional[date] = None
+
+
 class TaxReceiptResponse(TaxReceiptBase):
     id: int
     created_at: datetime
@@ -271,6 +502,16 @@ class ThankYouNoteCreate(ThankYouNoteBase):
     pass
 
 
+class ThankYouNoteUpdate(BaseModel):
+    """Partial update: only the fields present in the request body are changed."""
+    donor_id: Optional[int] = None
+    donation_id: Optional[int] = None
+    sent_date: Optional[date] = None
+    method: Optional[str] = None
+    template_used: Optional[str] = None
+    notes: Optional[str] = None
+
+
 class ThankYouNoteResponse(ThankYouNoteBase):
     id: int
     created_at: datetime
@@ -280,6 +521,136 @@ class ThankYouNoteResponse(ThankYouNoteBase):
         from_attributes = True
 
 
+class TaxReceiptFilter(BaseModel):
+    donation_id: Optional[int] = None
+    generated_after: Optional[date] = None
+    generated_before: Optional[date] = None
+    year_donated: Optional[date] = None
+    unsent_only: bool = True
+
+
+class TaxReceiptMarkSent(BaseModel):
+    ids: Optional[List[int]] = None
+    filter: Optional[TaxReceiptFilter] = None
+    sent_date: date = Field(default_factory=date.today)
+    dry_run: bool = False
+
+
+class ThankYouNoteFilter(BaseModel):
+    donor_id: Optional[int] = None
+    donation_id: Optional[int] = None
+    method: Optional[str] = None
+    template_used: Optional[str] = None
+    created_after: Optional[datetime] = None
+    created_before: Optional[datetime] = None
+    unsent_only: bool = True
+
+
+class ThankYouNoteMarkSent(BaseModel):
+    ids: Optional[List[int]] = None
+    filter: Optional[ThankYouNoteFilter] = None
+    sent_date: date = Field(default_factory=date.today)
+    method: Optional[str] = None
+    dry_run: bool = False
+
+
+class MarkSentResponse(BaseModel):
+    dry_run: bool
+    count: int
+    ids: List[int] = []
+
+
+class ThankYouCampaignCreate(BaseModel):
+    template_used: str
+    start_date: Optional[date] = None
+    end_date: Optional[date] = None
+    min_amount: Optional[float] = None
+    program_id: Optional[int] = None
+    preferred_contact_method: Optional[str] = None
+    method: Optional[str] = None  # Defaults to each donor's preferred_contact_method
+    sent_date: Optional[date] = None
+    notes: Optional[str] = None
+
+
+class JobCreate(BaseModel):
+    kind: str
+    params: dict = Field(default_factory=dict)
+
+
+class JobResponse(BaseModel):
+    id: int
+    kind: str
+    status: str
+    params: Optional[dict] = None
+    progress: float
+    checkpoint: Optional[dict] = None
+    error: Optional[str] = None
+    cancel_requested: bool
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    created_at: datetime
+    updated_at: datetime
+
+    class Config:
+        from_attributes = True
+
+
+# The time of a client's last committed write travels with the client, so every worker sees it
+LAST_WRITE_COOKIE = "last_write"
+
+
+def wrote_recently(request: Request) -> bool:
+    """Whether the client's X-Last-Write header or last_write cookie is within READ_YOUR_WRITES_SECONDS."""
+    if not READ_YOUR_WRITES_SECONDS:
+        return False
+    last_write = request.headers.get("X-Last-Write") or request.cookies.get(LAST_WRITE_COOKIE)
+    try:
+        return time.time() - float(last_write) < READ_YOUR_WRITES_SECONDS
+    except (TypeError, ValueError):
+        return False
+
+
+def remember_write(db, response: Response):
+    """Hand the client the time of each commit on ``db``; writes that roll back are not remembered."""
+    if not READ_YOUR_WRITES_SECONDS:
+        return
+
+    @event.listens_for(db, "after_commit")
+    def committed(session):
+        last_write = f"{time.time():.3f}"
+        response.headers["X-Last-Write"] = last_write
+        response.set_cookie(LAST_WRITE_COOKIE, last_write, max_age=math.ceil(READ_YOUR_WRITES_SECONDS),
+                            httponly=True, samesite="lax")
+
+
+# Dependency to get a read-write DB session on the primary
+def get_write_db(response: Response):
+    db = SessionLocal()
+    remember_write(db, response)
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+# Dependency to get a DB session for reads, routed to the replica unless the client just wrote
+def get_read_db(request: Request):
+    db = SessionLocal() if wrote_recently(request) else ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+# Dependency to get a DB session for heavy reports from the dedicated report pool
+def get_report_db():
+    db = ReportSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
 # Dependency to get DB session
 def get_db():
     db = SessionLocal()
@@ -0,0 +1,233 @@
+# partitions.py
+"""Range partitioning of the donations table by donation_date year.
+
+Usage:
+    python partitions.py migrate                 # convert donations to a partitioned table
+    python partitions.py create-future --years 2 # pre-create partitions for upcoming years
+    python partitions.py verify --year 2024      # EXPLAIN a year query and check pruning
+"""
+import argparse
+import json
+import sys
+from datetime import date
+from typing import List
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from sqlalchemy import text
+
+import idempotency
+from models import engine
+
+PARENT_TABLE = "donations"
+DEFAULT_PARTITION = "donations_default"
+
+DONATION_COLUMNS = ("id, donor_id, program_id, amount, donation_date, payment_method, transaction_id, "
+                    "is_tax_deductible, notes, created_at, updated_at")
+
+
+def partition_name(year: int) -> str:
+    return f"donations_y{year}"
+
+
+def is_partitioned(conn) -> bool:
+    return conn.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table))"
+    ), {"table": PARENT_TABLE}).scalar()
+
+
+def existing_partitions(conn) -> List[str]:
+    return list(conn.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = to_regclass(:table) ORDER BY child.relname"
+    ), {"table": PARENT_TABLE}).scalars())
+
+
+def create_year_partition(conn, year: int):
+    """Create the partition for ``year``, moving any matching rows out of the default partition."""
+    name = partition_name(year)
+    if name in existing_partitions(conn):
+        return False
+
+    start, end = date(year, 1, 1), date(year + 1, 1, 1)
+    conn.execute(text(f"CREATE TABLE {name} (LIKE {PARENT_TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+    conn.execute(text(
+        f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} "
+        f"WHERE donation_date >= :start AND donation_date < :end RETURNING {DONATION_COLUMNS}) "
+        f"INSERT INTO {name} ({DONATION_COLUMNS}) SELECT {DONATION_COLUMNS} FROM moved"
+    ), {"start": start, "end": end})
+    conn.execute(text(
+        f"ALTER TABLE {PARENT_TABLE} ATTACH PARTITION {name} FOR VALUES FROM ('{start}') TO ('{end}')"
+    ))
+    return True
+
+
+def index_definitions(conn) -> List[str]:
+    """CREATE INDEX statements for every index on donations except the primary key.
+
+    Unique indexes get donation_date appended to their key columns unless they already
+    include it, since a partitioned table can only enforce uniqueness within the key.
+    """
+    rows = conn.execute(text("""
+        SELECT pg_get_indexdef(i.indexrelid), i.indisunique,
+               a.attnum = ANY (i.indkey[0:i.indnkeyatts - 1]) AS has_partition_key
+        FROM pg_index i
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attname = 'donation_date'
+        WHERE i.indrelid = to_regclass(:table) AND NOT i.indisprimary
+        ORDER BY i.indexrelid::regclass::text
+    """), {"table": PARENT_TABLE}).all()
+    definitions = []
+    for definition, unique, has_partition_key in rows:
+        if unique and not has_partition_key:
+            # Close the key column list, e.g. "USING btree (a, b)" before any INCLUDE/NULLS/WHERE
+            start = definition.index("(", definition.index(" USING "))
+            depth = 0
+            for end in range(start, len(definition)):
+                depth += {"(": 1, ")": -1}.get(definition[end], 0)
+                if depth == 0:
+                    break
+            definition = f"{definition[:end]}, donation_date{definition[end:]}"
+        definitions.append(definition)
+    return definitions
+
+
+def migrate():
+    """Convert an existing plain donations table into one partitioned by year.
+
+    Runs in a single transaction: the old table is renamed, a partitioned table
+    with the same columns is created, one partition per year present in the data
+    (plus a default partition) is added, the rows are copied across and every
+    index of the old table is created again on the new one.
+
+    Postgres requires unique constraints on a partitioned table to include the
+    partition key, so the primary key becomes (id, donation_date), unique indexes
+    get donation_date as an extra column (see index_definitions) and foreign keys
+    from thank_you_notes and tax_receipts to donations are dropped. The application
+    enforces them instead, locking like the foreign keys did: writers of those rows
+    check the donation with a KEY SHARE lock, and delete_donation locks the donation
+    FOR UPDATE and refuses (409) while receipts or notes still reference it.
+    """
+    with engine.begin() as conn:
+        if is_partitioned(conn):
+            print("donations is already partitioned")
+            return
+        partitions = partition_table(conn)
+
+    # The conflict target for donation inserts now includes donation_date
+    idempotency.forget_transaction_index()
+    print(f"donations partitioned by year: {', '.join(partitions)}")
+
+
+def partition_table(conn) -> List[str]:
+    """The steps of migrate() on an open transaction; returns the partition names."""
+    referencing = conn.execute(text(
+        "SELECT conrelid::regclass::text, conname FROM pg_constraint "
+        "WHERE confrelid = to_regclass(:table) AND contype = 'f'"
+    ), {"table": PARENT_TABLE}).all()
+    for table_name, constraint_name in referencing:
+        conn.execute(text(f'ALTER TABLE {table_name} DROP CONSTRAINT "{constraint_name}"'))
+
+    # Read before the rename: the definitions name the table, and the indexes move with it
+    indexes = index_definitions(conn)
+    conn.execute(text("ALTER TABLE donations RENAME TO donations_unpartitioned"))
+    conn.execute(text("""
+        CREATE TABLE donations
+        (
+            id                integer        NOT NULL DEFAULT nextval('donations_id_seq'),
+            donor_id          integer REFERENCES public.donors,
+            program_id        integer REFERENCES public.programs,
+            amount            numeric(10, 2) NOT NULL,
+            donation_date     date           NOT NULL,
+            payment_method    varchar(50),
+            transaction_id    varchar(100),
+            is_tax_deductible boolean                  DEFAULT false,
+            notes             text,
+            created_at        timestamp with time zone DEFAULT CURRENT_TIMESTAMP,
+            updated_at        timestamp with time zone DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, donation_date)
+        ) PARTITION BY RANGE (donation_date)
+    """))
+    conn.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF donations DEFAULT"))
+
+    first_year, last_year = conn.execute(text(
+        "SELECT EXTRACT(YEAR FROM min(donation_date))::int, EXTRACT(YEAR FROM max(donation_date))::int "
+        "FROM donations_unpartitioned"
+    )).one()
+    this_year = date.today().year
+    for year in range(min(first_year or this_year, this_year), max(last_year or this_year, this_year) + 2):
+        create_year_partition(conn, year)
+
+    conn.execute(text(
+        f"INSERT INTO donations ({DONATION_COLUMNS}) "
+        f"SELECT {DONATION_COLUMNS} FROM donations_unpartitioned"
+    ))
+    conn.execute(text("ALTER SEQUENCE donations_id_seq OWNED BY donations.id"))
+    conn.execute(text("DROP TABLE donations_unpartitioned"))
+
+    for definition in indexes:
+        conn.execute(text(definition))
+    conn.execute(text("ANALYZE donations"))
+    return existing_partitions(conn)
+
+
+def create_future_partitions(years: int = 2):
+    """Pre-create partitions for the current year and the next ``years`` years."""
+    this_year = date.today().year
+    created = []
+    with engine.begin() as conn:
+        if not is_partitioned(conn):
+            raise SystemExit("donations is not partitioned; run `python partitions.py migrate` first")
+        for year in range(this_year, this_year + years + 1):
+            if create_year_partition(conn, year):
+                created.append(partition_name(year))
+    print(f"created partitions: {', '.join(created) or 'none (already present)'}")
+
+
+def scanned_relations(plan) -> List[str]:
+    """Collect the relation names scanned by an EXPLAIN (FORMAT JSON) plan node."""
+    names = [plan["Relation Name"]] if "Relation Name" in plan else []
+    for child in plan.get("Plans", []):
+        names.extend(scanned_relations(child))
+    return names
+
+
+def verify_pruning(year: int) -> List[str]:
+    """EXPLAIN the year filter used by read_donations and tax receipt generation."""
+    with engine.connect() as conn:
+        plan = conn.execute(text(
+            "EXPLAIN (FORMAT JSON) SELECT * FROM donations "
+            "WHERE donation_date >= :start AND donation_date <= :end"
+        ), {"start": date(year, 1, 1), "end": date(year, 12, 31)}).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return scanned_relations(plan[0]["Plan"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage year partitions of the donations table")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("migrate", help="convert donations into a partitioned table")
+    future = commands.add_parser("create-future", help="pre-create partitions for upcoming years")
+    future.add_argument("--years", type=int, default=2)
+    verify = commands.add_parser("verify", help="check that a year query prunes to one partition")
+    verify.add_argument("--year", type=int, default=date.today().year)
+    args = parser.parse_args(argv)
+
+    if args.command == "migrate":
+        migrate()
+    elif args.command == "create-future":
+        create_future_partitions(args.years)
+    elif args.command == "verify":
+        relations = verify_pruning(args.year)
+        print(f"relations scanned: {', '.join(relations)}")
+        if relations != [partition_name(args.year)]:
+            print("year query was not pruned to a single partition")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,302 @@
+# reconciliation.py
+"""Reconcile a processor or bank statement (CSV) against donations.
+
+The statement needs ``transaction_id``, ``amount`` and ``date`` (YYYY-MM-DD)
+columns. Other columns are ignored, and transaction_id may be empty. Matching
+runs in two phases:
+
+1. A hash join on transaction_id. The donations of the period are loaded into a
+   dict and the statement lines are streamed past it.
+2. Lines and donations left over from phase 1 are matched on equal amount with
+   dates at most ``tolerance_days`` apart. Each amount's lines are paired in date
+   order with the earliest donation still in range.
+
+Both sides are split into buckets (by transaction_id for phase 1, by amount for
+phase 2) so that one bucket fits in RECONCILIATION_MEMORY_MB. With a single
+bucket everything stays in memory. Otherwise buckets are spilled to temporary
+CSV files and joined one at a time, so a statement of millions of lines runs in
+the same memory as a small one.
+
+The three result sets are written as CSV files under
+EXPORT_DIR/reconciliation/<report id>/ next to a summary.json.
+"""
+import csv
+import io
+import json
+import math
+import os
+import re
+import tempfile
+import uuid
+import zlib
+from collections import defaultdict, deque
+from datetime import date, timedelta
+from decimal import Decimal, InvalidOperation
+from typing import Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from jobs import EXPORT_DIR
+from models import Donation
+
+RECONCILIATION_MEMORY_MB = int(os.getenv("RECONCILIATION_MEMORY_MB", "64"))
+RECONCILIATION_TOLERANCE_DAYS = int(os.getenv("RECONCILIATION_TOLERANCE_DAYS", "3"))
+REPORT_DIR = os.path.join(EXPORT_DIR, "reconciliation")
+# Rough in-memory cost of one row (tuple, strings and hash table slot)
+ROW_BYTES = 250
+FETCH_SIZE = 10_000
+EPOCH = date(1970, 1, 1)
+
+REQUIRED_COLUMNS = ("transaction_id", "amount", "date")
+RESULT_FILES = {
+    "matched": ("statement_line", "statement_transaction_id", "statement_amount", "statement_date",
+                "donation_id", "donation_transaction_id", "donation_amount", "donation_date",
+                "match_type", "amount_difference", "days_difference"),
+    "unmatched_statement": ("statement_line", "transaction_id", "amount", "date"),
+    "unmatched_database": ("donation_id", "transaction_id", "amount", "donation_date"),
+}
+REPORT_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+class StatementError(ValueError):
+    """The uploaded statement can't be parsed."""
+
+
+def bucket_count(rows: int) -> int:
+    return max(1, math.ceil(rows * ROW_BYTES / (RECONCILIATION_MEMORY_MB * 2 ** 20)))
+
+
+class Buckets:
+    """(number, transaction_id, cents, day) rows split into ``count`` buckets by key.
+
+    Statement lines use the line number and donations their id as ``number``.
+    With one bucket the rows are kept in a list; otherwise they are appended to
+    one temporary CSV file per bucket and read back one bucket at a time.
+    """
+
+    def __init__(self, directory: str, name: str, count: int):
+        self.count = count
+        if count == 1:
+            self.rows = []
+        else:
+            self.paths = [os.path.join(directory, f"{name}_{i}.csv") for i in range(count)]
+            self.files = [open(path, "w", newline="") for path in self.paths]
+            self.writers = [csv.writer(file) for file in self.files]
+
+    def add(self, key: str, row: tuple):
+        if self.count == 1:
+            self.rows.append(row)
+        else:
+            self.writers[zlib.crc32(key.encode()) % self.count].writerow(row)
+
+    def close(self):
+        if self.count > 1:
+            for file in self.files:
+                file.close()
+
+    def bucket(self, i: int):
+        if self.count == 1:
+            rows, self.rows = self.rows, []
+            yield from rows
+            return
+        with open(self.paths[i], newline="") as file:
+            for number, transaction_id, cents, day in csv.reader(file):
+                yield int(number), transaction_id, int(cents), int(day)
+        os.remove(self.paths[i])
+
+
+def parse_cents(value: str) -> int:
+    try:
+        return int((Decimal(value.strip().replace(",", "").replace("$", "")) * 100).to_integral_value())
+    except InvalidOperation:
+        raise ValueError(f"invalid amount {value!r}") from None
+
+
+def read_statement(upload):
+    """Yield (line number, transaction_id, cents, day) for each statement line."""
+    upload.seek(0)
+    text = io.TextIOWrapper(upload, encoding="utf-8-sig", newline="")
+    try:
+        reader = csv.reader(text)
+        header = [name.strip().lower() for name in next(reader, [])]
+        missing = [name for name in REQUIRED_COLUMNS if name not in header]
+        if missing:
+            raise StatementError(f"Statement is missing columns: {', '.join(missing)}")
+        transaction_col, amount_col, date_col = (header.index(name) for name in REQUIRED_COLUMNS)
+
+        line = 1
+        try:
+            for line, row in enumerate(reader, start=2):
+                if not any(row):
+                    continue
+                yield (line, row[transaction_col].strip(), parse_cents(row[amount_col]),
+                       (date.fromisoformat(row[date_col].strip()) - EPOCH).days)
+        except (IndexError, ValueError) as exc:
+            raise StatementError(f"Statement line {line}: {exc}") from exc
+    finally:
+        text.detach()  # leave the upload open for the next pass
+
+
+def dollars(cents: int) -> str:
+    sign = "-" if cents < 0 else ""
+    return f"{sign}{abs(cents) // 100}.{abs(cents) % 100:02d}"
+
+
+def day_date(day: int) -> date:
+    return EPOCH + timedelta(days=day)
+
+
+def reconcile_statement(db: Session, upload, tolerance_days: int = RECONCILIATION_TOLERANCE_DAYS,
+                        start_date: Optional[date] = None, end_date: Optional[date] = None,
+                        payment_method: Optional[str] = None) -> dict:
+    """Match a statement file object against donations and write the report; returns the summary.
+
+    The period defaults to the statement's first and last dates. Donations up to
+    ``tolerance_days`` outside it can still match, but only unmatched donations
+    inside it are reported.
+    """
+    # First pass: validate the file and find its size and period
+    lines, first_day, last_day = 0, None, None
+    for _, _, _, day in read_statement(upload):
+        lines += 1
+        first_day = day if first_day is None else min(first_day, day)
+        last_day = day if last_day is None else max(last_day, day)
+    start_day = (start_date - EPOCH).days if start_date else first_day
+    end_day = (end_date - EPOCH).days if end_date else last_day
+    if start_day is None or end_day is None:
+        raise StatementError("Statement has no lines; pass start_date and end_date to list unmatched donations")
+
+    donation_filter = [Donation.donation_date >= day_date(start_day - tolerance_days),
+                       Donation.donation_date <= day_date(end_day + tolerance_days)]
+    if payment_method:
+        donation_filter.append(Donation.payment_method == payment_method)
+    donations = db.scalar(select(func.count()).select_from(Donation).where(*donation_filter))
+
+    report_id = uuid.uuid4().hex
+    report_dir = os.path.join(REPORT_DIR, report_id)
+    os.makedirs(report_dir)
+    outputs = {name: open(os.path.join(report_dir, f"{name}.csv"), "w", newline="") for name in RESULT_FILES}
+    writers = {name: csv.writer(file) for name, file in outputs.items()}
+    for name, columns in RESULT_FILES.items():
+        writers[name].writerow(columns)
+    counts = defaultdict(int)
+    totals = defaultdict(int)
+
+    def matched(line, donation, match_type):
+        writers["matched"].writerow((
+            line[0], line[1], dollars(line[2]), day_date(line[3]),
+            donation[0], donation[1], dollars(donation[2]), day_date(donation[3]),
+            match_type, dollars(line[2] - donation[2]), line[3] - donation[3],
+        ))
+        counts[match_type] += 1
+        counts["amount_mismatches"] += line[2] != donation[2]
+        totals["matched"] += line[2]
+
+    def unmatched_line(line):
+        writers["unmatched_statement"].writerow((line[0], line[1], dollars(line[2]), day_date(line[3])))
+        counts["unmatched_statement"] += 1
+        totals["unmatched_statement"] += line[2]
+
+    def unmatched_donation(donation):
+        if start_day <= donation[3] <= end_day:
+            writers["unmatched_database"].writerow((donation[0], donation[1], dollars(donation[2]),
+                                                    day_date(donation[3])))
+            counts["unmatched_database"] += 1
+            totals["unmatched_database"] += donation[2]
+
+    with tempfile.TemporaryDirectory(prefix="reconciliation_") as spill:
+        # Either side of the phase 1 join may be the large one; with one bucket both stay in memory
+        by_transaction = bucket_count(max(donations, lines))
+        by_amount = bucket_count(donations + lines)
+        statement = Buckets(spill, "statement", by_transaction)
+        database = Buckets(spill, "donations", by_transaction)
+        statement_rest = Buckets(spill, "statement_rest", by_amount)
+        database_rest = Buckets(spill, "donations_rest", by_amount)
+
+        # Rows without a transaction id can only match in the second phase
+        for line in read_statement(upload):
+            (statement if line[1] else statement_rest).add(line[1] or str(line[2]), line)
+        rows = db.execute(
+            select(Donation.id, Donation.transaction_id, Donation.amount, Donation.donation_date)
+            .where(*donation_filter).execution_options(yield_per=FETCH_SIZE)
+        )
+        for donation_id, transaction_id, amount, donation_date in rows:
+            donation = (donation_id, transaction_id or "", round(amount * 100), (donation_date - EPOCH).days)
+            (database if transaction_id else database_rest).add(transaction_id or str(donation[2]), donation)
+        statement.close()
+        database.close()
+
+        # Phase 1: hash join on transaction_id, one bucket at a time
+        for i in range(by_transaction):
+            table = defaultdict(list)
+            for donation in database.bucket(i):
+                table[donation[1]].append(donation)
+            for line in statement.bucket(i):
+                candidates = table.get(line[1])
+                if candidates:
+                    # Prefer the donation with the same amount when the id repeats
+                    donation = next((row for row in candidates if row[2] == line[2]), candidates[0])
+                    candidates.remove(donation)
+                    matched(line, donation, "transaction_id")
+                else:
+                    statement_rest.add(str(line[2]), line)
+            for candidates in table.values():
+                for donation in candidates:
+                    database_rest.add(str(donation[2]), donation)
+        statement_rest.close()
+        database_rest.close()
+
+        # Phase 2: same amount, dates within the tolerance
+        for i in range(by_amount):
+            pending = defaultdict(list)
+            for donation in database_rest.bucket(i):
+                pending[donation[2]].append(donation)
+            for candidates in pending.values():
+                candidates.sort(key=lambda row: (row[3], row[0]))
+            pending = {cents: deque(candidates) for cents, candidates in pending.items()}
+
+            for line in sorted(statement_rest.bucket(i), key=lambda row: (row[2], row[3], row[0])):
+                candidates = pending.get(line[2])
+                while candidates and candidates[0][3] < line[3] - tolerance_days:
+                    unmatched_donation(candidates.popleft())
+                if candidates and candidates[0][3] <= line[3] + tolerance_days:
+                    matched(line, candidates.popleft(), "amount_date")
+                else:
+                    unmatched_line(line)
+            for candidates in pending.values():
+                for donation in candidates:
+                    unmatched_donation(donation)
+
+    for file in outputs.values():
+        file.close()
+
+    summary = {
+        "report_id": report_id,
+        "start_date": day_date(start_day).isoformat(),
+        "end_date": day_date(end_day).isoformat(),
+        "tolerance_days": tolerance_days,
+        "payment_method": payment_method,
+        "statement_lines": lines,
+        "matched": counts["transaction_id"] + counts["amount_date"],
+        "matched_by_transaction_id": counts["transaction_id"],
+        "matched_by_amount_and_date": counts["amount_date"],
+        "amount_mismatches": counts["amount_mismatches"],
+        "matched_amount": float(dollars(totals["matched"])),
+        "unmatched_statement": counts["unmatched_statement"],
+        "unmatched_statement_amount": float(dollars(totals["unmatched_statement"])),
+        "unmatched_database": counts["unmatched_database"],
+        "unmatched_database_amount": float(dollars(totals["unmatched_database"])),
+        "buckets": {"transaction_id": by_transaction, "amount": by_amount},
+    }
+    with open(os.path.join(report_dir, "summary.json"), "w") as file:
+        json.dump(summary, file)
+    return summary
+
+
+def report_path(report_id: str, name: str) -> Optional[str]:
+    """Path of a report's summary.json or result CSV, or None if it doesn't exist."""
+    if not REPORT_ID.match(report_id) or (name != "summary.json" and name.removesuffix(".csv") not in RESULT_FILES):
+        return None
+    path = os.path.join(REPORT_DIR, report_id, name)
+    return path if os.path.exists(path) else None
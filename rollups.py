@@ -0,0 +1,113 @@
+# rollups.py
+"""Daily and monthly donation rollups per program.
+
+The donation endpoints call ``refresh_rollups`` with the (program_id, donation_date)
+pairs a write touched, which recomputes just those buckets under a per-month
+advisory lock. ``rebuild_rollups`` recomputes every bucket from scratch:
+
+    python rollups.py rebuild
+"""
+import sys
+from datetime import date, timedelta
+from typing import Iterable, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+GRANULARITIES = {
+    "day": "donation_daily_rollups",
+    "month": "donation_monthly_rollups",
+}
+
+
+def bucket_bounds(granularity: str, day: date) -> Tuple[date, date]:
+    """Return the [start, end) dates of the bucket containing ``day``."""
+    if granularity == "day":
+        return day, day + timedelta(days=1)
+    start = day.replace(day=1)
+    end = date(start.year + 1, 1, 1) if start.month == 12 else date(start.year, start.month + 1, 1)
+    return start, end
+
+
+def refresh_rollups(db: Session, touched: Iterable[Tuple[Optional[int], Optional[date]]]):
+    """Recompute the rollup buckets for the given (program_id, donation_date) pairs.
+
+    Runs inside the caller's transaction; the caller commits.
+    """
+    touched = {(program_id, day) for program_id, day in touched if program_id and day}
+    if not touched:
+        return
+    # Concurrent writes to the same program and month take turns (a month covers its day buckets too),
+    # so each recompute sees the other's committed donations instead of overwriting them with a stale sum
+    keys = sorted({f"donation_rollups:{program_id}:{bucket_bounds('month', day)[0]}" for program_id, day in touched})
+    db.execute(text("SELECT pg_advisory_xact_lock(hashtext(key)) FROM unnest(:keys) AS key"), {"keys": keys})
+    for granularity, table in GRANULARITIES.items():
+        buckets = {(program_id, bucket_bounds(granularity, day)) for program_id, day in touched}
+        for program_id, (start, end) in buckets:
+            params = {"program_id": program_id, "start": start, "end": end}
+            db.execute(text(f"""
+                INSERT INTO {table} (program_id, bucket_date, total_amount, gift_count, distinct_donors, updated_at)
+                SELECT :program_id, :start, COALESCE(SUM(amount), 0), COUNT(*), COUNT(DISTINCT donor_id), now()
+                FROM donations
+                WHERE program_id = :program_id AND donation_date >= :start AND donation_date < :end
+                ON CONFLICT (program_id, bucket_date) DO UPDATE SET
+                    total_amount = EXCLUDED.total_amount,
+                    gift_count = EXCLUDED.gift_count,
+                    distinct_donors = EXCLUDED.distinct_donors,
+                    updated_at = EXCLUDED.updated_at
+            """), params)
+            db.execute(text(
+                f"DELETE FROM {table} WHERE program_id = :program_id AND bucket_date = :start AND gift_count = 0"
+            ), params)
+
+
+def rebuild_rollups(db: Session):
+    """Recompute every rollup bucket from the donations table in bulk."""
+    for granularity, table in GRANULARITIES.items():
+        db.execute(text(f"DELETE FROM {table}"))
+        db.execute(text(f"""
+            INSERT INTO {table} (program_id, bucket_date, total_amount, gift_count, distinct_donors, updated_at)
+            SELECT program_id, date_trunc('{granularity}', donation_date)::date,
+                   SUM(amount), COUNT(*), COUNT(DISTINCT donor_id), now()
+            FROM donations
+            WHERE program_id IS NOT NULL
+            GROUP BY 1, 2
+        """))
+
+
+def read_timeseries(db: Session, granularity: str, start_date: Optional[date] = None,
+                    end_date: Optional[date] = None, program_id: Optional[int] = None):
+    """Read rollup rows ordered by program and bucket."""
+    filters = ["TRUE"]
+    params = {}
+    if program_id:
+        filters.append("program_id = :program_id")
+        params["program_id"] = program_id
+    if start_date:
+        filters.append("bucket_date >= :start_date")
+        params["start_date"] = bucket_bounds(granularity, start_date)[0]
+    if end_date:
+        filters.append("bucket_date <= :end_date")
+        params["end_date"] = end_date
+
+    return db.execute(text(f"""
+        SELECT program_id, bucket_date, total_amount, gift_count, distinct_donors
+        FROM {GRANULARITIES[granularity]}
+        WHERE {' AND '.join(filters)}
+        ORDER BY program_id, bucket_date
+    """), params).mappings().all()
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    from models import SessionLocal
+
+    if sys.argv[1:] != ["rebuild"]:
+        sys.exit("usage: python rollups.py rebuild")
+    with SessionLocal() as session:
+        rebuild_rollups(session)
+        session.commit()
+    print("donation rollups rebuilt")
@@ -0,0 +1,102 @@
+# segments.py
+"""RFM (recency, frequency, monetary) donor segmentation.
+
+A refresh is one INSERT ... SELECT: donations are aggregated per donor in a
+single pass, each measure is scored into quintiles (5 = most recent / most
+frequent / largest), and the three scores are mapped to a named segment. A
+score is the quintile of the donor's percentile. Tied donors share the midpoint
+of their tie block's percentile range (between percent_rank and cume_dist), so
+equal values always get the same score. A value most donors share lands in the
+middle. The aggregate is linear in the number of donations; the window sorts
+only run over donors. The table is replaced inside one transaction, so readers
+keep seeing the previous scores until the refresh commits.
+
+Usage:
+    python segments.py refresh
+"""
+import os
+import sys
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from jobs import JobContext, job_handler
+
+NEW_DONOR_DAYS = int(os.getenv("SEGMENT_NEW_DONOR_DAYS", "365"))
+
+# Checked in order; the first matching rule names the segment
+SEGMENTS = {
+    "champions": "gave recently, often and the most",
+    "loyal": "gives often and not long ago",
+    "major_givers": "large totals and not long ago",
+    "new": "first gift within the last SEGMENT_NEW_DONOR_DAYS days",
+    "at_risk": "used to give often or a lot, but not recently",
+    "hibernating": "small, infrequent and long ago",
+    "needs_attention": "everyone else",
+}
+
+REFRESH_SQL = text("""
+    INSERT INTO donor_segments (donor_id, last_donation_date, gift_count, total_amount,
+                                r_score, f_score, m_score, segment, computed_at)
+    WITH per_donor AS (
+        SELECT donor_id, min(donation_date) AS first_donation_date, max(donation_date) AS last_donation_date,
+               count(*) AS gift_count, sum(amount) AS total_amount
+        FROM donations
+        WHERE donor_id IS NOT NULL
+        GROUP BY donor_id
+    ),
+    scored AS (
+        SELECT per_donor.*,
+               least(5, 1 + floor(5 * (percent_rank() OVER r + cume_dist() OVER r) / 2))::int AS r_score,
+               least(5, 1 + floor(5 * (percent_rank() OVER f + cume_dist() OVER f) / 2))::int AS f_score,
+               least(5, 1 + floor(5 * (percent_rank() OVER m + cume_dist() OVER m) / 2))::int AS m_score
+        FROM per_donor
+        WINDOW r AS (ORDER BY last_donation_date), f AS (ORDER BY gift_count), m AS (ORDER BY total_amount)
+    )
+    SELECT donor_id, last_donation_date, gift_count, total_amount, r_score, f_score, m_score,
+           CASE
+               WHEN r_score >= 4 AND f_score >= 4 AND m_score >= 4 THEN 'champions'
+               WHEN r_score >= 3 AND f_score >= 4 THEN 'loyal'
+               WHEN r_score >= 3 AND m_score >= 4 THEN 'major_givers'
+               WHEN first_donation_date >= current_date - :new_donor_days THEN 'new'
+               WHEN r_score <= 2 AND (f_score >= 4 OR m_score >= 4) THEN 'at_risk'
+               WHEN r_score <= 2 AND f_score <= 2 AND m_score <= 2 THEN 'hibernating'
+               ELSE 'needs_attention'
+           END,
+           now()
+    FROM scored
+""")
+
+
+def refresh_segments(db: Session) -> dict:
+    """Replace every donor's scores; returns the number of donors per segment."""
+    db.execute(text("DELETE FROM donor_segments"))
+    db.execute(REFRESH_SQL, {"new_donor_days": NEW_DONOR_DAYS})
+    counts = dict(db.execute(text("SELECT segment, count(*) FROM donor_segments GROUP BY segment")).all())
+    db.commit()
+    return {segment: counts.get(segment, 0) for segment in SEGMENTS}
+
+
+@job_handler("donor_segments")
+def refresh_donor_segments(ctx: JobContext, params: dict):
+    """Recompute RFM scores and segments for every donor."""
+    from models import SessionLocal
+
+    with SessionLocal() as db:
+        counts = refresh_segments(db)
+    ctx.report(100.0)
+    return {"segments": counts}
+
+
+if __name__ == "__main__":
+    from models import SessionLocal
+
+    if sys.argv[1:] != ["refresh"]:
+        sys.exit("usage: python segments.py refresh")
+    with SessionLocal() as session:
+        for segment, count in refresh_segments(session).items():
+            print(f"{segment:<16} {count}")
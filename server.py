@@ -0,0 +1,98 @@
+# server.py
+"""Production server settings, connection budget checks and pool lifecycle hooks.
+
+Environment:
+    WEB_CONCURRENCY      worker processes (default 1)
+    THREADPOOL_SIZE      threads per worker for sync endpoints (default 40, the anyio default)
+    KEEP_ALIVE           seconds to hold idle keep-alive connections (default 5)
+    BACKLOG              listen socket backlog (default 2048)
+    HOST / PORT          bind address (default 0.0.0.0:8000)
+    ACCESS_LOG           set to 0 to turn off uvicorn's per-request access log (default 1)
+    DB_MAX_CONNECTIONS   connections Postgres allows this app (default 100, match max_connections
+                         minus superuser_reserved_connections and other clients)
+"""
+import os
+
+import anyio.to_thread
+from sqlalchemy import text
+
+import events
+import models
+
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "40"))
+KEEP_ALIVE = int(os.getenv("KEEP_ALIVE", "5"))
+BACKLOG = int(os.getenv("BACKLOG", "2048"))
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+ACCESS_LOG = os.getenv("ACCESS_LOG", "1") != "0"
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", "100"))
+
+
+def engines():
+    """Distinct engines (primary, replica, reports, dashboard) used by one worker process."""
+    return list({id(engine): engine for engine in (models.engine, models.read_engine, models.report_engine,
+                                                   models.dashboard_engine)}.values())
+
+
+def connections_per_worker() -> int:
+    """Upper bound of Postgres connections one worker can open."""
+    import statements  # only needed here, so the app itself doesn't load it at startup
+    total = models.DB_POOL_SIZE + models.DB_MAX_OVERFLOW
+    if models.read_engine is not models.engine:
+        total += models.DB_POOL_SIZE + models.DB_MAX_OVERFLOW
+    total += models.REPORT_POOL_SIZE + models.DASHBOARD_POOL_SIZE
+    total += statements.STATEMENT_PROCESSES  # annual statement shard processes, one connection each
+    if events.PROGRESS_NOTIFY:
+        total += 1  # LISTEN connection
+    return total
+
+
+def check_connection_budget(workers: int):
+    """Refuse to start if all workers together could exceed DB_MAX_CONNECTIONS."""
+    needed = workers * connections_per_worker()
+    if needed > DB_MAX_CONNECTIONS:
+        raise SystemExit(
+            f"{workers} workers x {connections_per_worker()} connections = {needed} exceeds "
+            f"DB_MAX_CONNECTIONS={DB_MAX_CONNECTIONS}; lower WEB_CONCURRENCY, DB_POOL_SIZE, "
+            f"DB_MAX_OVERFLOW, REPORT_POOL_SIZE or DASHBOARD_POOL_SIZE"
+        )
+
+
+def configure_threadpool():
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+
+
+def warm_up_pools():
+    """Open each pool's base connections up front so the first requests don't pay for connecting."""
+    for engine in engines():
+        connections = []
+        try:
+            for _ in range(engine.pool.size()):
+                connection = engine.connect()
+                connection.execute(text("SELECT 1"))
+                connections.append(connection)
+        finally:
+            for connection in connections:
+                connection.close()
+
+
+def dispose_pools():
+    for engine in engines():
+        engine.dispose()
+
+
+def run():
+    import uvicorn
+
+    check_connection_budget(WEB_CONCURRENCY)
+    uvicorn.run(
+        "main:app",
+        host=HOST,
+        port=PORT,
+        workers=WEB_CONCURRENCY,
+        timeout_keep_alive=KEEP_ALIVE,
+        backlog=BACKLOG,
+        proxy_headers=True,
+        access_log=ACCESS_LOG,
+    )
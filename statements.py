@@ -0,0 +1,205 @@
+# statements.py
+"""Per-donor annual tax statements, generated in parallel across worker processes.
+
+Donors with tax-deductible donations in the year are split into id-range shards.
+Each shard runs in its own process: it aggregates its donors' donations in SQL,
+renders one statement file per donor and format, then records all of its
+statements in annual_statements in one batch. Donors that already have a
+statement for the year are skipped, so a failed shard can be retried without
+duplicating statements; the unique (donor_id, year) index also keeps concurrent
+jobs and replayed shards from recording a donor twice. Statements are kept apart from the per-donation
+tax_receipts: per-donation receipts don't stop a donor's statement, and a
+statement doesn't mark any of the donor's donations as receipted.
+"""
+import html
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from jobs import JobContext, job_handler
+
+STATEMENT_DIR = os.getenv("STATEMENT_DIR", "statements")
+STATEMENT_PROCESSES = int(os.getenv("STATEMENT_PROCESSES", os.cpu_count() or 1))
+STATEMENT_FORMATS = ("txt", "html", "pdf")
+
+# Deductible donations for the year, by donor, skipping donors who already have a statement for that year
+SHARD_STATEMENTS_SQL = text("""
+    SELECT d.donor_id,
+           SUM(d.amount) AS total_amount,
+           COUNT(*) AS gift_count,
+           MIN(d.donation_date) AS first_donation_date,
+           MAX(d.donation_date) AS last_donation_date,
+           dn.donor_type, dn.first_name, dn.last_name, dn.organization_name,
+           dn.address_line1, dn.address_line2, dn.city, dn.state, dn.postal_code, dn.country
+    FROM donations d
+    JOIN donors dn ON dn.id = d.donor_id
+    WHERE d.donation_date >= :year_start AND d.donation_date <= :year_end
+      AND d.is_tax_deductible
+      AND d.donor_id BETWEEN :first_donor_id AND :last_donor_id
+      AND NOT EXISTS (
+          SELECT 1 FROM annual_statements s
+          WHERE s.donor_id = d.donor_id AND s.year = :year
+      )
+    GROUP BY d.donor_id, dn.id
+    ORDER BY d.donor_id
+""")
+
+SHARDS_SQL = text("""
+    SELECT shard, MIN(donor_id), MAX(donor_id), COUNT(*)
+    FROM (
+        SELECT donor_id, NTILE(:shards) OVER (ORDER BY donor_id) AS shard
+        FROM (
+            SELECT DISTINCT donor_id FROM donations
+            WHERE donation_date >= :year_start AND donation_date <= :year_end
+              AND is_tax_deductible AND donor_id IS NOT NULL
+        ) donors_in_year
+    ) sharded
+    GROUP BY shard
+    ORDER BY shard
+""")
+
+
+def donor_name(row) -> str:
+    if row.donor_type == "individual":
+        return f"{row.first_name or ''} {row.last_name or ''}".strip()
+    return row.organization_name or ""
+
+
+def render_text(row, year: int) -> str:
+    address = [row.address_line1, row.address_line2,
+               " ".join(part for part in (row.city, row.state, row.postal_code) if part), row.country]
+    lines = [
+        f"ULEM Annual Giving Statement {year}",
+        "",
+        donor_name(row),
+        *[line for line in address if line],
+        "",
+        f"Tax-deductible gifts: {row.gift_count}",
+        f"Period: {row.first_donation_date} to {row.last_donation_date}",
+        f"Total deductible amount: ${row.total_amount:,.2f}",
+        "",
+        "No goods or services were provided in exchange for these contributions.",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def render_html(row, year: int) -> str:
+    body = "".join(f"<p>{html.escape(line)}</p>" if line else "<br>"
+                   for line in render_text(row, year).splitlines()[1:])
+    return (f"<!DOCTYPE html><html><head><meta charset=\"utf-8\">"
+            f"<title>Annual Giving Statement {year}</title></head>"
+            f"<body><h1>ULEM Annual Giving Statement {year}</h1>{body}</body></html>\n")
+
+
+def render_pdf(row, year: int, path: str):
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen import canvas
+
+    pdf = canvas.Canvas(path, pagesize=letter)
+    y = 720
+    for line in render_text(row, year).splitlines():
+        pdf.drawString(72, y, line)
+        y -= 16
+    pdf.save()
+
+
+def process_shard(year: int, first_donor_id: int, last_donor_id: int, formats: list, output_dir: str) -> dict:
+    """Render and record the statements for one donor id range. Runs in a worker process."""
+    from models import AnnualStatement, SessionLocal
+
+    year_start = date(year, 1, 1)
+    os.makedirs(output_dir, exist_ok=True)
+
+    with SessionLocal() as db:
+        rows = db.execute(SHARD_STATEMENTS_SQL, {
+            "year_start": year_start, "year_end": date(year, 12, 31), "year": year,
+            "first_donor_id": first_donor_id, "last_donor_id": last_donor_id,
+        }).all()
+
+        for row in rows:
+            base = os.path.join(output_dir, f"statement_{year}_donor_{row.donor_id}")
+            if "txt" in formats:
+                with open(f"{base}.txt", "w") as output:
+                    output.write(render_text(row, year))
+            if "html" in formats:
+                with open(f"{base}.html", "w") as output:
+                    output.write(render_html(row, year))
+            if "pdf" in formats:
+                render_pdf(row, year, f"{base}.pdf")
+
+        # A concurrent job or a replay of this shard may have recorded some of these donors already
+        recorded = []
+        if rows:
+            recorded = db.scalars(pg_insert(AnnualStatement).values([
+                {"donor_id": row.donor_id, "year": year, "total_amount": row.total_amount,
+                 "gift_count": row.gift_count, "generated_date": date.today()}
+                for row in rows
+            ]).on_conflict_do_nothing(index_elements=["donor_id", "year"]).returning(AnnualStatement.id)).all()
+            db.commit()
+
+    return {"statements": len(recorded)}
+
+
+@job_handler("annual_statements")
+def generate_annual_statements(ctx: JobContext, params: dict):
+    """Generate one annual statement per donor for ``params["year"]``."""
+    from models import SessionLocal
+
+    year = int(params["year"])
+    formats = params.get("formats") or ["txt", "html"]
+    unknown = [name for name in formats if name not in STATEMENT_FORMATS]
+    if unknown:
+        raise ValueError(f"Unknown formats: {', '.join(unknown)}")
+    if "pdf" in formats:
+        import reportlab  # noqa: F401  PDF output needs the optional reportlab package
+    output_dir = os.path.join(params.get("output_dir") or STATEMENT_DIR, str(year))
+
+    checkpoint = ctx.checkpoint
+    if "shards" not in checkpoint:
+        with SessionLocal() as db:
+            shards = db.execute(SHARDS_SQL, {
+                "shards": int(params.get("shards") or STATEMENT_PROCESSES),
+                "year_start": date(year, 1, 1), "year_end": date(year, 12, 31),
+            }).all()
+        checkpoint = {
+            "shards": {str(shard): {"first_donor_id": first, "last_donor_id": last, "donors": donors,
+                                    "status": "pending"}
+                       for shard, first, last, donors in shards},
+        }
+        ctx.report(0, checkpoint)
+
+    pending = {key: shard for key, shard in checkpoint["shards"].items() if shard["status"] != "done"}
+    total = len(checkpoint["shards"]) or 1
+
+    if pending:
+        # spawn, not fork: the parent is a threaded server process
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=min(STATEMENT_PROCESSES, len(pending)), mp_context=context) as pool:
+            futures = {
+                pool.submit(process_shard, year, shard["first_donor_id"], shard["last_donor_id"],
+                            formats, output_dir): key
+                for key, shard in pending.items()
+            }
+            for future in as_completed(futures):
+                shard = checkpoint["shards"][futures[future]]
+                try:
+                    shard.update(status="done", error=None, **future.result())
+                except Exception as exc:
+                    shard.update(status="failed", error=f"{type(exc).__name__}: {exc}")
+                done = sum(1 for item in checkpoint["shards"].values() if item["status"] == "done")
+                ctx.report(100.0 * done / total, checkpoint)
+
+    failed = sorted(key for key, shard in checkpoint["shards"].items() if shard["status"] == "failed")
+    if failed:
+        raise RuntimeError(f"Shards {', '.join(failed)} failed; retry the job to rerun them")
+
+    return {
+        "year": year,
+        "shards": len(checkpoint["shards"]),
+        "statements": sum(shard.get("statements", 0) for shard in checkpoint["shards"].values()),
+        "output_dir": output_dir,
+    }